@@ -39,7 +39,7 @@ public class Assign {
         throws java.io.IOException, FormatterException, RecordLoadingException, IteratorException
     {
         if (args.length == 0) {
-            System.out.println("Usage: assign DIR");
+            System.out.println("Usage: assign DIR [sm-pq|pq-sm]");
             System.exit(1);
         }
 
@@ -48,7 +48,12 @@ public class Assign {
         String inFile = new File(baseDir, "matching_output_clerical.csv").getPath();
         String outFile = new File(baseDir, "links_1x1.csv").getPath();
 
-        assign(baseDir, "sm_pq_matching_output_clerical.csv", "sm_pq_links_1x1.csv");
-        assign(baseDir, "pq_sm_matching_output_clerical.csv", "pq_sm_links_1x1.csv");
+        String direction = args.length > 1 ? args[1] : "both";
+
+        if (direction.equals("both") || direction.equals("sm-pq"))
+            assign(baseDir, "sm_pq_matching_output_clerical.csv", "sm_pq_links_1x1.csv");
+
+        if (direction.equals("both") || direction.equals("pq-sm"))
+            assign(baseDir, "pq_sm_matching_output_clerical.csv", "pq_sm_links_1x1.csv");
     }
 }
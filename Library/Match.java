@@ -140,11 +140,16 @@ public class Match {
         throws java.io.IOException, FormatterException, RecordLoadingException, IteratorException
     {
         if (args.length == 0) {
-            System.out.println("Usage: match DIR");
+            System.out.println("Usage: match DIR [sm-pq|pq-sm]");
         }
 
         File baseDir = new File(args[0]);
-        starMetricsToProQuestMatching(baseDir);
-        proQuestToStarMetricsMatching(baseDir);
+        String direction = args.length > 1 ? args[1] : "both";
+
+        if (direction.equals("both") || direction.equals("sm-pq"))
+            starMetricsToProQuestMatching(baseDir);
+
+        if (direction.equals("both") || direction.equals("pq-sm"))
+            proQuestToStarMetricsMatching(baseDir);
     }
 }
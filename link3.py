@@ -1,8 +1,25 @@
-import argparse, csv, datetime, os, re, subprocess, sys
+import argparse, copy, csv, datetime, hashlib, json, multiprocessing, os, re, shutil, subprocess, sys, tempfile, threading, zlib
 import ConfigParser, xlrd, MySQLdb
 
 from collections import defaultdict
-from contextlib import closing
+from contextlib import closing, contextmanager
+from itertools import groupby
+from operator import itemgetter
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from metaphone import doublemetaphone
+except ImportError:
+    doublemetaphone = None
 
 def read_configuration(f):
     """Read the configuration file f and return a dict."""
@@ -36,141 +53,864 @@ def read_configuration(f):
     result["db_db"] = conf.get("Database", "db")
     result["db_host"] = conf.get("Database", "host")
 
+    if conf.has_option("Database", "batch_size"):
+        result["db_batch_size"] = int(conf.get("Database", "batch_size"))
+    else:
+        result["db_batch_size"] = 1000
+
+    if conf.has_option("Database", "pool_size"):
+        result["db_pool_size"] = int(conf.get("Database", "pool_size"))
+    else:
+        result["db_pool_size"] = 4
+
+    result["projection_profile"] = "full"
+    result["projection"] = {}
+
+    if conf.has_section("Column Projection"):
+        for k, v in conf.items("Column Projection"):
+            if k == "profile":
+                result["projection_profile"] = v
+            else:
+                result["projection"][k] = [c.strip() for c in v.split(",") if c.strip()]
+
+    return result
+
+
+# Column projection profiles: for each copied table, the columns to keep besides the ones
+# the pipeline needs (see PQ_COLUMNS and SM_AGENCY_COPIES). Tables that are not listed
+# keep all their columns.
+PROJECTION_PROFILES = {"full": {},
+                       "slim": {"proquest": [],
+                                "nih": ["BUDGET_START", "TOTAL_COST"],
+                                "nsf": ["AwardEffectiveDate"],
+                                "usda": ["start_date"],
+                                "rg": ["AwardStartDate"]}}
+
+
+def column_projection(profile="full", overrides=None):
+    """Return the column projection of the given profile, with the per-table column
+    lists in overrides (from the [Column Projection] section of the configuration)
+    taking precedence."""
+
+    if profile not in PROJECTION_PROFILES:
+        raise ValueError("Unknown column projection profile '{}'".format(profile))
+
+    result = dict(PROJECTION_PROFILES[profile])
+    result.update(overrides or {})
+
     return result
 
 
-def life_science_init(db, table_prefix="smpq"):
+def db_connect(conf):
+    """Open a new database connection using the configuration returned by
+    read_configuration."""
+
+    return MySQLdb.connect(user=conf["db_user"],
+                           passwd=conf["db_passwd"],
+                           db=conf["db_db"],
+                           host=conf["db_host"],
+                           local_infile=1)
+
+
+def close_quietly(db):
+    """Close the connection db, ignoring errors from a connection that is already gone."""
+
+    try:
+        db.close()
+    except MySQLdb.Error:
+        pass
+
+
+class ConnectionPool(object):
+    """A pool of at most size database connections opened with db_connect(conf) and
+    shared by the stages of a run. Check connections out with connection and
+    connections, or with the module-level functions of the same name.
+
+    An idle connection is pinged when it is checked out and replaced if the server has
+    dropped it. On check-in uncommitted work is rolled back, and a connection that
+    failed with an OperationalError is closed instead of returned to the pool. A
+    connection lost while it is checked out fails the work using it; the pipeline
+    stages of add_pipeline_stages that rebuild their tables then run again on new
+    connections (see STAGE_RETRIES).
+
+    A checkout waits while the pool is exhausted. Work that runs inside a checked-out
+    connection, like the threads of run_in_threads, should check out with
+    overflow=True: it then opens a temporary connection instead of waiting for one
+    that may never be returned."""
+
+    def __init__(self, conf, size=4):
+        self.conf = conf
+        self.size = max(size, 2)
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.lock = threading.Lock()
+        self.checkout_lock = threading.Lock()
+        self.idle = []
+
+
+    def get(self):
+        """Return an idle connection that is still alive, or a new one."""
+
+        with self.lock:
+            db = self.idle.pop() if self.idle else None
+
+        if db is not None:
+            try:
+                db.ping()
+                return db
+            except MySQLdb.Error:
+                close_quietly(db)
+
+        return db_connect(self.conf)
+
+
+    def put(self, db, broken=False):
+        """Return the connection db to the idle connections, or close it if broken."""
+
+        if not broken:
+            try:
+                db.rollback()
+                with self.lock:
+                    self.idle.append(db)
+                return
+            except MySQLdb.Error:
+                pass
+
+        close_quietly(db)
+
+
+    @contextmanager
+    def connections(self, n=1, overflow=False):
+        """Check out n connections and yield them as a list. The pool slots are taken
+        all at once, so stages that need several connections cannot deadlock each
+        other."""
+
+        if overflow:
+            slots = 0
+            while slots < n and self.slots.acquire(False):
+                slots += 1
+        else:
+            with self.checkout_lock:
+                for _ in range(n):
+                    self.slots.acquire()
+            slots = n
+
+        dbs = []
+        broken = False
+        try:
+            for i in range(n):
+                dbs.append(self.get() if i < slots else db_connect(self.conf))
+            yield dbs
+        except MySQLdb.OperationalError:
+            broken = True
+            raise
+        finally:
+            for i, db in enumerate(dbs):
+                if i < slots:
+                    self.put(db, broken)
+                else:
+                    close_quietly(db)
+            for _ in range(slots):
+                self.slots.release()
+
+
+    @contextmanager
+    def connection(self, overflow=False):
+        """Check out a single connection, see connections."""
+
+        with self.connections(1, overflow) as dbs:
+            yield dbs[0]
+
+
+    def close(self):
+        """Close the idle connections."""
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for db in idle:
+            close_quietly(db)
+
+
+# Times a pipeline stage is run again after losing its database connection.
+STAGE_RETRIES = 1
+
+# MySQL client errors of a connection that was lost: server has gone away, lost
+# connection during query, and lost connection (newer clients).
+CONNECTION_LOST_ERRORS = (2006, 2013, 2055)
+
+
+def connection_lost(e):
+    """Return True if the MySQLdb.OperationalError e means the connection was lost."""
+
+    return bool(e.args) and e.args[0] in CONNECTION_LOST_ERRORS
+
+
+@contextmanager
+def connections(source, n=1, overflow=False):
+    """Check out n connections from source, a ConnectionPool, or open them with
+    db_connect if source is a configuration, and yield them as a list."""
+
+    if isinstance(source, ConnectionPool):
+        with source.connections(n, overflow) as dbs:
+            yield dbs
+    else:
+        dbs = []
+        try:
+            for _ in range(n):
+                dbs.append(db_connect(source))
+            yield dbs
+        finally:
+            for db in dbs:
+                db.close()
+
+
+@contextmanager
+def connection(source, overflow=False):
+    """Check out a single connection from source, see connections."""
+
+    with connections(source, 1, overflow) as dbs:
+        yield dbs[0]
+
+
+def configuration(source):
+    """Return the configuration of source, a ConnectionPool or a configuration, for
+    worker processes that have to open their own connections."""
+
+    return source.conf if isinstance(source, ConnectionPool) else source
+
+
+class BatchWriter(object):
+    """Execute one statement for many rows with executemany, batch_size rows at a
+    time, committing after every batch unless commit is false (then the caller
+    commits, so that all the rows are written in one transaction). For "insert ...
+    values" statements MySQLdb sends each batch as a single multi-row insert. Use it
+    as a context manager: the last batch is written when the block exits, and the
+    number of rows written and the rate are printed.
+
+        with BatchWriter(db, "insert into t (a, b) values (%s, %s)") as w:
+            for row in rows:
+                w.add(row)
+    """
+
+    def __init__(self, db, sql, batch_size=1000, description=None, commit=True):
+        self.db = db
+        self.sql = sql
+        self.batch_size = batch_size
+        self.commit = commit
+        self.description = description or sql.split("(")[0].strip()
+        self.rows = []
+        self.count = 0
+        self.start = datetime.datetime.now()
+        self.cur = db.cursor()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+                self.report()
+        finally:
+            self.cur.close()
+
+        return False
+
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        if self.rows:
+            self.cur.executemany(self.sql, self.rows)
+            if self.commit:
+                self.db.commit()
+            self.count += len(self.rows)
+            self.rows = []
+
+
+    def report(self):
+        seconds = (datetime.datetime.now() - self.start).total_seconds()
+        rate = self.count / seconds if seconds > 0 else 0
+        print("{}: {} rows in {:.1f}s ({:.0f} rows/s)".format(self.description, self.count, seconds, rate))
+
+
+class RunManifest(object):
+    """Record of the stages completed by link3.py, kept as JSON in the file path (see
+    main for where). Each stage is recorded with a fingerprint of its inputs and of
+    the tokens of the stages it depends on, and gets a new token every time it runs,
+    so running a stage again invalidates the stages that depend on it. With resume,
+    run skips the stages whose fingerprint is unchanged."""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.resume = resume
+        self.stages = {}
+        self.lock = threading.RLock()
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stages = json.load(f).get("stages", {})
+
+
+    def fingerprint(self, inputs=None, depends=()):
+        with self.lock:
+            tokens = [[d, self.stages.get(d, {}).get("token")] for d in depends]
+        data = json.dumps([inputs, tokens], sort_keys=True, default=str)
+
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+    def save(self):
+        with self.lock, open(self.path, "w") as f:
+            json.dump({"stages": self.stages}, f, indent=2, sort_keys=True)
+
+
+    def run(self, name, f, args=(), inputs=None, depends=(), valid=None, always=False):
+        """Run f(*args) as the stage name, unless resuming and the stage completed with
+        the same inputs and upstream stages, and valid() (if given) is true. Stages
+        with always are run in any case."""
+
+        fingerprint = self.fingerprint(inputs, depends)
+        done = self.stages.get(name)
+
+        if self.resume and not always and done and done["fingerprint"] == fingerprint and \
+                (valid is None or valid()):
+            print("Skipping {} (completed {})".format(name, done["completed"]))
+            return
+
+        # Forget the stage while it runs, so that a failed run is not mistaken for a
+        # completed one.
+        with self.lock:
+            if self.stages.pop(name, None):
+                self.save()
+
+        start = datetime.datetime.now()
+        f(*args)
+        end = datetime.datetime.now()
+
+        with self.lock:
+            self.stages[name] = {"fingerprint": fingerprint,
+                                 "token": hashlib.sha1("{} {} {}".format(name, fingerprint, end).encode("utf-8")).hexdigest(),
+                                 "completed": end.isoformat(),
+                                 "seconds": (end - start).total_seconds()}
+            self.save()
+
+
+class StageScheduler(object):
+    """Run the stages of a pipeline, each in a thread of its own as soon as the stages it
+    depends on have finished, with at most workers stages running at a time. Stages
+    are started in the order they were added among those that are ready, so with one
+    worker they run in that order. Dependencies on stages that were not added are
+    ignored. After a stage fails no new stages are started, and the first error is
+    raised once the running stages have finished."""
+
+    def __init__(self, workers=1):
+        self.workers = max(workers, 1)
+        self.stages = []
+
+
+    def add(self, name, f, depends=()):
+        """Add the stage name, which runs f()."""
+
+        self.stages.append((name, f, list(depends)))
+
+
+    def run(self):
+        names = set(name for name, _, _ in self.stages)
+        pending = [(name, f, [d for d in depends if d in names]) for name, f, depends in self.stages]
+        running = set()
+        done = set()
+        errors = []
+        cond = threading.Condition()
+
+        def work(name, f):
+            start = datetime.datetime.now()
+            try:
+                f()
+                print("Finished stage {} in {:.1f}s".format(name, (datetime.datetime.now() - start).total_seconds()))
+            except Exception as e:
+                with cond:
+                    errors.append((name, e))
+            finally:
+                with cond:
+                    running.discard(name)
+                    done.add(name)
+                    cond.notify()
+
+        with cond:
+            while pending or running:
+                if errors:
+                    pending = []
+
+                for stage in list(pending):
+                    name, f, depends = stage
+                    if len(running) >= self.workers:
+                        break
+                    if all(d in done for d in depends):
+                        pending.remove(stage)
+                        running.add(name)
+                        print("Starting stage {}".format(name))
+                        threading.Thread(target=work, args=(name, f)).start()
+
+                if running:
+                    cond.wait(1)
+                elif pending:
+                    raise ValueError("Stages {} depend on each other".format(", ".join(s[0] for s in pending)))
+
+        if errors:
+            for name, e in errors:
+                print("Stage {} failed: {}".format(name, e))
+            raise errors[0][1]
+
+
+def run_stage(manifest, name, f, args=(), inputs=None, depends=(), valid=None, always=False):
+    """Run f(*args) as the stage name of manifest (see RunManifest.run), or simply run it
+    if manifest is None."""
+
+    if manifest is None:
+        f(*args)
+    else:
+        manifest.run(name, f, args, inputs, depends, valid, always)
+
+
+def file_fingerprint(path):
+    """Identify the version of an input file by its size and modification time."""
+
+    if not os.path.exists(path):
+        return [path, None, None]
+
+    st = os.stat(path)
+    return [path, st.st_size, int(st.st_mtime)]
+
+
+def table_exists(db, table):
+    """Return True if the table exists in the air database. The name is compared
+    exactly; a like pattern would take every _ in it as a wildcard."""
+
+    cur = db.cursor()
+    cur.execute("""select 1
+                   from information_schema.tables
+                   where table_schema = 'air' and table_name = %s""", [table])
+
+    return cur.fetchone() is not None
+
+
+def watermarks_init(db, table_prefix="smpq"):
+    """Create air.{table_prefix}_watermarks, which records how far the incremental
+    refreshes have got, if it does not exist yet."""
+
+    cur = db.cursor()
+    cur.execute("""create table if not exists air.{}_watermarks (
+                   name varchar(100) not null primary key,
+                   value varchar(100) not null,
+                   updated datetime not null)""".format(table_prefix))
+
+    db.commit()
+
+
+def get_watermark(db, name, table_prefix="smpq"):
+    """Return the value of the watermark name, or None if it has not been set."""
+
+    if not table_exists(db, "{}_watermarks".format(table_prefix)):
+        return None
+
+    cur = db.cursor()
+    cur.execute("select value from air.{}_watermarks where name = %s".format(table_prefix), [name])
+    row = cur.fetchone()
+
+    return row[0] if row else None
+
+
+def set_watermark(db, name, value, table_prefix="smpq", commit=True):
+    """Set the watermark name to value. Without commit, the watermark table must exist
+    already and the change is left to the caller's transaction."""
+
+    if commit:
+        watermarks_init(db, table_prefix)
+
+    cur = db.cursor()
+    cur.execute("""insert into air.{}_watermarks (name, value, updated)
+                   values (%s, %s, now())
+                   on duplicate key update value = values(value), updated = values(updated)""".format(table_prefix),
+                [name, str(value)])
+
+    if commit:
+        db.commit()
+
+
+def delete_watermark(db, name, table_prefix="smpq", commit=True):
+    """Remove the watermark name, if it has been set."""
+
+    cur = db.cursor()
+    cur.execute("delete from air.{}_watermarks where name = %s".format(table_prefix), [name])
+
+    if commit:
+        db.commit()
+
+
+# (table, index definitions, seconds) of every add_indexes call, for index_report.
+INDEX_TIMINGS = []
+
+
+def add_indexes(db, table, indexes):
+    """Add the indexes (definitions like "index name_ix (col)") to table with a single
+    alter table. Tables are created without their secondary indexes and indexed this
+    way once they are loaded, so that MySQL builds each index in one pass instead of
+    maintaining it row by row. The time taken is printed and kept in INDEX_TIMINGS.
+    Worker processes return the timings they add (see new_index_timings) so that
+    index_report in the main process covers them too."""
+
+    start = datetime.datetime.now()
+
+    cur = db.cursor()
+    cur.execute("alter table {} {}".format(table, ", ".join("add " + x for x in indexes)))
+    db.commit()
+
+    seconds = (datetime.datetime.now() - start).total_seconds()
+    INDEX_TIMINGS.append((table, indexes, seconds))
+    print("Indexed {} ({}) in {:.1f}s".format(table, ", ".join(indexes), seconds))
+
+
+def new_index_timings(start):
+    """Return the INDEX_TIMINGS added since there were start of them, for a worker
+    process to return to its parent."""
+
+    return INDEX_TIMINGS[start:]
+
+
+def index_report():
+    """Print how long each index build of add_indexes took, longest first."""
+
+    if not INDEX_TIMINGS:
+        return
+
+    print("Index builds:")
+    for table, indexes, seconds in sorted(INDEX_TIMINGS, key=lambda x: -x[2]):
+        print("  {:8.1f}s  {}: {}".format(seconds, table, ", ".join(indexes)))
+    print("  {:8.1f}s  total".format(sum(x[2] for x in INDEX_TIMINGS)))
+
+
+def run_in_threads(tasks):
+    """Run each of the callables in tasks in a thread of its own and wait for all of
+    them. Re-raises the first exception raised by a task."""
+
+    errors = []
+
+    def run(task):
+        try:
+            task()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(task,)) for task in tasks]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+
+def with_connection(conf, f, *args):
+    """Return a callable that runs f(db, *args) on a connection from conf (a
+    ConnectionPool or a configuration), for run_in_threads."""
+
+    def task():
+        with connection(conf, overflow=True) as db:
+            f(db, *args)
+
+    return task
+
+
+def life_science_init(db, life_science_file, table_prefix="smpq", batch_size=1000):
     """Load the list of "life science" codes into the database."""
 
     cur = db.cursor()
     cur.execute("drop table if exists air.{}_life_science".format(table_prefix))
     cur.execute("""create table air.{}_life_science (
                    subject_code int unsigned not null,
-                   subject_name varchar(200) not null,
-                   index subject_code_ix (subject_code),
-                   index subject_name_ix (subject_name))""".format(table_prefix))
+                   subject_name varchar(200) not null)""".format(table_prefix))
 
-    book = xlrd.open_workbook(LIFE_SCIENCE_FILE)
+    book = xlrd.open_workbook(life_science_file)
     sheet = book.sheet_by_name("Life Sciences")
-    for i in range(1, sheet.nrows):
-        cur.execute("""insert into air.{}_life_science
-                       (subject_code, subject_name) values (%s, %s)""".format(table_prefix),
-                    (int(sheet.cell_value(i, 0)), sheet.cell_value(i, 1)))
 
-    db.commit()
+    with BatchWriter(db, """insert into air.{}_life_science
+                            (subject_code, subject_name) values (%s, %s)""".format(table_prefix),
+                     batch_size) as w:
+        for i in range(1, sheet.nrows):
+            w.add((int(sheet.cell_value(i, 0)), sheet.cell_value(i, 1)))
 
+    add_indexes(db, "air.{}_life_science".format(table_prefix),
+                ["index subject_code_ix (subject_code)", "index subject_name_ix (subject_name)"])
 
-def gender_probabilities_parse_row(row, male_cutoff, female_cutoff):
-    """Parse one row of the gender-name file. Returns the upcased name, the 2008
-    sliding model probability, and the predicted gender as a tuple."""
+
+def gender_probabilities_parse_row(row):
+    """Parse one row of the gender-name file. Returns the upcased name and the 2008
+    sliding model probability as a tuple."""
 
     name, data = row.split("\t")[:2]
     pr_fem = float(data.split("|")[-1])
 
-    if pr_fem <= male_cutoff:
-        gender = "M"
-    elif pr_fem >= female_cutoff:
-        gender = "F"
-    else:
-        gender = "N"
+    return name.strip().upper(), pr_fem
 
-    return name.strip().upper(), pr_fem, gender
 
+def gender_sql(pr_fem_column, male_cutoff, female_cutoff):
+    """SQL expression that codes the probability in pr_fem_column as 'M', 'F', 'N'
+    (neither cutoff reached) or 'U' (unknown name). Gender is always derived from
+    the stored probabilities with this expression, so changing the cutoffs only
+    needs gender_recode."""
 
-def gender_probabilities_init(db, gender_file, male_cutoff, female_cutoff, table_prefix="smpq"):
-    """Load names and probabilities from the gender modeling paper. Use the 2008 sliding
-    model probability."""
+    return """case when {c} is null then 'U'
+                   when {c} <= {male} then 'M'
+                   when {c} >= {female} then 'F'
+                   else 'N' end""".format(c=pr_fem_column, male=float(male_cutoff), female=float(female_cutoff))
 
-    cur = db.cursor()
 
-    cur.execute("drop table if exists air.{}_gender_probabilities".format(table_prefix))
-    cur.execute("""create table air.{}_gender_probabilities (
-                   firstname varchar(40) not null,
-                   pr_fem float not null,
-                   gender char(1) not null,
-                   index firstname_ix (firstname))""".format(table_prefix))
+def gender_probabilities_rows(gender_file):
+    """Parse the gender-name file, yielding one (firstname, pr_fem) tuple per name."""
 
     with open(gender_file) as f:
         f.readline() # skip header row
         for row in f:
-            name, pr_fem, gender = gender_probabilities_parse_row(row, male_cutoff, female_cutoff)
-            cur.execute("""insert into air.{}_gender_probabilities
-                           (firstname, pr_fem, gender) values (%s, %s, %s)""".format(table_prefix),
-                           [name, pr_fem, gender])
+            yield gender_probabilities_parse_row(row)
+
+
+def gender_probabilities_bulk_load(db, gender_file, table_prefix="smpq"):
+    """Write the parsed gender-name file to a temporary tab-separated file and load it
+    with a single LOAD DATA LOCAL INFILE. Needs local_infile enabled on both the
+    connection and the server."""
+
+    start = datetime.datetime.now()
+
+    f = tempfile.NamedTemporaryFile(suffix=".tsv", delete=False)
+    try:
+        with f:
+            for name, pr_fem in gender_probabilities_rows(gender_file):
+                name = name.replace("\\", "\\\\").replace("\t", "\\t")
+                f.write("{}\t{!r}\n".format(name, pr_fem))
+
+        cur = db.cursor()
+        cur.execute("""load data local infile %s
+                       into table air.{}_gender_probabilities
+                       fields terminated by '\\t' lines terminated by '\\n'
+                       (firstname, pr_fem)""".format(table_prefix), [f.name])
+        db.commit()
+    finally:
+        os.remove(f.name)
+
+    print("load data air.{}_gender_probabilities: {} rows in {:.1f}s".format(
+          table_prefix, cur.rowcount, (datetime.datetime.now() - start).total_seconds()))
 
-    db.commit()
 
+def gender_probabilities_init(db, gender_file, table_prefix="smpq", batch_size=1000, bulk=True):
+    """Load names and probabilities from the gender modeling paper. Use the 2008 sliding
+    model probability. Only the probability is stored, see gender_sql.
+
+    With bulk, the file is loaded with gender_probabilities_bulk_load, falling back to
+    batched inserts if the server refuses LOAD DATA LOCAL INFILE. The index is added
+    once the table is loaded."""
+
+    cur = db.cursor()
 
-def pq_create_database(db, table_prefix="smpq"):
+    cur.execute("drop table if exists air.{}_gender_probabilities".format(table_prefix))
+    cur.execute("""create table air.{}_gender_probabilities (
+                   firstname varchar(40) not null,
+                   pr_fem double not null)""".format(table_prefix))
+
+    loaded = False
+    if bulk:
+        try:
+            gender_probabilities_bulk_load(db, gender_file, table_prefix)
+            loaded = True
+        except MySQLdb.Error as e:
+            print("LOAD DATA LOCAL INFILE failed ({}), inserting rows instead".format(e))
+            db.rollback()
+            cur.execute("truncate table air.{}_gender_probabilities".format(table_prefix))
+
+    if not loaded:
+        with BatchWriter(db, """insert into air.{}_gender_probabilities
+                                (firstname, pr_fem) values (%s, %s)""".format(table_prefix),
+                         batch_size) as w:
+            for row in gender_probabilities_rows(gender_file):
+                w.add(row)
+
+    add_indexes(db, "air.{}_gender_probabilities".format(table_prefix), ["index firstname_ix (firstname)"])
+
+
+# Columns of air.{table_prefix}_proquest: (name, definition, expression in the select of
+# pq_insert_records, or None for columns that are filled in later).
+PQ_COLUMNS = [("_id", "int unsigned primary key", "d._id"),
+              ("publication_number", "varchar(20)", "d.publication_number"),
+              ("degree_year", "int not null", "d.degree_year"),
+              ("author", "varchar(60) not null", "d.author"),
+              ("lastname", "varchar(40) not null", "d.author_lastname"),
+              ("firstname", "varchar(40) null", "d.author_firstname"),
+              ("gender", "char(1) null", None),
+              ("pr_fem", "double null", None),
+              ("school_code", "int not null", "i.pq_institution_id"),
+              ("institution_id", "int not null", "i._id"),
+              ("university", "varchar(45) null", "u.university"),
+              ("title", "text null", "d.title"),
+              ("translated_title", "text null", "d.translated_title"),
+              ("advisors", "varchar(100) null", "d.advisors"),
+              ("advisor_firstname", "varchar(40) null", "d.advisor_firstname"),
+              ("advisor_gender", "char(1) null", None),
+              ("advisor_pr_fem", "double null", None),
+              ("subjects", "varchar(300) null", "d.subjects"),
+              ("subject_codes", "varchar(100) null", "vds.subject_codes"),
+              ("subject_1", "varchar(200) null", "s.name"),
+              ("subject_code_1", "int null", "s.pq_subject_id"),
+              ("corporate_name", "varchar(250)", "d.corporate_name"),
+              ("degree", "varchar(20)", "d.degree"),
+              ("language", "varchar(30)", "d.language"),
+              ("life_science_code", "tinyint not null default 0", None),
+              ("abstract", "text null", None)]
+
+# Columns of the proquest table that linkage does not use, and that a column projection
+# may leave out.
+PQ_OPTIONAL_COLUMNS = ["title", "translated_title", "subjects", "abstract"]
+
+
+def pq_columns(projection=None):
+    """Return the PQ_COLUMNS kept by the column projection of the proquest table: all of
+    them if projection is None, otherwise the required columns and the optional columns
+    listed in projection."""
+
+    if projection is None:
+        return list(PQ_COLUMNS)
+
+    return [c for c in PQ_COLUMNS if c[0] not in PQ_OPTIONAL_COLUMNS or c[0] in projection]
+
+
+def pq_create_database(db, table_prefix="smpq", columns=PQ_COLUMNS):
     cur = db.cursor()
 
     cur.execute("drop table if exists air.{}_proquest".format(table_prefix))
     cur.execute("""create table air.{}_proquest (
-                   _id int unsigned primary key,
-                   publication_number varchar(20),
-                   degree_year int not null,
-                   author varchar(60) not null,
-                   lastname varchar(40) not null,
-                   firstname varchar(40) null,
-                   gender char(1) null,
-                   pr_fem float null,
-                   school_code int not null,
-                   institution_id int not null,
-                   university varchar(45) null,
-                   title text null,
-                   translated_title text null,
-                   advisors varchar(100) null,
-                   advisor_firstname varchar(40) null,
-                   advisor_gender char(1) null,
-                   advisor_pr_fem float null,
-                   subjects varchar(300) null,
-                   subject_codes varchar(100) null,
-                   subject_1 varchar(200) null,
-                   subject_code_1 int null,
-                   corporate_name varchar(250),
-                   degree varchar(20),
-                   language varchar(30),
-                   life_science_code tinyint not null default 0,
-                   abstract text null,
-                   unique index publication_number_ix (publication_number))""".format(table_prefix))
+                   {})""".format(
+                table_prefix, ",\n                   ".join("{} {}".format(name, definition)
+                                                            for name, definition, _ in columns)))
 
     db.commit()
 
 
-def pq_insert_records(db, institution_ids, min_year, table_prefix="smpq"):
+def pq_universities_init(db, institution_ids, table_prefix="smpq", batch_size=1000):
+    """Load the ProQuest institution ids and university names of the configuration into
+    air.{table_prefix}_pq_universities."""
+
+    cur = db.cursor()
+    cur.execute("drop table if exists air.{}_pq_universities".format(table_prefix))
+    cur.execute("""create table air.{}_pq_universities (
+                   institution_id int not null primary key,
+                   university varchar(45) not null)""".format(table_prefix))
+
+    sql = "insert into air.{}_pq_universities (institution_id, university) values (%s, %s)".format(table_prefix)
+    with BatchWriter(db, sql, batch_size) as writer:
+        for k, v in institution_ids.items():
+            writer.add((k, v))
+
+
+def pq_insert_chunk(db, institution_ids, min_year, table_prefix="smpq", columns=PQ_COLUMNS, min_ids=None):
+    """Insert the dissertations of the given institution ids into the proquest table,
+    taking the university names from air.{table_prefix}_pq_universities. With min_ids
+    (see pq_id_filter), only the dissertations with an _id above the watermark of their
+    institution are read, and dissertations already in the table (by _id or
+    publication_number) are updated."""
+
+    if not institution_ids:
+        return
+
     ids = ", ".join([str(n) for n in institution_ids])
+    columns = [(name, expr) for name, _, expr in columns if expr]
 
-    sql = """insert into air.{}_proquest
-             (_id, publication_number, degree_year, author, lastname, firstname, school_code,
-              institution_id, title, translated_title, advisors, advisor_firstname,
-              subjects, subject_codes, subject_1, subject_code_1, corporate_name, degree, language)
-             select d._id, d.publication_number, d.degree_year, d.author, d.author_lastname, d.author_firstname,
-                    i.pq_institution_id, i._id, d.title, d.translated_title, d.advisors, d.advisor_firstname,
-                    d.subjects, vds.subject_codes, s.name, s.pq_subject_id,
-                    d.corporate_name, d.degree, d.language
+    sql = """insert into air.{table_prefix}_proquest
+             ({names})
+             select {exprs}
              from proquest.dissertation d
+             join air.{table_prefix}_pq_universities u on u.institution_id = d.institution_id
              join proquest.institution i on i._id = d.institution_id
              left join proquest.v_dissertation_subject vds on vds.dissertation_id = d._id
              left join proquest.dissertation_subject ds on ds.dissertation_id = d._id and ds.position = 1
              left join proquest.subject s on s._id = ds.subject_id
-             where d.institution_id in ({})
-             and d.degree_year >= {}
-             and d.degree like 'Ph.D.%'""".format(table_prefix, ids, min_year)
-
+             where d.institution_id in ({ids})
+             and d.degree_year >= {min_year}
+             and d.degree like 'Ph.D.%'""".format(table_prefix=table_prefix,
+                                                  names=", ".join(name for name, _ in columns),
+                                                  exprs=", ".join(expr for _, expr in columns),
+                                                  ids=ids, min_year=min_year)
+
+    if min_ids is not None:
+        sql += "\n             and " + pq_id_filter("d", min_ids, institution_ids)
+        sql += "\n             on duplicate key update " + ", ".join(
+            "{0} = values({0})".format(name) for name, _ in columns if name not in ("_id", "publication_number"))
 
     cur = db.cursor()
     cur.execute(sql)
 
-    for k, v in institution_ids.items():
-        cur.execute("""update air.{}_proquest
-                       set university = %s
-                       where institution_id = %s""".format(table_prefix),
-                       (v, k))
-
     db.commit()
 
 
-def pq_life_science_prediction(db, institution_ids=None, table_prefix="smpq"):
+def pq_insert_records(db, institution_ids, min_year, table_prefix="smpq", columns=PQ_COLUMNS, conf=None,
+                      workers=1, batch_size=1000, min_ids=None):
+    """Insert the dissertations of the institutions in institution_ids (a dict of institution
+    id to university name) into the proquest table. With workers > 1 (and conf, a
+    ConnectionPool or configuration to connect with) the institutions are split into that many chunks, each inserted
+    by a thread with its own connection. See pq_insert_chunk for min_ids."""
+
+    pq_universities_init(db, institution_ids, table_prefix, batch_size)
+
+    ids = sorted(institution_ids)
+    chunks = [ids[i::workers] for i in range(min(max(workers, 1), len(ids)))]
+
+    if conf and len(chunks) > 1:
+        run_in_threads([with_connection(conf, pq_insert_chunk, chunk, min_year, table_prefix, columns, min_ids)
+                        for chunk in chunks])
+    else:
+        pq_insert_chunk(db, ids, min_year, table_prefix, columns, min_ids)
+
+
+def pq_id_filter(alias, min_ids, institution_ids=None):
+    """Return the condition selecting the dissertations (of the table aliased alias) of
+    the institutions in institution_ids (by default those of min_ids) with an _id above
+    the watermark of their institution in min_ids, a dict from institution id to _id.
+    Institutions missing from min_ids have a watermark of 0."""
+
+    ids = sorted(institution_ids if institution_ids else min_ids)
+    if not ids:
+        return "false"
+
+    return "({})".format(" or ".join("({0}.institution_id = {1} and {0}._id > {2})".format(alias, k, int(min_ids.get(k, 0)))
+                                     for k in ids))
+
+
+def pq_where(institution_ids=None, min_ids=None):
+    """Return the where clause restricting the proquest table (aliased pq) to the given
+    institutions and to the dissertations above the watermarks min_ids (see
+    pq_id_filter)."""
+
+    conditions = []
+
+    if institution_ids:
+        ids = ", ".join(str(n) for n in institution_ids)
+        conditions.append("pq.institution_id in ({})".format(ids))
+
+    if min_ids is not None:
+        conditions.append(pq_id_filter("pq", min_ids, institution_ids))
+
+    if not conditions:
+        return ""
+
+    return " where " + " and ".join(conditions)
+
+
+def pq_life_science_prediction(db, institution_ids=None, table_prefix="smpq", min_ids=None):
     """Update the life-science columns in the proquest table."""
 
     sql = """update air.{table_prefix}_proquest pq
@@ -179,9 +919,7 @@ def pq_life_science_prediction(db, institution_ids=None, table_prefix="smpq"):
              join air.{table_prefix}_life_science ls on ls.subject_code = s.pq_subject_id
              set pq.life_science_code = 1""".format(table_prefix=table_prefix)
 
-    if institution_ids:
-        ids = ", ".join(str(n) for n in institution_ids)
-        sql += " where pq.institution_id in ({})".format(ids)
+    sql += pq_where(institution_ids, min_ids)
 
     cur = db.cursor()
     cur.execute(sql)
@@ -189,45 +927,162 @@ def pq_life_science_prediction(db, institution_ids=None, table_prefix="smpq"):
     db.commit()
 
 
-def pq_gender_prediction(db, institution_ids=None, table_prefix="smpq"):
+def pq_gender_prediction(db, institution_ids=None, table_prefix="smpq", male_cutoff=0.2, female_cutoff=0.8,
+                         min_ids=None):
     """Update gender prediction columns in the proquest table."""
     
-    if institution_ids:
-        ids = ", ".join(str(n) for n in institution_ids)
-        where_clause = " where pq.institution_id in ({})".format(ids)
-    else:
-        where_clause = ""
+    where_clause = pq_where(institution_ids, min_ids)
 
     cur = db.cursor()
     cur.execute("""update air.{table_prefix}_proquest pq
                    join air.{table_prefix}_gender_probabilities prob using (firstname)
-                   set pq.pr_fem = prob.pr_fem, pq.gender = prob.gender""".format(table_prefix=table_prefix) + where_clause)
+                   set pq.pr_fem = prob.pr_fem""".format(table_prefix=table_prefix) + where_clause)
 
     cur.execute("""update air.{table_prefix}_proquest pq
                    join air.{table_prefix}_gender_probabilities prob on pq.advisor_firstname = prob.firstname
-                   set pq.advisor_pr_fem = prob.pr_fem, pq.advisor_gender = prob.gender""".format(table_prefix=table_prefix) + where_clause)
+                   set pq.advisor_pr_fem = prob.pr_fem""".format(table_prefix=table_prefix) + where_clause)
+
+    db.commit()
+
+    pq_gender_coding(db, male_cutoff, female_cutoff, institution_ids, table_prefix, min_ids)
+
+
+def pq_gender_coding(db, male_cutoff, female_cutoff, institution_ids=None, table_prefix="smpq", min_ids=None):
+    """Set the gender columns in the proquest table from the stored probabilities."""
 
-    cur.execute("""update air.{}_proquest pq
-                   set pq.gender = 'U'
-                   where pq.gender is null""".format(table_prefix))
+    sql = """update air.{}_proquest pq
+             set pq.gender = {},
+                 pq.advisor_gender = {}""".format(table_prefix,
+                                                  gender_sql("pq.pr_fem", male_cutoff, female_cutoff),
+                                                  gender_sql("pq.advisor_pr_fem", male_cutoff, female_cutoff))
 
-    cur.execute("""update air.{}_proquest pq
-                   set pq.advisor_gender = 'U'
-                   where pq.advisor_gender is null""".format(table_prefix))
+    sql += pq_where(institution_ids, min_ids)
+
+    cur = db.cursor()
+    cur.execute(sql)
 
     db.commit()
 
 
-def pq_init(db, institution_ids, table_prefix="smpq"):
-    """Extract a set of records from the ProQuest data corresponding to the given school code."""
+def pq_create_indexes(db, table_prefix="smpq"):
+    """Index the loaded proquest table: publication_number for pq_name_fix and the links,
+    and institution_id for the per-institution updates and the matching input."""
+
+    add_indexes(db, "air.{}_proquest".format(table_prefix),
+                ["unique index publication_number_ix (publication_number)",
+                 "index institution_id_ix (institution_id)"])
+
+
+def pq_column_names(columns):
+    """Return the names of the proquest columns as stored with the watermarks."""
+
+    return ",".join(name for name, _, _ in columns)
+
+
+def pq_watermark(db, institution_ids, min_year, table_prefix="smpq", columns=PQ_COLUMNS):
+    """Return a dict from each of the given institutions to the _id up to which the
+    proquest table is complete for it, or None if the table has to be rebuilt: when it
+    does not exist, there are no institutions, or min_year or the columns have changed.
+    Institutions without a watermark of their own (new ones) get 0, so that all of
+    their dissertations are loaded."""
+
+    if not institution_ids or not table_exists(db, "{}_proquest".format(table_prefix)):
+        return None
+
+    if get_watermark(db, "proquest_min_year", table_prefix) != str(min_year):
+        return None
+
+    if get_watermark(db, "proquest_columns", table_prefix) != pq_column_names(columns):
+        return None
+
+    return dict((k, int(get_watermark(db, "proquest_id_{}".format(k), table_prefix) or 0)) for k in institution_ids)
+
+
+def pq_set_watermarks(db, institution_ids, min_year, table_prefix="smpq", columns=PQ_COLUMNS):
+    """Record the highest _id loaded for each institution, and the min_year and columns
+    they were loaded with."""
+
+    cur = db.cursor()
+    cur.execute("""select institution_id, max(_id)
+                   from air.{}_proquest
+                   group by 1""".format(table_prefix))
+    max_ids = dict(cur.fetchall())
+
+    for k in institution_ids:
+        set_watermark(db, "proquest_id_{}".format(k), max_ids.get(k, 0), table_prefix)
+
+    set_watermark(db, "proquest_min_year", min_year, table_prefix)
+    set_watermark(db, "proquest_columns", pq_column_names(columns), table_prefix)
+
+
+def pq_init(db, institution_ids, min_year, table_prefix="smpq", male_cutoff=0.2, female_cutoff=0.8,
+            projection=None, conf=None, workers=1, batch_size=1000, incremental=False, manifest=None,
+            predict=True):
+    """Extract a set of records from the ProQuest data corresponding to the given school code.
+    projection is a column projection as returned by column_projection. See
+    pq_insert_records for conf and workers.
+
+    With incremental, an existing proquest table is kept and only the dissertations above
+    the watermark of their institution (see pq_watermark) are loaded and predicted;
+    dissertation _ids grow as new batches arrive. The table is rebuilt if there is no
+    usable watermark.
+
+    Each step is run as a stage of the RunManifest manifest, if given; incremental
+    loads are always run. Without predict, the life-science and gender predictions are
+    left to the caller (see pq_life_science_stage and pq_gender_stage). Incremental
+    loads always run them."""
+
+    columns = pq_columns((projection or {}).get("proquest"))
+    min_ids = pq_watermark(db, institution_ids, min_year, table_prefix, columns) if incremental else None
+    inputs = [sorted(institution_ids.items()), min_year, table_prefix]
+
+    def exists():
+        return table_exists(db, "{}_proquest".format(table_prefix))
+
+    run_stage(manifest, "pq.load", pq_load,
+              (db, institution_ids, min_year, table_prefix, columns, conf, workers, batch_size, min_ids),
+              inputs + [columns], valid=exists, always=min_ids is not None)
+
+    if predict or min_ids is not None:
+        pq_life_science_stage(db, institution_ids, min_year, table_prefix, min_ids, manifest)
+        pq_gender_stage(db, institution_ids, min_year, table_prefix, male_cutoff, female_cutoff, min_ids, manifest)
+
+    pq_set_watermarks(db, institution_ids, min_year, table_prefix, columns)
+
+
+def pq_life_science_stage(db, institution_ids, min_year, table_prefix="smpq", min_ids=None, manifest=None):
+    """Run pq_life_science_prediction as the pq.life_science stage of manifest. See pq_init."""
+
+    run_stage(manifest, "pq.life_science", pq_life_science_prediction, (db, institution_ids, table_prefix, min_ids),
+              [sorted(institution_ids.items()), min_year, table_prefix], ["pq.load", "life_science"])
+
 
-    pq_create_database(db, table_prefix)
-    pq_insert_records(db, institution_ids, table_prefix)
-    pq_life_science_prediction(db, institution_ids, table_prefix)
-    pq_gender_prediction(db, institution_ids, table_prefix)
+def pq_gender_stage(db, institution_ids, min_year, table_prefix="smpq", male_cutoff=0.2, female_cutoff=0.8,
+                    min_ids=None, manifest=None):
+    """Run pq_gender_prediction as the pq.gender stage of manifest. See pq_init."""
 
+    run_stage(manifest, "pq.gender", pq_gender_prediction,
+              (db, institution_ids, table_prefix, male_cutoff, female_cutoff, min_ids),
+              [sorted(institution_ids.items()), min_year, table_prefix, male_cutoff, female_cutoff],
+              ["pq.load", "gender_probabilities"])
 
-def pq_name_fix(db, institution_ids=None, table_prefix="smpq"):
+
+def pq_load(db, institution_ids, min_year, table_prefix="smpq", columns=PQ_COLUMNS, conf=None, workers=1,
+            batch_size=1000, min_ids=None):
+    """Create, fill and index the proquest table or, with min_ids, add the dissertations
+    above the watermarks min_ids to it. See pq_init."""
+
+    if min_ids is None:
+        pq_create_database(db, table_prefix, columns)
+        pq_insert_records(db, institution_ids, min_year, table_prefix, columns, conf, workers, batch_size)
+        pq_create_indexes(db, table_prefix)
+    else:
+        print("Loading ProQuest dissertations above the watermarks {}".format(
+            ", ".join("{}: {}".format(k, v) for k, v in sorted(min_ids.items()))))
+        pq_insert_records(db, institution_ids, min_year, table_prefix, columns, conf, workers, batch_size, min_ids)
+
+
+def pq_name_fix(db, institution_ids=None, table_prefix="smpq", batch_size=1000):
     """Update the last-name field in proquest, if this works well then the fix should be applied
     to the proquest database itself.
     
@@ -235,7 +1090,6 @@ def pq_name_fix(db, institution_ids=None, table_prefix="smpq"):
     the last name in each file"""
 
     cur = db.cursor()
-    cur2 = db.cursor()
 
     sql = "select publication_number, author from air.{}_proquest pq".format(table_prefix)
     if institution_ids:
@@ -244,15 +1098,34 @@ def pq_name_fix(db, institution_ids=None, table_prefix="smpq"):
 
     cur.execute(sql)
 
-    sql = "update air.{}_proquest set lastname = %s where publication_number = %s".format(table_prefix)
+    # The new names are written to a keyed temporary table in batches and applied
+    # with a single update join. A table left by a failed run on the same (pooled)
+    # connection is dropped first.
+    cur2 = db.cursor()
+    cur2.execute("drop temporary table if exists air.{}_proquest_name_fix".format(table_prefix))
+    cur2.execute("""create temporary table air.{}_proquest_name_fix (
+                    publication_number varchar(20) primary key,
+                    lastname varchar(40) not null)""".format(table_prefix))
+
     expr = re.compile("^[^.,]+")
 
-    for row in cur:
-        publication_number, author = row
-        m = expr.search(author)
-        if m:
-            lastname = m.group().upper()
-            cur2.execute(sql, (lastname, publication_number))
+    with BatchWriter(db, """insert into air.{}_proquest_name_fix
+                            (publication_number, lastname) values (%s, %s)""".format(table_prefix),
+                     batch_size) as w:
+        for row in cur:
+            publication_number, author = row
+            # Rows without a publication number cannot be joined back; the update by
+            # publication number never matched them either.
+            if publication_number is None:
+                continue
+            m = expr.search(author or "")
+            if m:
+                w.add((publication_number, m.group().upper()))
+
+    cur2.execute("""update air.{table_prefix}_proquest pq
+                    join air.{table_prefix}_proquest_name_fix fix using (publication_number)
+                    set pq.lastname = fix.lastname""".format(table_prefix=table_prefix))
+    cur2.execute("drop temporary table air.{}_proquest_name_fix".format(table_prefix))
 
     db.commit()
 
@@ -261,14 +1134,93 @@ def sm_source_id_list(sm_source_ids):
     return ", ".join("{}".format(v) for v in sm_source_ids.keys())
 
 
-def sm_names_init(db, table_prefix="smpq"):
-    """Create a table to store starmetrics employees."""
+def sm_transactions_init(db, sm_source_ids, table_prefix="smpq", since=None):
+    """Create air.{table_prefix}_sm_transactions, the staging table of the employee
+    transactions of the given sources, joined to the employee, source, occupation, award
+    and agency program tables, with the year of each transaction stored in a column.
+    This is the only scan of starmetricsnew.employee_transaction; every later STAR
+    METRICS step reads from the staging table.
+
+    The occupation is left-joined because the award tables count transactions without
+    one; employees are computed from transactions that have an occupation only, see
+    sm_transaction_filter.
+
+    since maps source ids to a date: only the transactions of that source starting on
+    or after the date are staged (see sm_refresh)."""
+
+    if since:
+        conditions = []
+        for k in sm_source_ids:
+            if since.get(k):
+                conditions.append("(et.__source_id = {} and et.period_start_date >= '{}')".format(k, since[k]))
+            else:
+                conditions.append("et.__source_id = {}".format(k))
+        where_clause = " or ".join(conditions)
+    else:
+        where_clause = "et.__source_id in ({})".format(sm_source_id_list(sm_source_ids))
 
     cur = db.cursor()
-    cur.execute("drop table if exists air.{}_sm_names".format(table_prefix))
-    cur.execute("""create table air.{}_sm_names (
-                   __employee_id int unsigned not null,
-                   university varchar(45) null,
+    cur.execute("drop table if exists air.{}_sm_transactions".format(table_prefix))
+    cur.execute("""create table air.{}_sm_transactions
+                   select et.__employee_id, et.__source_id, et.__award_id,
+                          s.name university, upper(e.last_name) last_name, upper(e.first_name) first_name,
+                          et.period_start_date, et.period_end_date, year(et.period_start_date) year,
+                          o.occupational_classification, et.x_occupational_classification,
+                          a.unique_award_number, ap.cfda, ap.agency_code, ap.program_code, ap.is_nih
+                   from starmetricsnew.employee_transaction et
+                   join starmetricsnew.employee e using (__employee_id)
+                   join starmetricsnew.source s on s.__source_id = et.__source_id
+                   left join starmetricsnew.occupation o using (__occupation_id)
+                   join starmetricsnew.award a using (__award_id)
+                   join starmetricsnew.agency_program ap using (__agency_program_id)
+                   where {}""".format(table_prefix, where_clause))
+
+    db.commit()
+
+    # A rebuilt staging table holds nothing of an interrupted sm_refresh to undo.
+    if not since and table_exists(db, "{}_watermarks".format(table_prefix)):
+        delete_watermark(db, "sm_refresh_appended", table_prefix)
+
+    add_indexes(db, "air.{}_sm_transactions".format(table_prefix),
+                ["index employee_ix (__employee_id, period_start_date, period_end_date, "
+                 "occupational_classification, x_occupational_classification, is_nih, agency_code)",
+                 "index source_ix (__source_id)",
+                 "index award_year_ix (__award_id, year)"])
+
+
+def sm_transaction_filter(sm_source_ids, employee_ids=None, require_occupation=True):
+    """Where-clause selecting the staged transactions (alias et) of the given sources
+    and, optionally, of the given employees only (an empty list selects nothing). With
+    require_occupation, only the transactions that count towards employees are
+    selected."""
+
+    sql = "et.__source_id in ({})".format(sm_source_id_list(sm_source_ids))
+    if require_occupation:
+        sql += " and et.occupational_classification is not null"
+    if employee_ids is not None:
+        if employee_ids:
+            sql += " and et.__employee_id in ({})".format(", ".join(str(n) for n in employee_ids))
+        else:
+            sql += " and false"
+
+    return sql
+
+
+# Order of the transactions within an employee. Employee resolves ties by taking the
+# first row, so the order is made total (as far as the aggregated columns go) to keep
+# the engines deterministic and in agreement.
+SM_TRANSACTION_ORDER = """et.period_start_date, et.period_end_date, et.occupational_classification,
+                          et.x_occupational_classification, et.is_nih, et.agency_code"""
+
+
+def sm_names_init(db, table_prefix="smpq"):
+    """Create a table to store starmetrics employees."""
+
+    cur = db.cursor()
+    cur.execute("drop table if exists air.{}_sm_names".format(table_prefix))
+    cur.execute("""create table air.{}_sm_names (
+                   __employee_id int unsigned not null,
+                   university varchar(45) null,
                    last_name varchar(50) null,
                    first_name varchar(50) null,
                    max_grad_year int null,
@@ -278,7 +1230,7 @@ def sm_names_init(db, table_prefix="smpq"):
                    work_6_months_over_2_years tinyint not null default 0,
                    work_12_months_over_2_years tinyint not null default 0,
                    gender char(1) null,
-                   pr_fem float null,
+                   pr_fem double null,
                    life_science_code tinyint null,
                    nsf tinyint not null default 0,
                    nih tinyint not null default 0,
@@ -309,8 +1261,41 @@ def is_usda(agency_code):
     return int(agency_code) == 10
 
 
+def state_text(value):
+    """Return value, decoding the byte strings returned by MySQLdb as latin-1 so that
+    json can store them whatever their encoding. state_bytes reverses this."""
+
+    if isinstance(value, bytes):
+        return value.decode("latin-1")
+
+    return value
+
+
+def state_bytes(value):
+    """Return the str of the value read back from json, see state_text. Under Python 3
+    strings are returned as they are."""
+
+    if bytes is str and isinstance(value, type(u"")):
+        return value.encode("latin-1")
+
+    return value
+
+
 class Employee(object):
 
+    # Attributes saved by getstate, besides the employee id and days_worked_by_occup.
+    state_fields = ["university", "last_name", "first_name",
+                    "min_period_start_date", "max_period_end_date",
+                    "min_grad_period_start_date", "max_grad_period_end_date",
+                    "first_grad_orig_occup", "last_grad_orig_occup",
+                    "first_appear_bucketed_occup", "first_appear_orig_occup",
+                    "last_appear_bucketed_occup", "last_appear_orig_occup",
+                    "total_days_worked", "total_days_worked_on_nih",
+                    "total_days_worked_on_nsf", "total_days_worked_on_usda"]
+
+    state_dates = ["min_period_start_date", "max_period_end_date",
+                   "min_grad_period_start_date", "max_grad_period_end_date"]
+
     def __init__(self, row):
         self.__employee_id = row['__employee_id']
         self.university = row['university']
@@ -389,6 +1374,56 @@ class Employee(object):
             self.total_days_worked_on_usda += dt
 
 
+    def getstate(self):
+        """Return the aggregation state as a dict that can be stored as JSON, so that
+        later transactions can be added to the employee with fromstate and
+        addtransaction."""
+
+        state = dict((k, state_text(getattr(self, k))) for k in self.state_fields)
+        for k in self.state_dates:
+            state[k] = state[k].isoformat()
+
+        state["__employee_id"] = self.__employee_id
+        state["days_worked_by_occup"] = dict((state_text(k), v) for k, v in self.days_worked_by_occup.items())
+
+        return state
+
+
+    @classmethod
+    def fromstate(cls, state):
+        """Return the Employee saved by getstate."""
+
+        e = cls.__new__(cls)
+        e.__employee_id = state["__employee_id"]
+
+        for k in cls.state_fields:
+            setattr(e, k, state_bytes(state[k]))
+        for k in cls.state_dates:
+            setattr(e, k, datetime.datetime.strptime(state[k], "%Y-%m-%d").date())
+
+        e.days_worked_by_occup = defaultdict(int, ((state_bytes(k), v)
+                                                   for k, v in state["days_worked_by_occup"].items()))
+
+        return e
+
+
+    @property
+    def employee_id(self):
+        return self.__employee_id
+
+
+    def days_worked_as_grad(self):
+        return sum(v for k, v in self.days_worked_by_occup.items() if k.lower().startswith("graduate"))
+
+
+    def days_worked_under_first_occup(self):
+        return self.days_worked_by_occup[self.first_appear_bucketed_occup]
+
+
+    def days_worked_under_last_occup(self):
+        return self.days_worked_by_occup[self.last_appear_bucketed_occup]
+
+
     def days_spanned(self):
         return (self.max_period_end_date - self.min_period_start_date).days
 
@@ -401,10 +1436,6 @@ class Employee(object):
         return self.days_spanned() > 2 * 365 and self.total_days_worked > 360
 
 
-    def days_worked_as_grad(self):
-        return sum(v for k, v in self.days_worked_by_occup.items() if k.lower().startswith("graduate"))
-
-
     def work_6_months_on_nih(self):
         return self.total_days_worked_on_nih > 180
 
@@ -430,7 +1461,7 @@ class Employee(object):
             max_grad_period_end_date = None
             max_grad_year = None
 
-        return {"__employee_id": self.__employee_id,
+        return {"__employee_id": self.employee_id,
                 "university": self.university,
                 "last_name": self.last_name,
                 "first_name": self.first_name,
@@ -444,7 +1475,7 @@ class Employee(object):
                 "first_appear_bucketed_occup": self.first_appear_bucketed_occup,
                 "first_appear_orig_occup": self.first_appear_orig_occup,
                 "first_appear_date": self.min_period_start_date,
-                "days_worked_under_first_occup": self.days_worked_by_occup[self.first_appear_bucketed_occup],
+                "days_worked_under_first_occup": self.days_worked_under_first_occup(),
                 "first_appear_as_grad_date": min_grad_period_start_date,
                 "first_appear_as_grad_orig_occup": self.first_grad_orig_occup,
                 "last_appear_as_grad_date": max_grad_period_end_date,
@@ -452,479 +1483,2797 @@ class Employee(object):
                 "days_worked_as_grad": days_worked_as_grad,
                 "last_appear_bucketed_occup": self.last_appear_bucketed_occup,
                 "last_appear_orig_occup": self.last_appear_orig_occup,
-                "days_worked_under_last_occup": self.days_worked_by_occup[self.last_appear_bucketed_occup],
+                "days_worked_under_last_occup": self.days_worked_under_last_occup(),
                 "work_6_months_on_nih": self.work_6_months_on_nih(),
                 "work_6_months_on_nsf": self.work_6_months_on_nsf(),
                 "work_6_months_on_usda": self.work_6_months_on_usda()}
 
 
-def sm_get_employees(db, sm_source_ids):
-    employees = {}
+def first_index_by_group(mask, starts):
+    """For each group beginning at the offsets in starts, return the index of the
+    first row where mask is true, or len(mask) if there is none."""
+
+    n = len(mask)
+    return np.minimum.reduceat(np.where(mask, np.arange(n), n), starts)
+
+
+# MySQL to_days() of a date minus its date.toordinal().
+MYSQL_DAYS_OFFSET = 365
+
+
+def day_dates(days, mask=None):
+    """Return the dates of the MySQL day numbers days as a list, with None where mask
+    is false. Each distinct day is converted once."""
+
+    unique, index = np.unique(days, return_inverse=True)
+    dates = np.array([datetime.date.fromordinal(int(d) - MYSQL_DAYS_OFFSET) for d in unique], dtype=object)[index]
+    if mask is not None:
+        dates[~mask] = None
+
+    return dates.tolist()
+
+
+def sm_summarize_columnar(columns, strings):
+    """Aggregate a batch of transaction columns, as yielded by
+    sm_transaction_column_batches, with NumPy grouped reductions. The batch must hold
+    every transaction with an occupation of the employees it contains, and no others.
+    Rows are treated in the order of sm_get_transactions, so ties are resolved
+    exactly as Employee.addtransaction resolves them.
+
+    Returns the SM_NAMES_COLUMNS of the employees as a dict from column name to a
+    list with one value per employee, in __employee_id order."""
+
+    ids = columns["__employee_id"]
+    n = len(ids)
+    if n == 0:
+        return dict((k, []) for k in SM_NAMES_COLUMNS)
+
+    start = columns["start"]
+    end = columns["end"]
+    occup = columns["occup"]
+    x_occup = columns["x_occup"]
+
+    strings = np.array(strings, dtype=object)
+    is_grad = np.array([x is not None and x.lower().startswith("graduate") for x in strings], dtype=bool)[occup]
+    is_true = np.array([bool(x) for x in strings], dtype=bool)
+
+    starts = np.concatenate(([0], np.flatnonzero(ids[1:] != ids[:-1]) + 1))
+    counts = np.diff(np.append(starts, n))
+    group = np.repeat(np.arange(len(starts)), counts)
+
+    # Employee counts the first transaction inclusively and the others exclusively.
+    dt = end - start
+    dt[starts] += 1
+
+    first = first_index_by_group(start == np.minimum.reduceat(start, starts)[group], starts)
+    last = first_index_by_group(end == np.maximum.reduceat(end, starts)[group], starts)
+
+    grad_start = np.where(is_grad, start, np.iinfo(np.int64).max)
+    grad_end = np.where(is_grad, end, np.iinfo(np.int64).min)
+    grad_first = first_index_by_group(is_grad & (start == np.minimum.reduceat(grad_start, starts)[group]), starts)
+    grad_last = first_index_by_group(is_grad & (end == np.maximum.reduceat(grad_end, starts)[group]), starts)
+
+    n_occup = len(strings)
+    keys, key_index = np.unique(group * n_occup + occup, return_inverse=True)
+    occup_days = np.bincount(key_index, weights=dt).astype(np.int64)
+    first_occup_days = occup_days[np.searchsorted(keys, np.arange(len(starts)) * n_occup + occup[first])]
+    last_occup_days = occup_days[np.searchsorted(keys, np.arange(len(starts)) * n_occup + occup[last])]
+
+    total_days = np.add.reduceat(dt, starts)
+    grad_days = np.add.reduceat(np.where(is_grad, dt, 0), starts)
+    nih_days = np.add.reduceat(np.where(columns["is_nih"], dt, 0), starts)
+    nsf_days = np.add.reduceat(np.where(columns["is_nsf"], dt, 0), starts)
+    usda_days = np.add.reduceat(np.where(columns["is_usda"], dt, 0), starts)
+
+    # Employees without a graduate transaction point at their first row and are
+    # masked. Like Employee.todict, the graduate dates are only given with a
+    # graduate occupation.
+    has_grad = grad_first < n
+    grad_first = np.where(has_grad, grad_first, starts)
+    grad_last = np.where(has_grad, grad_last, starts)
+    grad_dates = has_grad & is_true[x_occup[grad_first]]
+
+    min_dates = day_dates(start[first])
+    last_grad_dates = day_dates(end[grad_last], grad_dates)
+    spanned_2_years = end[last] - start[first] > 2 * 365
+    university, last_name, first_name = zip(*columns["names"][starts])
+
+    return {"__employee_id": ids[starts].tolist(),
+            "university": list(university),
+            "last_name": list(last_name),
+            "first_name": list(first_name),
+            "max_grad_year": [d.year if d else None for d in last_grad_dates],
+            "min_period_start_date": min_dates,
+            "max_period_end_date": day_dates(end[last]),
+            "days_worked": total_days.tolist(),
+            "work_6_months_over_2_years": (spanned_2_years & (total_days > 180)).tolist(),
+            "work_12_months_over_2_years": (spanned_2_years & (total_days > 360)).tolist(),
+            "first_appear_bucketed_occup": strings[occup[first]].tolist(),
+            "first_appear_orig_occup": strings[x_occup[first]].tolist(),
+            "first_appear_date": min_dates,
+            "days_worked_under_first_occup": first_occup_days.tolist(),
+            "first_appear_as_grad_date": day_dates(start[grad_first], grad_dates),
+            "first_appear_as_grad_orig_occup": np.where(has_grad, strings[x_occup[grad_first]], None).tolist(),
+            "last_appear_as_grad_date": last_grad_dates,
+            "last_appear_as_grad_orig_occup": np.where(has_grad, strings[x_occup[grad_last]], None).tolist(),
+            "days_worked_as_grad": grad_days.tolist(),
+            "last_appear_bucketed_occup": strings[occup[last]].tolist(),
+            "last_appear_orig_occup": strings[x_occup[last]].tolist(),
+            "days_worked_under_last_occup": last_occup_days.tolist(),
+            "work_6_months_on_nih": (nih_days > 180).tolist(),
+            "work_6_months_on_nsf": (nsf_days > 180).tolist(),
+            "work_6_months_on_usda": (usda_days > 180).tolist()}
+
+
+def sm_get_transactions(db, sm_source_ids, employee_ids=None, table_prefix="smpq", require_occupation=True):
+    """Execute the STAR METRICS transaction query on an unbuffered cursor and return
+    the cursor. Rows are ordered by __employee_id and then by SM_TRANSACTION_ORDER."""
+
+    cur = db.cursor(MySQLdb.cursors.SSDictCursor)
+    cur.execute("""select et.__employee_id, et.university, et.last_name, et.first_name,
+                   et.period_start_date, et.period_end_date,
+                   datediff(et.period_end_date, et.period_start_date) + 1 days_worked,
+                   et.occupational_classification, et.x_occupational_classification,
+                   et.agency_code, et.program_code, et.is_nih, et.__award_id, et.year
+                   from air.{}_sm_transactions et
+                   where {}
+                   order by et.__employee_id, {}""".format(table_prefix,
+                                                           sm_transaction_filter(sm_source_ids, employee_ids,
+                                                                                 require_occupation),
+                                                           SM_TRANSACTION_ORDER))
+
+    return cur
+
+
+def sm_get_transaction_tuples(db, sm_source_ids, employee_ids=None, table_prefix="smpq", require_occupation=True):
+    """Like sm_get_transactions, but on an unbuffered tuple cursor and with the columns
+    read by sm_transaction_arrays: the dates as MySQL day numbers and the agency tests
+    done in MySQL, so that no Python objects are made for them."""
+
+    cur = db.cursor(MySQLdb.cursors.SSCursor)
+    cur.execute("""select et.__employee_id, to_days(et.period_start_date), to_days(et.period_end_date),
+                   et.occupational_classification, et.x_occupational_classification,
+                   et.is_nih <=> 1, et.agency_code <=> 47, et.agency_code <=> 10, et.__award_id, et.year,
+                   et.university, et.last_name, et.first_name
+                   from air.{}_sm_transactions et
+                   where {}
+                   order by et.__employee_id, {}""".format(table_prefix,
+                                                           sm_transaction_filter(sm_source_ids, employee_ids,
+                                                                                 require_occupation),
+                                                           SM_TRANSACTION_ORDER))
+
+    return cur
+
+
+def sm_transaction_arrays(rows, codes):
+    """Turn rows of sm_get_transaction_tuples into a dict of column arrays, one column
+    at a time. The occupations are stored as integer codes from codes, a defaultdict
+    that gives each new occupation the next code. The names (university, last and first name) come from the
+    employee and source tables and are the same on every transaction of an employee,
+    so each row refers to the names tuple of the first row of its employee."""
+
+    n = len(rows)
+
+    def column(k, dtype=np.int64):
+        return np.fromiter(map(itemgetter(k), rows), dtype, n)
+
+    def codes_of(k):
+        return np.fromiter(map(codes.__getitem__, map(itemgetter(k), rows)), np.int64, n)
+
+    ids = column(0)
+
+    runs = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    names = np.empty(len(runs), dtype=object)
+    for j, i in enumerate(runs):
+        names[j] = rows[i][10:13]
+
+    return {"__employee_id": ids,
+            "start": column(1),
+            "end": column(2),
+            "occup": codes_of(3),
+            "x_occup": codes_of(4),
+            "is_nih": column(5, np.bool_),
+            "is_nsf": column(6, np.bool_),
+            "is_usda": column(7, np.bool_),
+            "__award_id": column(8),
+            "year": column(9),
+            "names": np.repeat(names, np.diff(np.append(runs, n)))}
+
+
+def select_columns(columns, index):
+    """Return the rows index (a slice, mask or index array) of the column arrays columns."""
+
+    return dict((k, v[index]) for k, v in columns.items())
+
+
+def sm_transaction_column_batches(cur, batch_size=100000, fetch_size=10000):
+    """Read the rows of sm_get_transaction_tuples from cur fetch_size at a time and
+    yield them as (columns, strings) in batches of about batch_size rows. Like the
+    batches of sm_transaction_batches, every employee is complete within a single
+    batch. columns holds the arrays of sm_transaction_arrays and strings the
+    occupations of their codes, by code."""
+
+    codes = defaultdict(lambda: len(codes))
+    strings = []
+    parts = []
+    count = 0
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if rows:
+            parts.append(sm_transaction_arrays(rows, codes))
+            count += len(rows)
+            if count < batch_size:
+                continue
+        elif not parts:
+            break
+
+        columns = dict((k, np.concatenate([p[k] for p in parts])) for k in parts[0])
+        ids = columns["__employee_id"]
+        if rows:
+            # The last employee may go on in the next rows, so it is held back.
+            other = np.flatnonzero(ids != ids[-1])
+            i = other[-1] + 1 if len(other) else 0
+        else:
+            i = len(ids)
+
+        if len(strings) < len(codes):
+            strings = sorted(codes, key=codes.get)
+
+        if i > 0:
+            yield select_columns(columns, slice(0, i)), strings
+
+        if not rows:
+            break
+
+        parts = [select_columns(columns, slice(i, len(ids)))]
+        count = len(ids) - i
+
+
+def sm_transaction_batches(cur, batch_size=100000):
+    """Read transaction rows from cur in batches of about batch_size rows. The rows of
+    the last employee in a batch are held back for the next one, so that every
+    employee is complete within a single batch."""
+
+    pending = []
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+
+        rows = pending + list(rows)
+        last_id = rows[-1]["__employee_id"]
+        i = len(rows)
+        while i > 0 and rows[i - 1]["__employee_id"] == last_id:
+            i -= 1
+
+        pending = rows[i:]
+        if i > 0:
+            yield rows[:i]
+
+    if pending:
+        yield pending
+
+
+# Employees read at a time by sm_employee_batches without a second connection.
+SM_EMPLOYEE_CHUNK = 1000
+
+
+def sm_employee_batches(db, sm_source_ids, table_prefix="smpq", read_db=None, require_occupation=True,
+                        batch_size=10000, columnar=False):
+    """Yield the staged transactions in batches of complete employees, ordered as by
+    sm_get_transactions. With read_db, the transactions are streamed from an unbuffered
+    cursor on read_db (see sm_transaction_batches) while the caller writes to db.
+    Otherwise the employees are read from db SM_EMPLOYEE_CHUNK at a time, each chunk
+    completely before it is yielded, so that db is free for writing in between.
+
+    With columnar, the batches are the (columns, strings) pairs of
+    sm_transaction_column_batches instead of lists of dict rows."""
+
+    if columnar:
+        query, batches = sm_get_transaction_tuples, sm_transaction_column_batches
+    else:
+        query, batches = sm_get_transactions, sm_transaction_batches
+
+    if read_db:
+        with closing(query(read_db, sm_source_ids, table_prefix=table_prefix,
+                           require_occupation=require_occupation)) as cur:
+            for batch in batches(cur, batch_size):
+                yield batch
+        return
+
+    cur = db.cursor()
+    cur.execute("""select distinct et.__employee_id
+                   from air.{}_sm_transactions et
+                   where {}
+                   order by 1""".format(table_prefix, sm_transaction_filter(sm_source_ids, None, require_occupation)))
+    employee_ids = [row[0] for row in cur.fetchall()]
+
+    for i in range(0, len(employee_ids), SM_EMPLOYEE_CHUNK):
+        with closing(query(db, sm_source_ids, employee_ids[i:i + SM_EMPLOYEE_CHUNK], table_prefix,
+                           require_occupation)) as cur:
+            chunk = list(batches(cur, batch_size))
+        for batch in chunk:
+            yield batch
+
+
+def sm_get_employees(db, sm_source_ids, employee_ids=None, table_prefix="smpq"):
+    """Stream employees from the STAR METRICS transactions. Transactions are read in
+    __employee_id order, so each Employee is complete when the id changes and is
+    yielded before the next one is started."""
+
+    employee = None
+
+    with closing(sm_get_transactions(db, sm_source_ids, employee_ids, table_prefix)) as cur:
+        row = cur.fetchone()
+        while row:
+            if employee and employee.employee_id == row["__employee_id"]:
+                employee.addtransaction(row)
+            else:
+                if employee:
+                    yield employee
+                employee = Employee(row)
+
+            row = cur.fetchone()
+
+    if employee:
+        yield employee
+
+
+def sm_summarize(rows):
+    """Aggregate a batch of transaction rows with the Employee class. The rows must be
+    ordered by __employee_id and hold every transaction of the employees they
+    contain."""
+
+    result = []
+    for _, group in groupby(rows, key=lambda r: r["__employee_id"]):
+        employee = None
+        for row in group:
+            if employee:
+                employee.addtransaction(row)
+            else:
+                employee = Employee(row)
+
+        result.append(employee)
+
+    return result
+
+
+def sm_awards_by_year_lookup(db, table_prefix="smpq"):
+    """Read air.{table_prefix}_sm_awards_by_year into a dict from (__award_id, year) to
+    (unique_award_number, team_size, nih, nsf, usda)."""
+
+    cur = db.cursor()
+    cur.execute("""select __award_id, year, unique_award_number, team_size, nih, nsf, usda
+                   from air.{}_sm_awards_by_year""".format(table_prefix))
+
+    return dict(((row[0], row[1]), row[2:]) for row in cur.fetchall())
+
+
+def sm_awards_index(awards):
+    """Return the sm_awards_by_year_lookup dict awards as arrays for
+    sm_single_pass_columnar: the sorted keys, as __award_id * 10000 + year, and the
+    __award_id, year and values of each key in the same order."""
+
+    keys = sorted(awards)
+    values = [awards[k] for k in keys]
+
+    return {"key": np.array([k[0] * 10000 + k[1] for k in keys], dtype=np.int64),
+            "__award_id": np.array([k[0] for k in keys], dtype=np.int64),
+            "year": np.array([k[1] for k in keys], dtype=np.int64),
+            "unique_award_number": np.array([v[0] for v in values], dtype=object),
+            "team_size": np.array([v[1] for v in values], dtype=float),
+            "nih": np.array([v[2] for v in values], dtype=np.int64),
+            "nsf": np.array([v[3] for v in values], dtype=np.int64),
+            "usda": np.array([v[4] for v in values], dtype=np.int64)}
+
+
+def sm_single_pass_rows(rows, awards):
+    """Summarize a batch of dict rows from sm_employee_batches with sm_summarize and
+    return the rows of sm_names (SM_NAMES_COLUMNS and nih, nsf, usda), sm_names_awards
+    and sm_team_size for it. awards is the sm_awards_by_year_lookup dict."""
+
+    names_rows = []
+    awards_rows = []
+    team_size_rows = []
+
+    employees = sm_summarize([r for r in rows if r["occupational_classification"] is not None])
+    employees = dict((e.employee_id, e) for e in employees)
+
+    for employee_id, group in groupby(rows, key=lambda r: r["__employee_id"]):
+        employee = employees.get(employee_id)
+        if not employee:
+            continue
+
+        links = set(k for k in ((r["__award_id"], r["year"]) for r in group) if k in awards)
+        by_year = defaultdict(list)
+        for award_id, year in sorted(links):
+            unique_award_number, team_size, nih, nsf, usda = awards[(award_id, year)]
+            awards_rows.append((employee_id, employee.university, award_id, unique_award_number, year))
+            by_year[year].append((team_size, nih, nsf))
+
+        for year, values in sorted(by_year.items()):
+            team_size_rows.append((employee_id, year,
+                                   float(sum(v[0] for v in values)) / len(values),
+                                   max(v[1] for v in values),
+                                   max(v[2] for v in values)))
+
+        flags = [awards[k][2:] for k in links]
+        d = employee.todict()
+        names_rows.append([d[k] for k in SM_NAMES_COLUMNS] + [max([f[0] for f in flags] or [0]),
+                                                              max([f[1] for f in flags] or [0]),
+                                                              max([f[2] for f in flags] or [0])])
+
+    return names_rows, awards_rows, team_size_rows
+
+
+def sm_single_pass_columnar(batch, awards):
+    """Like sm_single_pass_rows, for a (columns, strings) batch from sm_employee_batches
+    with columnar, summarized with sm_summarize_columnar. The award links and team
+    sizes are computed with array operations as well. awards is the sm_awards_index of
+    the award lookup."""
+
+    columns, strings = batch
+    ids = columns["__employee_id"]
+
+    no_occupation = strings.index(None) if None in strings else -1
+    summary = sm_summarize_columnar(select_columns(columns, columns["occup"] != no_occupation), strings)
+    employees = np.array(summary["__employee_id"], dtype=np.int64)
+    universities = np.array(summary["university"], dtype=object)
+
+    # The distinct links of the summarized employees to the awards and years in the
+    # lookup, as employee index * number of awards + award index, so that np.unique
+    # sorts them by employee, award and year.
+    n_awards = len(awards["key"])
+    if len(employees) and n_awards:
+        keys = columns["__award_id"] * 10000 + columns["year"]
+        award = np.minimum(np.searchsorted(awards["key"], keys), n_awards - 1)
+        employee = np.minimum(np.searchsorted(employees, ids), len(employees) - 1)
+        found = (awards["key"][award] == keys) & (employees[employee] == ids)
+        links = np.unique(employee[found] * n_awards + award[found])
+    else:
+        links = np.zeros(0, dtype=np.int64)
+
+    link_employee, link_award = np.divmod(links, max(n_awards, 1))
+
+    awards_rows = zip(employees[link_employee].tolist(), universities[link_employee].tolist(),
+                      awards["__award_id"][link_award].tolist(),
+                      awards["unique_award_number"][link_award].tolist(),
+                      awards["year"][link_award].tolist())
+
+    # The flags are 0 or 1, so their maximum is whether their sum is positive.
+    def any_by(index, column, n=0):
+        return (np.bincount(index, weights=awards[column][link_award], minlength=n) > 0).astype(int).tolist()
+
+    years, year_index = np.unique(link_employee * 10000 + awards["year"][link_award], return_inverse=True)
+    team_size = np.bincount(year_index, weights=awards["team_size"][link_award]) / np.bincount(year_index)
+    team_size_rows = zip(employees[years // 10000].tolist(), (years % 10000).tolist(), team_size.tolist(),
+                         any_by(year_index, "nih"), any_by(year_index, "nsf"))
+
+    names_rows = zip(*([summary[k] for k in SM_NAMES_COLUMNS] +
+                       [any_by(link_employee, k, len(employees)) for k in ["nih", "nsf", "usda"]]))
+
+    return names_rows, awards_rows, team_size_rows
+
+
+def sm_names_single_pass(db, sm_source_ids, table_prefix="smpq", read_db=None, engine="python", batch_size=1000):
+    """Fill air.{table_prefix}_sm_names, _sm_names_awards and _sm_team_size in a single
+    pass over the staged transactions, instead of sm_names_awards_init and
+    sm_team_size_init. The award tables must already exist:
+    the team sizes and agency flags are looked up in _sm_awards_by_year, which is
+    small enough to hold in memory.
+
+    Each batch of employees is summarized with sm_single_pass_rows or, with the
+    "columnar" engine, sm_single_pass_columnar, which reads the transactions into
+    arrays. The award links of an employee are the distinct (__award_id, year) pairs
+    of all its transactions, including those without an occupation, as in
+    sm_names_awards_init. See sm_names_load for read_db."""
+
+    awards = sm_awards_by_year_lookup(db, table_prefix)
+
+    if engine == "columnar":
+        if np is None:
+            raise ImportError("the columnar STAR METRICS engine requires numpy")
+        single_pass, awards = sm_single_pass_columnar, sm_awards_index(awards)
+    else:
+        single_pass = sm_single_pass_rows
+
+    names_columns = SM_NAMES_COLUMNS + ["nih", "nsf", "usda"]
+    names_sql = "insert into air.{}_sm_names ({}) values ({})".format(
+                table_prefix, ", ".join(names_columns), ", ".join("%s" for _ in names_columns))
+    awards_sql = """insert into air.{}_sm_names_awards
+                    (__employee_id, university, __award_id, unique_award_number, year)
+                    values (%s, %s, %s, %s, %s)""".format(table_prefix)
+    team_size_sql = """insert into air.{}_sm_team_size
+                       (__employee_id, year, avg_team_size, nih, nsf)
+                       values (%s, %s, %s, %s, %s)""".format(table_prefix)
+
+    batches = sm_employee_batches(db, sm_source_ids, table_prefix, read_db, False, max(batch_size, 10000),
+                                  engine == "columnar")
+    with BatchWriter(db, names_sql, batch_size) as names_writer, \
+            BatchWriter(db, awards_sql, batch_size) as awards_writer, \
+            BatchWriter(db, team_size_sql, batch_size) as team_size_writer:
+        for batch in batches:
+            names_rows, awards_rows, team_size_rows = single_pass(batch, awards)
+            for row in awards_rows:
+                awards_writer.add(row)
+            for row in team_size_rows:
+                team_size_writer.add(row)
+            for row in names_rows:
+                names_writer.add(row)
+
+
+SM_NAMES_COLUMNS = ["__employee_id", "university", "last_name", "first_name", "max_grad_year",
+                    "min_period_start_date", "max_period_end_date", "days_worked",
+                    "work_6_months_over_2_years", "work_12_months_over_2_years",
+                    "first_appear_bucketed_occup", "first_appear_orig_occup",
+                    "first_appear_date", "days_worked_under_first_occup",
+                    "first_appear_as_grad_date", "first_appear_as_grad_orig_occup",
+                    "last_appear_as_grad_date", "last_appear_as_grad_orig_occup",
+                    "days_worked_as_grad", "last_appear_bucketed_occup",
+                    "last_appear_orig_occup", "days_worked_under_last_occup",
+                    "work_6_months_on_nih", "work_6_months_on_nsf", "work_6_months_on_usda"]
+
+
+def sm_occup_days_table(sm_source_ids, table_prefix="smpq"):
+    """Name of the table created by sm_occup_days_init. It includes the source ids so
+    that workers extracting different sources do not share it."""
+
+    return "air.{}_sm_occup_days_{}".format(table_prefix, "_".join(str(k) for k in sorted(sm_source_ids)))
+
+
+def sm_occup_days_init(db, sm_source_ids, employee_ids=None, table_prefix="smpq"):
+    """Create the sm_occup_days_table with the days worked by employee and occupation,
+    for use by sm_summary_sql. This is a regular table rather than a temporary one
+    because sm_summary_sql joins it twice."""
+
+    table = sm_occup_days_table(sm_source_ids, table_prefix)
+
+    cur = db.cursor()
+    cur.execute("drop table if exists {}".format(table))
+    cur.execute("""create table {}
+                   (primary key (__employee_id, occupational_classification))
+                   select et.__employee_id, et.occupational_classification,
+                          sum(datediff(et.period_end_date, et.period_start_date)) days
+                   from air.{}_sm_transactions et
+                   where {}
+                   group by 1, 2""".format(table, table_prefix, sm_transaction_filter(sm_source_ids, employee_ids)))
+
+    db.commit()
+
+
+def sm_summary_sql(sm_source_ids, employee_ids=None, table_prefix="smpq"):
+    """Return a select statement that computes the air.{table_prefix}_sm_names columns
+    (in SM_NAMES_COLUMNS order) inside MySQL. Needs the table built by
+    sm_occup_days_init and a large group_concat_max_len.
+
+    The first and last occupations are picked with group_concat ordered the same way
+    as sm_get_transactions, so ties are broken as in Employee. Employee counts the
+    first transaction of each employee inclusively and the others exclusively, which
+    is the "+ 1" on the first-row terms below."""
+
+    sep = "\x1f"
+    grad = "et.occupational_classification like 'graduate%'"
+    first_order = SM_TRANSACTION_ORDER
+    last_order = "et.period_end_date desc, " + SM_TRANSACTION_ORDER
+
+    def first(expr, order):
+        return "substring_index(group_concat({} order by {} separator '{}'), '{}', 1)".format(expr, order, sep, sep)
+
+    return """select q.__employee_id, q.university, q.last_name, q.first_name,
+                     if(q.first_grad_orig_occup <> '', year(q.max_grad_date), null) max_grad_year,
+                     q.min_period_start_date, q.max_period_end_date, q.days_worked,
+                     q.days_spanned > 2 * 365 and q.days_worked > 180 work_6_months_over_2_years,
+                     q.days_spanned > 2 * 365 and q.days_worked > 360 work_12_months_over_2_years,
+                     q.first_appear_bucketed_occup,
+                     nullif(q.first_appear_orig_occup, '') first_appear_orig_occup,
+                     q.min_period_start_date first_appear_date,
+                     first_occup.days + 1 days_worked_under_first_occup,
+                     if(q.first_grad_orig_occup <> '', q.min_grad_date, null) first_appear_as_grad_date,
+                     nullif(q.first_grad_orig_occup, '') first_appear_as_grad_orig_occup,
+                     if(q.first_grad_orig_occup <> '', q.max_grad_date, null) last_appear_as_grad_date,
+                     nullif(q.last_grad_orig_occup, '') last_appear_as_grad_orig_occup,
+                     q.grad_days + (q.first_appear_bucketed_occup like 'graduate%') days_worked_as_grad,
+                     q.last_appear_bucketed_occup,
+                     nullif(q.last_appear_orig_occup, '') last_appear_orig_occup,
+                     last_occup.days + (q.last_appear_bucketed_occup = q.first_appear_bucketed_occup) days_worked_under_last_occup,
+                     q.nih_days + (q.first_is_nih = 1) > 180 work_6_months_on_nih,
+                     q.nsf_days + (q.first_agency_code = 47) > 180 work_6_months_on_nsf,
+                     q.usda_days + (q.first_agency_code = 10) > 180 work_6_months_on_usda
+              from (select et.__employee_id,
+                           {first_university} university,
+                           min(et.last_name) last_name, min(et.first_name) first_name,
+                           min(et.period_start_date) min_period_start_date,
+                           max(et.period_end_date) max_period_end_date,
+                           datediff(max(et.period_end_date), min(et.period_start_date)) days_spanned,
+                           sum(datediff(et.period_end_date, et.period_start_date)) + 1 days_worked,
+                           {first_occup} first_appear_bucketed_occup,
+                           {first_orig_occup} first_appear_orig_occup,
+                           {last_occup} last_appear_bucketed_occup,
+                           {last_orig_occup} last_appear_orig_occup,
+                           min(if({grad}, et.period_start_date, null)) min_grad_date,
+                           max(if({grad}, et.period_end_date, null)) max_grad_date,
+                           {first_grad_orig_occup} first_grad_orig_occup,
+                           {last_grad_orig_occup} last_grad_orig_occup,
+                           sum(if({grad}, datediff(et.period_end_date, et.period_start_date), 0)) grad_days,
+                           sum(if(et.is_nih = 1, datediff(et.period_end_date, et.period_start_date), 0)) nih_days,
+                           sum(if(et.agency_code = 47, datediff(et.period_end_date, et.period_start_date), 0)) nsf_days,
+                           sum(if(et.agency_code = 10, datediff(et.period_end_date, et.period_start_date), 0)) usda_days,
+                           {first_is_nih} first_is_nih,
+                           {first_agency_code} first_agency_code
+                    from air.{table_prefix}_sm_transactions et
+                    where {where}
+                    group by et.__employee_id) q
+              join {occup_days} first_occup
+              on first_occup.__employee_id = q.__employee_id
+              and first_occup.occupational_classification = q.first_appear_bucketed_occup
+              join {occup_days} last_occup
+              on last_occup.__employee_id = q.__employee_id
+              and last_occup.occupational_classification = q.last_appear_bucketed_occup""".format(
+            first_university=first("et.university", first_order),
+            first_occup=first("et.occupational_classification", first_order),
+            first_orig_occup=first("ifnull(et.x_occupational_classification, '')", first_order),
+            last_occup=first("et.occupational_classification", last_order),
+            last_orig_occup=first("ifnull(et.x_occupational_classification, '')", last_order),
+            first_grad_orig_occup=first("if({}, ifnull(et.x_occupational_classification, ''), null)".format(grad), first_order),
+            last_grad_orig_occup=first("if({}, ifnull(et.x_occupational_classification, ''), null)".format(grad), last_order),
+            first_is_nih=first("et.is_nih", first_order),
+            first_agency_code=first("et.agency_code", first_order),
+            grad=grad,
+            where=sm_transaction_filter(sm_source_ids, employee_ids),
+            table_prefix=table_prefix,
+            occup_days=sm_occup_days_table(sm_source_ids, table_prefix))
+
+
+def sm_insert_employees_sql(db, sm_source_ids, table_prefix="smpq"):
+    """Compute air.{table_prefix}_sm_names inside MySQL with sm_summary_sql, instead of
+    aggregating the transactions in Python."""
+
+    sm_occup_days_init(db, sm_source_ids, table_prefix=table_prefix)
+
+    cur = db.cursor()
+    cur.execute("set session group_concat_max_len = 16777216")
+    cur.execute("insert into air.{}_sm_names ({}) ".format(table_prefix, ", ".join(SM_NAMES_COLUMNS)) +
+                sm_summary_sql(sm_source_ids, table_prefix=table_prefix))
+    cur.execute("drop table {}".format(sm_occup_days_table(sm_source_ids, table_prefix)))
+
+    db.commit()
+
+
+def sm_compare_summaries(name_a, rows_a, name_b, rows_b, max_examples=5):
+    """Print the differences between two engines' employee summaries, given as dicts
+    from __employee_id to todict() rows, column by column. Returns the number of
+    differing values."""
+
+    errors = 0
+    for k in sorted(set(rows_a) ^ set(rows_b)):
+        print("  __employee_id {} only produced by the {} engine".format(k, name_a if k in rows_a else name_b))
+        errors += 1
+
+    common = sorted(set(rows_a) & set(rows_b))
+    for column in SM_NAMES_COLUMNS:
+        diffs = [(k, rows_a[k][column], rows_b[k][column])
+                 for k in common if rows_a[k][column] != rows_b[k][column]]
+        errors += len(diffs)
+
+        print("  {:<35} {:>8} differences".format(column, len(diffs)))
+        for k, a, b in diffs[:max_examples]:
+            print("      __employee_id {}: {}={!r} {}={!r}".format(k, name_a.lower(), a, name_b.lower(), b))
+
+    return errors
+
+
+def sm_verify_engines(db, sm_source_ids, sample_size=1000, table_prefix="smpq", max_examples=5):
+    """Compute the employee summary for a random sample of employees with the
+    Employee class, sm_summarize_columnar (if NumPy is installed) and sm_summary_sql,
+    print how long each took, including reading the transactions, and the
+    differences from the Python engine column by column. Returns the number of
+    differing values. Uses the staging table from sm_init if there is one."""
+
+    if not table_exists(db, "{}_sm_transactions".format(table_prefix)):
+        sm_transactions_init(db, sm_source_ids, table_prefix)
+
+    cur = db.cursor()
+    cur.execute("""select distinct et.__employee_id
+                   from air.{}_sm_transactions et
+                   where {}
+                   order by rand()
+                   limit %s""".format(table_prefix, sm_transaction_filter(sm_source_ids)), [sample_size])
+    employee_ids = [row[0] for row in cur.fetchall()]
+
+    if not employee_ids:
+        print("No employees to compare")
+        return 0
+
+    start = datetime.datetime.now()
+    with closing(sm_get_transactions(db, sm_source_ids, employee_ids, table_prefix)) as cur:
+        rows = cur.fetchall()
+    python_rows = dict((e.employee_id, e.todict()) for e in sm_summarize(rows))
+    python_seconds = (datetime.datetime.now() - start).total_seconds()
+
+    start = datetime.datetime.now()
+    sm_occup_days_init(db, sm_source_ids, employee_ids, table_prefix)
+    cur = db.cursor(MySQLdb.cursors.DictCursor)
+    cur.execute("set session group_concat_max_len = 16777216")
+    cur.execute(sm_summary_sql(sm_source_ids, employee_ids, table_prefix))
+    sql_rows = dict((row["__employee_id"], row) for row in cur.fetchall())
+    cur.execute("drop table {}".format(sm_occup_days_table(sm_source_ids, table_prefix)))
+    db.commit()
+    sql_seconds = (datetime.datetime.now() - start).total_seconds()
+
+    print("Compared {} employees ({} transactions)".format(len(employee_ids), len(rows)))
+    print("  Python engine:   {:>8} employees in {:.3f}s".format(len(python_rows), python_seconds))
+    print("  SQL engine:      {:>8} employees in {:.3f}s".format(len(sql_rows), sql_seconds))
+
+    errors = sm_compare_summaries("Python", python_rows, "SQL", sql_rows, max_examples)
+
+    if np is None:
+        print("  Columnar engine skipped: NumPy is not installed")
+        return errors
+
+    start = datetime.datetime.now()
+    with closing(sm_get_transaction_tuples(db, sm_source_ids, employee_ids, table_prefix)) as cur:
+        summaries = [sm_summarize_columnar(*batch) for batch in sm_transaction_column_batches(cur)]
+    columnar_seconds = (datetime.datetime.now() - start).total_seconds()
+
+    columnar_rows = {}
+    for summary in summaries:
+        for row in zip(*[summary[k] for k in SM_NAMES_COLUMNS]):
+            columnar_rows[row[0]] = dict(zip(SM_NAMES_COLUMNS, row))
+
+    print("  Columnar engine: {:>8} employees in {:.3f}s".format(len(columnar_rows), columnar_seconds))
+
+    errors += sm_compare_summaries("Python", python_rows, "Columnar", columnar_rows, max_examples)
+
+    return errors
+
+
+def sm_name_fix(db, table_prefix="smpq", batch_size=1000):
+    """Extract the first alphabetic word from the last name."""
+
+    cur = db.cursor()
+    cur.execute("select __employee_id, last_name from air.{}_sm_names".format(table_prefix))
+
+    # Written in batches to a keyed temporary table and applied with one update join,
+    # as in pq_name_fix.
+    cur2 = db.cursor()
+    cur2.execute("drop temporary table if exists air.{}_sm_name_fix".format(table_prefix))
+    cur2.execute("""create temporary table air.{}_sm_name_fix (
+                    __employee_id int unsigned primary key,
+                    last_name varchar(50) not null)""".format(table_prefix))
+
+    expr = re.compile("^[^.,]+")
+
+    with BatchWriter(db, """insert into air.{}_sm_name_fix
+                            (__employee_id, last_name) values (%s, %s)""".format(table_prefix),
+                     batch_size) as w:
+        for row in cur:
+            employee_id, last_name = row
+            m = expr.search(last_name or "")
+            if m:
+                w.add((employee_id, m.group().upper()))
+
+    cur2.execute("""update air.{table_prefix}_sm_names names
+                    join air.{table_prefix}_sm_name_fix fix using (__employee_id)
+                    set names.last_name = fix.last_name""".format(table_prefix=table_prefix))
+    cur2.execute("drop temporary table air.{}_sm_name_fix".format(table_prefix))
+
+    db.commit()
+
+
+
+def sm_names_set_flags(db, table_prefix="smpq", male_cutoff=0.2, female_cutoff=0.8, delta_prefix=None):
+    """Set the gender columns of the sm_names table. With delta_prefix, only the employees
+    in air.{delta_prefix}_employees are updated (see sm_refresh)."""
+
+    if delta_prefix:
+        employees = "join air.{}_employees delta using (__employee_id)".format(delta_prefix)
+    else:
+        employees = ""
+
+    cur = db.cursor()
+    cur.execute("""update air.{table_prefix}_sm_names sm
+                   {employees}
+                   join air.{table_prefix}_gender_probabilities prob on sm.first_name = prob.firstname
+                   set sm.pr_fem = prob.pr_fem""".format(table_prefix=table_prefix, employees=employees))
+
+    db.commit()
+
+    sm_gender_coding(db, male_cutoff, female_cutoff, table_prefix, delta_prefix)
+
+
+def sm_gender_coding(db, male_cutoff, female_cutoff, table_prefix="smpq", delta_prefix=None):
+    """Set the gender column in the sm_names table from the stored probabilities."""
+
+    if delta_prefix:
+        employees = "join air.{}_employees delta using (__employee_id)".format(delta_prefix)
+    else:
+        employees = ""
+
+    cur = db.cursor()
+    cur.execute("""update air.{}_sm_names sm
+                   {}
+                   set sm.gender = {}""".format(table_prefix, employees,
+                                                gender_sql("sm.pr_fem", male_cutoff, female_cutoff)))
+
+    db.commit()
+
+
+def sm_awards_init(db, table_prefix="smpq"):
+    """Create the award summary tables from the transactions staged by
+    sm_transactions_init."""
+
+    cur= db.cursor()
+    cur.execute("drop table if exists air.{}_sm_awards".format(table_prefix))
+    cur.execute("drop table if exists air.{}_sm_awards_by_year".format(table_prefix))
+
+    cur.execute("""create table air.{}_sm_awards (
+                   __award_id int unsigned not null,
+                   unique_award_number varchar(60) not null,
+                   award_id varchar(50) null,
+                   umetricsgrants varchar(45) null,
+                   xwalk_id int unsigned null,
+                   cfda varchar(10) not null,
+                   agency_code int not null,
+                   nih tinyint not null default 0,
+                   nsf tinyint not null default 0,
+                   usda tinyint not null default 0,
+                   university varchar(45) not null,
+                   first_transaction_year int unsigned not null,
+                   first_period_start_date date not null,
+                   last_period_end_date date not null,
+                   team_size int not null,
+                   primary key (__award_id))""".format(table_prefix))
+
+    cur.execute("""create table air.{}_sm_awards_by_year (
+                   __award_id int unsigned not null,
+                   unique_award_number varchar(60) not null,
+                   year int not null,
+                   cfda varchar(10) not null,
+                   agency_code int not null,
+                   nih tinyint not null default 0,
+                   nsf tinyint not null default 0,
+                   usda tinyint not null default 0,
+                   team_size int null,
+                   primary key (__award_id, year))""".format(table_prefix))
+
+    db.commit()
+
+    sm_awards_insert(db, table_prefix)
+
+    add_indexes(db, "air.{}_sm_awards".format(table_prefix),
+                ["index unique_award_number (unique_award_number)",
+                 "index umetricsgrants (umetricsgrants)",
+                 "index award_id (award_id)"])
+
+    sm_awards_set_agencies(db, table_prefix)
+
+
+def sm_awards_insert(db, table_prefix="smpq", delta_prefix=None):
+    """Fill the award summary tables from air.{table_prefix}_sm_transactions. With
+    delta_prefix, only the awards listed in air.{delta_prefix}_awards are summarized
+    again and upserted (see sm_refresh); their crosswalk columns are kept."""
+
+    if delta_prefix:
+        join = "join air.{}_awards delta using (__award_id)".format(delta_prefix)
+        awards_upsert = """on duplicate key update university = values(university),
+                           first_transaction_year = values(first_transaction_year),
+                           first_period_start_date = values(first_period_start_date),
+                           last_period_end_date = values(last_period_end_date),
+                           team_size = values(team_size)"""
+        awards_by_year_insert = "insert into"
+        awards_by_year_upsert = "on duplicate key update team_size = values(team_size)"
+    else:
+        join = awards_upsert = awards_by_year_upsert = ""
+        awards_by_year_insert = "insert ignore into"
+
+    cur = db.cursor()
+    cur.execute("""insert into air.{table_prefix}_sm_awards
+                   (__award_id, unique_award_number, cfda, agency_code, nih, university, first_transaction_year, 
+                   first_period_start_date, last_period_end_date, team_size)
+                   select et.__award_id, et.unique_award_number, et.cfda, et.agency_code, et.is_nih,
+                   group_concat(distinct et.university order by et.university separator '|'),
+                   min(et.year), min(et.period_start_date), max(et.period_end_date),
+                   count(distinct et.__employee_id)
+                   from air.{table_prefix}_sm_transactions et
+                   {join}
+                   group by 1, 2, 3, 4, 5
+                   {upsert}""".format(table_prefix=table_prefix, join=join, upsert=awards_upsert))
+
+    cur.execute("""{insert} air.{table_prefix}_sm_awards_by_year
+                   (__award_id, unique_award_number, cfda, agency_code, nih, year, team_size)
+                   select et.__award_id, et.unique_award_number, et.cfda, et.agency_code, et.is_nih,
+                          et.year, count(distinct et.__employee_id)
+                   from air.{table_prefix}_sm_transactions et
+                   {join}
+                   group by 1, 2, 3, 4, 5, 6
+                   {upsert}""".format(insert=awards_by_year_insert, table_prefix=table_prefix, join=join,
+                                      upsert=awards_by_year_upsert))
+
+    db.commit()
+
+
+def sm_awards_set_agencies(db, table_prefix="smpq"):
+    """Set the nsf and usda flags of the award summary tables from the agency code."""
+
+    cur = db.cursor()
+    cur.execute("""update air.{}_sm_awards
+                   set nsf = 1
+                   where agency_code = 47""".format(table_prefix))
+
+    cur.execute("""update air.{}_sm_awards_by_year
+                   set nsf = 1
+                   where agency_code = 47""".format(table_prefix))
+
+    cur.execute("""update air.{}_sm_awards
+                   set usda = 1
+                   where agency_code = 10""".format(table_prefix))
+
+    cur.execute("""update air.{}_sm_awards_by_year
+                   set usda = 1
+                   where agency_code = 10""".format(table_prefix))
+
+    db.commit()
+
+
+def sm_names_awards_create(db, table_prefix="smpq"):
+    """Create the empty air.{table_prefix}_sm_names_awards table."""
+
+    cur = db.cursor()
+    cur.execute("drop table if exists air.{}_sm_names_awards".format(table_prefix))
+
+    cur.execute("""create table air.{}_sm_names_awards (
+                   __employee_id int not null,
+                   university varchar(45) not null,
+                   __award_id int not null,
+                   unique_award_number varchar(60) not null,
+                   year int not null,
+                   primary key (__employee_id, __award_id, year))""".format(table_prefix))
+
+    db.commit()
+
+
+def sm_names_awards_init(db, table_prefix="smpq", delta_prefix=None):
+    """For all names in the air.{table_prefix}_sm_names table, create links to 
+       all star metrics awards for which they have transactions. The table is created
+       by sm_names_awards_create. Only needed with the "sql" engine, the other engines
+       write the links in sm_names_single_pass. With delta_prefix, the links of the
+       new transactions in air.{delta_prefix}_sm_transactions are added and the flags
+       of the employees in air.{delta_prefix}_employees are updated (see sm_refresh)."""
+
+    if delta_prefix:
+        insert = "insert ignore into"
+        transactions = "air.{}_sm_transactions".format(delta_prefix)
+        employees = "join air.{}_employees delta using (__employee_id)".format(delta_prefix)
+    else:
+        insert = "insert into"
+        transactions = "air.{}_sm_transactions".format(table_prefix)
+        employees = ""
+
+    cur = db.cursor()
+    cur.execute("""{insert} air.{table_prefix}_sm_names_awards
+                   select distinct et.__employee_id, names.university, 
+                          aby.__award_id, aby.unique_award_number, aby.year
+                   from air.{table_prefix}_sm_names names
+                   join {transactions} et using (__employee_id)
+                   join air.{table_prefix}_sm_awards_by_year aby
+                   on aby.__award_id = et.__award_id and aby.year = et.year""".format(insert=insert,
+                                                                                     table_prefix=table_prefix,
+                                                                                     transactions=transactions))
+
+    db.commit()
+
+    cur.execute("""update air.{table_prefix}_sm_names names
+                   {employees}
+                   join (select __employee_id, max(nih) nih, max(nsf) nsf, max(usda) usda
+                         from air.{table_prefix}_sm_names_awards awards
+                         join air.{table_prefix}_sm_awards using (__award_id)
+                         group by 1) q using (__employee_id)
+                   set names.nih = q.nih, names.nsf = q.nsf, names.usda = q.usda""".format(table_prefix=table_prefix,
+                                                                                           employees=employees))
+
+    db.commit()
+
+
+def sm_team_size_create(db, table_prefix="smpq"):
+    """Create the empty air.{table_prefix}_sm_team_size table."""
+
+    cur = db.cursor()
+
+    cur.execute("drop table if exists air.{}_sm_team_size".format(table_prefix))
+
+    cur.execute("""create table air.{}_sm_team_size (
+                   __employee_id int not null,
+                   year int not null,
+                   avg_team_size float not null,
+                   nih tinyint not null,
+                   nsf tinyint not null,
+                   primary key (__employee_id, year))""".format(table_prefix))
+
+    db.commit()
+
+
+def sm_team_size_init(db, table_prefix="smpq", delta_prefix=None):
+    """By employee (__employee_id) and year, compute the average team size worked on.
+    The table is created by sm_team_size_create. Only needed with the "sql" engine,
+    the other engines compute team sizes in sm_names_single_pass. With delta_prefix,
+    only the employees linked to an award and year of the new transactions in
+    air.{delta_prefix}_sm_transactions are computed again (see sm_refresh)."""
+
+    cur = db.cursor()
+
+    if delta_prefix:
+        cur.execute("drop table if exists air.{}_team_employees".format(delta_prefix))
+        cur.execute("""create table air.{delta_prefix}_team_employees
+                       (primary key (__employee_id))
+                       select distinct na.__employee_id
+                       from air.{table_prefix}_sm_names_awards na
+                       join (select distinct __award_id, year
+                             from air.{delta_prefix}_sm_transactions) delta using (__award_id, year)""".format(
+                    table_prefix=table_prefix, delta_prefix=delta_prefix))
+
+        cur.execute("""delete ts from air.{table_prefix}_sm_team_size ts
+                       join air.{delta_prefix}_team_employees delta using (__employee_id)""".format(
+                    table_prefix=table_prefix, delta_prefix=delta_prefix))
+
+        employees = "join air.{}_team_employees delta using (__employee_id)".format(delta_prefix)
+    else:
+        employees = ""
+
+    cur.execute("""insert into air.{table_prefix}_sm_team_size
+                   select names.__employee_id, aby.year, avg(aby.team_size),
+                          max(aby.nih), max(aby.nsf)
+                   from air.{table_prefix}_sm_names names
+                   {employees}
+                   join air.{table_prefix}_sm_names_awards na using (__employee_id)
+                   join air.{table_prefix}_sm_awards_by_year aby using (__award_id, year)
+                   group by 1, 2""".format(table_prefix=table_prefix, employees=employees))
+
+    db.commit()
+
+
+# Crosswalk methods in order of precedence: (xwalk_id, umetricsgrants table, award id
+# column, start date column). xwalk_id 1 is the 1-to-1 crosswalk match.
+SM_XWALK_AGENCIES = [(2, "nih_project", "FULL_PROJECT_NUM", "BUDGET_START"),
+                     (3, "nsf_award", "AwardId", "AwardEffectiveDate"),
+                     (4, "usda_grant", "grant_num", "start_date"),
+                     (5, "rg_award", "FederalAwardIDNumber", "AwardStartDate")]
+
+
+def sm_xwalk_table(name, table_prefix="smpq"):
+    """Name of the scratch table holding the crosswalk candidates of one method, in
+    the namespace of the table prefix."""
+
+    return "air.{}_xwalk_{}".format(table_prefix, name)
+
+
+def sm_awards_xwalk_1x1(db, table_prefix="smpq"):
+    """Find the awards whose unique award number and award id both appear exactly
+    once in the crosswalk, and store them in the sm_xwalk_table "1x1"."""
+
+    cur = db.cursor()
+    table = sm_xwalk_table("1x1", table_prefix)
+
+    cur.execute("drop temporary table if exists air.{}_award_id_count".format(table_prefix))
+    cur.execute("drop temporary table if exists air.{}_uniqueawardnumber_count".format(table_prefix))
+
+    cur.execute("""create temporary table air.{}_award_id_count
+                   (primary key (award_id))
+                   select award_id, count(*) count
+                   from starmetrics.crosswalk
+                   group by 1
+                   having count(*) = 1""".format(table_prefix))
+
+    cur.execute("""create temporary table air.{}_uniqueawardnumber_count
+                   (primary key (uniqueawardnumber))
+                   select uniqueawardnumber, count(*) count
+                   from starmetrics.crosswalk
+                   group by 1
+                   having count(*) = 1""".format(table_prefix))
+
+    cur.execute("drop table if exists {}".format(table))
+    cur.execute("""create table {table}
+                   (primary key (__award_id))
+                   ignore select awards.__award_id, x.award_id, x.umetricsgrants
+                   from air.{table_prefix}_sm_awards awards
+                   join starmetrics.crosswalk x on x.uniqueawardnumber = awards.unique_award_number
+                   join air.{table_prefix}_award_id_count a on a.award_id = x.award_id
+                   join air.{table_prefix}_uniqueawardnumber_count b on b.uniqueawardnumber = x.uniqueawardnumber""".format(
+                table=table, table_prefix=table_prefix))
+
+    cur.execute("drop temporary table air.{}_award_id_count".format(table_prefix))
+    cur.execute("drop temporary table air.{}_uniqueawardnumber_count".format(table_prefix))
+
+    db.commit()
+
+
+def sm_awards_xwalk_agency(db, agency_table, agency_award_id, year_field, table_prefix="smpq"):
+    """Find the awards that match exactly one crosswalk entry of agency_table with the
+    same start year, and store them in the sm_xwalk_table named after agency_table."""
+
+    cur = db.cursor()
+    table = sm_xwalk_table(agency_table, table_prefix)
+
+    cur.execute("drop temporary table if exists air.{}_{}_award_id_count".format(table_prefix, agency_table))
+
+    sql = """create temporary table air.{table_prefix}_{agency_table}_award_id_count
+             (primary key (award_id, start_year))
+             select x.award_id, year(a.{year_field}) start_year, count(distinct x.uniqueawardnumber) count
+             from starmetrics.crosswalk x
+             join umetricsgrants.{agency_table} a on a.{agency_award_id} = x.award_id
+             where x.umetricsgrants = '{agency_table}'
+             and a.{year_field} is not null
+             group by 1, 2
+             having count(distinct x.uniqueawardnumber) = 1"""
+
+    cur.execute(sql.format(table_prefix=table_prefix,
+                           agency_table=agency_table, 
+                           year_field=year_field, 
+                           agency_award_id=agency_award_id))
+    
+    cur.execute("drop table if exists {}".format(table))
+
+    sql = """create table {table}
+             (primary key (__award_id))
+             ignore select awards.__award_id, x.award_id, x.umetricsgrants
+             from air.{table_prefix}_sm_awards awards
+             join starmetrics.crosswalk x on x.uniqueawardnumber = awards.unique_award_number
+             join air.{table_prefix}_{agency_table}_award_id_count a
+             on a.award_id = x.award_id and a.start_year = awards.first_transaction_year
+             where x.umetricsgrants = '{agency_table}'"""
+
+    cur.execute(sql.format(table=table, table_prefix=table_prefix, agency_table=agency_table))
+
+    cur.execute("drop temporary table air.{}_{}_award_id_count".format(table_prefix, agency_table))
+    db.commit()
+
+
+def sm_awards_xwalk_merge(db, table_prefix="smpq"):
+    """Apply the crosswalk candidates to air.{table_prefix}_sm_awards in order of
+    precedence, so that an award matched by several methods gets the lowest xwalk_id,
+    and drop the scratch tables."""
+
+    cur = db.cursor()
+
+    methods = [(1, "1x1")] + [(xwalk_id, agency_table) for xwalk_id, agency_table, _, _ in SM_XWALK_AGENCIES]
+    for xwalk_id, name in methods:
+        cur.execute("""update air.{table_prefix}_sm_awards awards
+                       join {table} x using (__award_id)
+                       set awards.award_id = x.award_id,
+                           awards.umetricsgrants = x.umetricsgrants,
+                           awards.xwalk_id = {xwalk_id}
+                       where awards.award_id is null""".format(table_prefix=table_prefix,
+                                                               table=sm_xwalk_table(name, table_prefix),
+                                                               xwalk_id=xwalk_id))
+        db.commit()
+
+    for _, name in methods:
+        cur.execute("drop table {}".format(sm_xwalk_table(name, table_prefix)))
+
+    db.commit()
+
+
+def xwalk_key(value):
+    """Normalize an award id, unique award number or table name the way the
+    case-insensitive MySQL collations compare them, so that Python lookups match the
+    SQL joins. Byte strings are decoded as latin-1, so that non-ASCII letters are
+    uppercased too."""
+
+    if value is None:
+        return None
+
+    if isinstance(value, bytes):
+        value = value.decode("latin-1")
+    elif not isinstance(value, type(u"")):
+        value = u"{}".format(value)
+
+    return value.upper().rstrip(u" ")
+
+
+def sm_awards_xwalk_index(db):
+    """Load starmetrics.crosswalk and the start years of the agency awards into hash
+    indexes. Returns (one_to_one, by_agency): one_to_one maps a unique award number to
+    (award_id, umetricsgrants) for the 1-to-1 crosswalk entries, and by_agency[agency_table]
+    maps (unique award number, start year) to (award_id, umetricsgrants) for the award
+    id and start year pairs with a single unique award number, as in sm_awards_xwalk_agency."""
+
+    cur = db.cursor()
+
+    cur.execute("select uniqueawardnumber, award_id, umetricsgrants from starmetrics.crosswalk")
+    crosswalk = [(xwalk_key(uan), xwalk_key(award_id), award_id, umetricsgrants) for uan, award_id, umetricsgrants in cur]
+
+    award_id_count = defaultdict(int)
+    uan_count = defaultdict(int)
+    for uan, award_key, _, _ in crosswalk:
+        award_id_count[award_key] += 1
+        uan_count[uan] += 1
+
+    one_to_one = {}
+    for uan, award_key, award_id, umetricsgrants in crosswalk:
+        if award_id_count[award_key] == 1 and uan_count[uan] == 1:
+            one_to_one.setdefault(uan, (award_id, umetricsgrants))
+
+    by_agency = {}
+    for _, agency_table, agency_award_id, year_field in SM_XWALK_AGENCIES:
+        cur.execute("""select distinct {agency_award_id}, year({year_field})
+                       from umetricsgrants.{agency_table}
+                       where {year_field} is not null""".format(agency_table=agency_table,
+                                                                agency_award_id=agency_award_id,
+                                                                year_field=year_field))
+        start_years = defaultdict(set)
+        for award_id, year in cur:
+            start_years[xwalk_key(award_id)].add(year)
+
+        agency_key = xwalk_key(agency_table)
+        uans = defaultdict(set)
+        award_ids = {}
+        for uan, award_key, award_id, umetricsgrants in crosswalk:
+            if xwalk_key(umetricsgrants) != agency_key or award_key not in start_years:
+                continue
+            award_ids[award_key] = award_id
+            for year in start_years[award_key]:
+                uans[award_key, year].add(uan)
+
+        index = {}
+        for (award_key, year), u in uans.items():
+            if len(u) == 1:
+                index.setdefault((u.pop(), year), (award_ids[award_key], agency_table))
+
+        by_agency[agency_table] = index
+
+    cur.close()
+    return one_to_one, by_agency
+
+
+def sm_awards_xwalk_memory(db, table_prefix="smpq", batch_size=1000):
+    """Crosswalk the STAR METRICS awards using the hash indexes of sm_awards_xwalk_index
+    instead of temporary tables. Every award is resolved in memory, in the same order
+    of precedence as sm_awards_xwalk_merge, and the results are written back with a
+    single update."""
+
+    one_to_one, by_agency = sm_awards_xwalk_index(db)
+
+    cur = db.cursor()
+    cur.execute("""select __award_id, unique_award_number, first_transaction_year
+                   from air.{}_sm_awards
+                   where award_id is null""".format(table_prefix))
+    awards = cur.fetchall()
+
+    table = sm_xwalk_table("memory", table_prefix)
+    cur.execute("drop table if exists {}".format(table))
+    cur.execute("""create table {}
+                   (__award_id int unsigned not null,
+                   award_id varchar(50) null,
+                   umetricsgrants varchar(45) null,
+                   xwalk_id int unsigned null,
+                   primary key (__award_id))""".format(table))
+
+    sql = "insert into {} (__award_id, award_id, umetricsgrants, xwalk_id) values (%s, %s, %s, %s)".format(table)
+    with BatchWriter(db, sql, batch_size, "crosswalk matches") as writer:
+        for award, uan, year in awards:
+            uan = xwalk_key(uan)
+            if uan in one_to_one:
+                writer.add((award,) + one_to_one[uan] + (1,))
+                continue
+            for xwalk_id, agency_table, _, _ in SM_XWALK_AGENCIES:
+                match = by_agency[agency_table].get((uan, year))
+                if match:
+                    writer.add((award,) + match + (xwalk_id,))
+                    break
+
+    cur.execute("""update air.{}_sm_awards awards
+                   join {} x using (__award_id)
+                   set awards.award_id = x.award_id,
+                       awards.umetricsgrants = x.umetricsgrants,
+                       awards.xwalk_id = x.xwalk_id""".format(table_prefix, table))
+    cur.execute("drop table {}".format(table))
+    db.commit()
+
+
+def sm_awards_xwalk(db, table_prefix="smpq", conf=None, engine="sql", batch_size=1000):
+    """Crosswalk the STAR METRICS awards to the agency award tables. With engine "memory"
+    this is done by sm_awards_xwalk_memory. Otherwise the candidates of each method are
+    found independently in MySQL; with conf, each method runs in its own thread on its
+    own connection. The candidates are then merged in order of precedence by
+    sm_awards_xwalk_merge."""
+
+    if engine == "memory":
+        sm_awards_xwalk_memory(db, table_prefix, batch_size)
+        return
+
+    tasks = [(sm_awards_xwalk_1x1, (table_prefix,))]
+    for _, agency_table, agency_award_id, year_field in SM_XWALK_AGENCIES:
+        tasks.append((sm_awards_xwalk_agency, (agency_table, agency_award_id, year_field, table_prefix)))
+
+    if conf:
+        run_in_threads([with_connection(conf, f, *args) for f, args in tasks])
+    else:
+        for f, args in tasks:
+            f(db, *args)
+
+    sm_awards_xwalk_merge(db, table_prefix)
+
+
+# Agency tables copied by sm_agency_init: (copy, umetricsgrants table, key column, extra
+# condition, whether duplicate keys are ignored).
+SM_AGENCY_COPIES = [("nih", "nih_project", "FULL_PROJECT_NUM", "nih.TOTAL_COST <> 0", False),
+                    ("nsf", "nsf_award", "AwardId", None, False),
+                    ("usda", "usda_grant", "grant_num", None, True),
+                    ("rg", "rg_award", "FederalAwardIDNumber", None, False)]
+
+
+def sm_agency_init(db, table_prefix="smpq", projection=None):
+    """Copy the agency awards matched by the crosswalk into air.{table_prefix}_nih, _nsf,
+    _usda and _rg. projection is a column projection as returned by column_projection;
+    the key column is always copied."""
+
+    projection = projection or {}
+    cur = db.cursor()
+
+    for copy, agency_table, key, condition, ignore in SM_AGENCY_COPIES:
+        if copy in projection:
+            columns = [key] + [c for c in projection[copy] if c != key]
+            select = ", ".join("{}.{}".format(copy, c) for c in columns)
+        else:
+            select = "{}.*".format(copy)
+
+        sql = """create table air.{table_prefix}_{copy}
+                 (primary key ({key}))
+                 {ignore}select {select}
+                 from umetricsgrants.{agency_table} {copy}
+                 join air.{table_prefix}_sm_awards awards on awards.umetricsgrants = '{agency_table}' and awards.award_id = {copy}.{key}"""
+
+        if condition:
+            sql += "\n                 where {}".format(condition)
+
+        cur.execute("drop table if exists air.{}_{}".format(table_prefix, copy))
+        cur.execute(sql.format(table_prefix=table_prefix, copy=copy, key=key, agency_table=agency_table,
+                               select=select, ignore="ignore " if ignore else ""))
+
+    db.commit()
+
+
+def sm_names_load(db, sm_source_ids, table_prefix="smpq", read_db=None, engine="python", batch_size=1000):
+    """Aggregate the employees of the given sources into air.{table_prefix}_sm_names.
+    If read_db is given, employees are streamed from read_db into db one at a time.
+    MySQL cannot run the inserts on the connection that is still reading the
+    unbuffered transaction query, so without a second connection the transactions
+    are collected in memory first.
+
+    engine selects how employees are aggregated: "python" uses the Employee class and
+    "columnar" NumPy arrays (see sm_single_pass_columnar), both in
+    sm_names_single_pass, which also
+    fills the names/awards and team size tables. "sql" computes the summary inside
+    MySQL with sm_summary_sql and leaves the other two tables to sm_init."""
+
+    if engine == "sql":
+        sm_insert_employees_sql(db, sm_source_ids, table_prefix)
+    else:
+        sm_names_single_pass(db, sm_source_ids, table_prefix, read_db, engine, batch_size)
+
+
+def sm_names_load_source(args):
+    """Worker for sm_init: load the employees of a single source, using connections of
+    its own. args is a (conf, source_id, source_name, table_prefix, engine) tuple so
+    that the function can be used with multiprocessing.Pool.map. Returns the index
+    timings of the worker."""
+
+    conf, source_id, source_name, table_prefix, engine = args
+
+    timings = len(INDEX_TIMINGS)
+    start = datetime.datetime.now()
+    with closing(db_connect(conf)) as db, closing(db_connect(conf)) as read_db:
+        sm_names_load(db, {source_id: source_name}, table_prefix, read_db, engine, conf["db_batch_size"])
+
+    print("Loaded employees from {} in {}".format(source_name, datetime.datetime.now() - start))
+
+    return new_index_timings(timings)
+
+
+def sm_employee_state_create(db, table_prefix="smpq"):
+    """Create the empty air.{table_prefix}_sm_employee_state table, which holds the
+    Employee.getstate of every employee as JSON."""
+
+    cur = db.cursor()
+    cur.execute("drop table if exists air.{}_sm_employee_state".format(table_prefix))
+    cur.execute("""create table air.{}_sm_employee_state (
+                   __employee_id int unsigned not null primary key,
+                   state text not null)""".format(table_prefix))
+
+    db.commit()
+
+
+def sm_employee_state_sql(table_prefix="smpq"):
+    """Return the statement that upserts one row of air.{table_prefix}_sm_employee_state."""
+
+    return """insert into air.{}_sm_employee_state (__employee_id, state)
+              values (%s, %s)
+              on duplicate key update state = values(state)""".format(table_prefix)
+
+
+def sm_save_employee_states(db, employees, table_prefix="smpq", batch_size=1000):
+    """Upsert the state of the given Employee objects into air.{table_prefix}_sm_employee_state."""
+
+    with BatchWriter(db, sm_employee_state_sql(table_prefix), batch_size, "employee states") as w:
+        for e in employees:
+            w.add((e.employee_id, json.dumps(e.getstate())))
+
+
+def sm_load_employee_states(db, delta_prefix, table_prefix="smpq"):
+    """Return a dict from __employee_id to the saved state of the employees in
+    air.{delta_prefix}_employees."""
+
+    cur = db.cursor()
+    cur.execute("""select s.__employee_id, s.state
+                   from air.{}_sm_employee_state s
+                   join air.{}_employees delta using (__employee_id)""".format(table_prefix, delta_prefix))
+
+    return dict((k, json.loads(v)) for k, v in cur.fetchall())
+
+
+def sm_resume(rows, states):
+    """Like sm_summarize, but employees with a saved state in states are restored with
+    Employee.fromstate and the rows are added to them. The result is the same as
+    summarizing all of the transactions only if the rows all come after the
+    transactions the states were computed from in SM_TRANSACTION_ORDER. That holds for
+    the transactions sm_refresh stages after the watermark date, but not for new ones
+    on the watermark date itself, which may sort before transactions loaded earlier;
+    sm_refresh summarizes the employees with those from all of their transactions."""
+
+    result = []
+    for employee_id, group in groupby(rows, key=lambda r: r["__employee_id"]):
+        if employee_id in states:
+            employee = Employee.fromstate(states[employee_id])
+        else:
+            employee = None
+
+        for row in group:
+            if employee:
+                employee.addtransaction(row)
+            else:
+                employee = Employee(row)
+
+        result.append(employee)
+
+    return result
+
+
+def sm_get_watermarks(db, sm_source_ids, table_prefix="smpq"):
+    """Return a dict from source id to the last period_start_date loaded by sm_init or
+    sm_refresh, or None for sources that have not been loaded."""
+
+    return dict((k, get_watermark(db, "sm_period_start_date_{}".format(k), table_prefix)) for k in sm_source_ids)
+
+
+def sm_set_watermarks(db, sm_source_ids, table_prefix="smpq", commit=True):
+    """Record the last period_start_date of each source in the staged transactions.
+    See set_watermark for commit."""
+
+    cur = db.cursor()
+    cur.execute("""select __source_id, max(period_start_date)
+                   from air.{}_sm_transactions
+                   group by 1""".format(table_prefix))
+    last = dict(cur.fetchall())
+
+    for k in sm_source_ids:
+        if last.get(k):
+            set_watermark(db, "sm_period_start_date_{}".format(k), last[k].isoformat(), table_prefix, commit)
+
+
+# Condition joining the staged transactions t and d that are the same transaction.
+SM_SAME_TRANSACTION = """t.__employee_id = d.__employee_id
+                         and t.period_start_date = d.period_start_date
+                         and t.period_end_date = d.period_end_date
+                         and t.__source_id = d.__source_id
+                         and t.__award_id = d.__award_id
+                         and t.occupational_classification <=> d.occupational_classification
+                         and t.x_occupational_classification <=> d.x_occupational_classification"""
+
+
+def sm_refresh_rollback(db, table_prefix="smpq"):
+    """Undo the append of an sm_refresh that stopped before it finished: remove the
+    transactions of air.{table_prefix}_delta_sm_transactions from
+    air.{table_prefix}_sm_transactions. The append and the watermark
+    "sm_refresh_appended" are committed together, and the delta tables are dropped
+    only after the watermark is removed again, so they are still there to undo."""
+
+    if not get_watermark(db, "sm_refresh_appended", table_prefix):
+        return
+
+    print("Undoing the interrupted STAR METRICS refresh")
+
+    cur = db.cursor()
+    cur.execute("""delete t
+                   from air.{}_sm_transactions t
+                   join air.{}_delta_sm_transactions d
+                   on {}""".format(table_prefix, table_prefix, SM_SAME_TRANSACTION))
+    delete_watermark(db, "sm_refresh_appended", table_prefix, False)
+    db.commit()
+
+
+def sm_watermark_date_employees(db, since, table_prefix="smpq"):
+    """Return the sorted ids of the employees with staged transactions (counting
+    towards employees) that start on the date of their source in since."""
+
+    conditions = ["(et.__source_id = {} and et.period_start_date = '{}')".format(k, v)
+                  for k, v in sorted(since.items()) if v]
+    if not conditions:
+        return []
+
+    cur = db.cursor()
+    cur.execute("""select distinct et.__employee_id
+                   from air.{}_sm_transactions et
+                   where et.occupational_classification is not null
+                   and ({})
+                   order by 1""".format(table_prefix, " or ".join(conditions)))
+
+    return [row[0] for row in cur.fetchall()]
+
+
+def sm_refresh(db, sm_source_ids, table_prefix="smpq", read_db=None, batch_size=1000, male_cutoff=0.2,
+               female_cutoff=0.8, conf=None, xwalk_engine="sql", projection=None):
+    """Add the transactions delivered since the last run to the STAR METRICS tables,
+    instead of building them again. Only the transactions of each source starting on or
+    after its watermark (see sm_get_watermarks) are staged, in the tables prefixed
+    {table_prefix}_delta; those already in air.{table_prefix}_sm_transactions (the ones
+    starting on the watermark date that were loaded before) are dropped, and the rest
+    are appended to it. Then:
+
+    - the awards with new transactions are summarized again and upserted;
+    - the employees with new transactions are restored from their saved state, the new
+      transactions are added with Employee.addtransaction and they are upserted into
+      sm_names. Employees with new transactions on the watermark date are summarized
+      from all of their transactions instead (see sm_resume);
+    - their new award links are added, their flags and gender are set again, and the
+      team sizes of all employees linked to an award and year with new transactions
+      are computed again;
+    - the awards without an award_id are crosswalked and the agency tables are copied.
+
+    The new employee states are saved and the watermarks moved in one transaction at
+    the end. If the refresh stops before that, the next one first removes the appended
+    transactions (see sm_refresh_rollback) and starts again from the same watermarks;
+    every other step overwrites its rows.
+
+    Transactions that arrive later with a period_start_date before the watermark of
+    their source are not picked up; sm_init without incremental rebuilds everything."""
+
+    delta_prefix = table_prefix + "_delta"
+
+    sm_refresh_rollback(db, table_prefix)
+
+    since = sm_get_watermarks(db, sm_source_ids, table_prefix)
+
+    sm_transactions_init(db, sm_source_ids, delta_prefix, since)
+
+    cur = db.cursor()
+    cur.execute("""delete d
+                   from air.{}_sm_transactions d
+                   join air.{}_sm_transactions t
+                   on {}""".format(delta_prefix, table_prefix, SM_SAME_TRANSACTION))
+    db.commit()
+
+    cur.execute("select count(*) from air.{}_sm_transactions".format(delta_prefix))
+    print("{} new STAR METRICS transactions".format(cur.fetchone()[0]))
+
+    for name, key in [("awards", "__award_id"), ("employees", "__employee_id")]:
+        cur.execute("drop table if exists air.{}_{}".format(delta_prefix, name))
+        cur.execute("""create table air.{delta_prefix}_{name}
+                       (primary key ({key}))
+                       select distinct {key}
+                       from air.{delta_prefix}_sm_transactions""".format(delta_prefix=delta_prefix,
+                                                                         name=name, key=key))
+    sm_employee_state_create(db, delta_prefix)
+
+    cur.execute("""insert into air.{}_sm_transactions
+                   select * from air.{}_sm_transactions""".format(table_prefix, delta_prefix))
+    set_watermark(db, "sm_refresh_appended", 1, table_prefix, False)
+    db.commit()
+
+    sm_awards_insert(db, table_prefix, delta_prefix)
+    sm_awards_set_agencies(db, table_prefix)
+
+    states = sm_load_employee_states(db, delta_prefix, table_prefix)
+
+    rebuild = sm_watermark_date_employees(db, since, delta_prefix)
+    rebuild_ids = set(rebuild)
+    if rebuild:
+        print("{} employees with new transactions on the watermark date are summarized again".format(len(rebuild)))
+
+    names_sql = """insert into air.{}_sm_names ({}) values ({})
+                   on duplicate key update {}""".format(table_prefix, ", ".join(SM_NAMES_COLUMNS),
+                                                        ", ".join("%s" for _ in SM_NAMES_COLUMNS),
+                                                        ", ".join("{0} = values({0})".format(k)
+                                                                  for k in SM_NAMES_COLUMNS[1:]))
+
+    batches = sm_employee_batches(db, sm_source_ids, delta_prefix, read_db, batch_size=max(batch_size, 10000))
+    with BatchWriter(db, names_sql, batch_size, "employees") as names_writer, \
+            BatchWriter(db, sm_employee_state_sql(delta_prefix), batch_size) as state_writer:
+        def write(employees):
+            for e in employees:
+                d = e.todict()
+                names_writer.add([d[k] for k in SM_NAMES_COLUMNS])
+                state_writer.add((e.employee_id, json.dumps(e.getstate())))
+
+        for rows in batches:
+            write(sm_resume([r for r in rows if r["__employee_id"] not in rebuild_ids], states))
+
+        for i in range(0, len(rebuild), SM_EMPLOYEE_CHUNK):
+            write(list(sm_get_employees(db, sm_source_ids, rebuild[i:i + SM_EMPLOYEE_CHUNK], table_prefix)))
+
+    sm_names_awards_init(db, table_prefix, delta_prefix)
+    sm_team_size_init(db, table_prefix, delta_prefix)
+    sm_names_set_flags(db, table_prefix, male_cutoff, female_cutoff, delta_prefix)
+
+    sm_awards_xwalk(db, table_prefix, conf, xwalk_engine, batch_size)
+    sm_agency_init(db, table_prefix, projection)
+
+    cur = db.cursor()
+    cur.execute("""insert into air.{}_sm_employee_state (__employee_id, state)
+                   select __employee_id, state from air.{}_sm_employee_state
+                   on duplicate key update state = values(state)""".format(table_prefix, delta_prefix))
+    sm_set_watermarks(db, sm_source_ids, table_prefix, False)
+    delete_watermark(db, "sm_refresh_appended", table_prefix, False)
+    db.commit()
+
+    for name in ["sm_transactions", "awards", "employees", "team_employees", "sm_employee_state"]:
+        cur.execute("drop table if exists air.{}_{}".format(delta_prefix, name))
+    db.commit()
+
+
+def sm_init(db, sm_source_ids, table_prefix="smpq", read_db=None, engine="python", conf=None, workers=1,
+            batch_size=1000, male_cutoff=0.2, female_cutoff=0.8, xwalk_engine="sql", projection=None,
+            incremental=False, manifest=None, gender=True):
+    """Create the STAR METRICS summary tables. See sm_names_load for read_db and engine,
+    sm_awards_xwalk for xwalk_engine and sm_agency_init for projection.
+
+    With incremental, the tables are updated with sm_refresh if a previous incremental
+    run saved the employee states and watermarks. Otherwise they are built from
+    scratch, and the states and watermarks are saved for the next run.
+
+    Sources do not share employees, so with workers > 1 (and conf, a ConnectionPool or
+    configuration to connect with) the employees of each source are loaded by a separate process
+    with its own database connections.
+
+    Each step is run as a stage of the RunManifest manifest, if given. Without gender,
+    the gender columns of sm_names are left to the caller (see sm_gender_stage).
+    Incremental refreshes always set them."""
+
+    def exists(*tables):
+        return lambda: all(table_exists(db, "{}_{}".format(table_prefix, t)) for t in tables)
+
+    inputs = [sorted(sm_source_ids.items()), table_prefix]
+
+    if incremental and table_exists(db, "{}_sm_employee_state".format(table_prefix)) \
+            and any(sm_get_watermarks(db, sm_source_ids, table_prefix).values()):
+        run_stage(manifest, "sm.refresh",
+                  lambda: sm_refresh(db, sm_source_ids, table_prefix, read_db=read_db, batch_size=batch_size,
+                                     male_cutoff=male_cutoff, female_cutoff=female_cutoff, conf=conf,
+                                     xwalk_engine=xwalk_engine, projection=projection),
+                  always=True)
+        return
+
+    run_stage(manifest, "sm.transactions", sm_transactions_init, (db, sm_source_ids, table_prefix),
+              inputs, valid=exists("sm_transactions"))
+
+    run_stage(manifest, "sm.awards", sm_awards_init, (db, table_prefix),
+              inputs, ["sm.transactions"], exists("sm_awards", "sm_awards_by_year"))
+
+    run_stage(manifest, "sm.names", sm_names_build,
+              (db, sm_source_ids, table_prefix, read_db, engine, conf, workers, batch_size),
+              inputs + [engine], ["sm.transactions", "sm.awards"],
+              exists("sm_names", "sm_names_awards", "sm_team_size"))
+
+    if gender:
+        sm_gender_stage(db, sm_source_ids, table_prefix, male_cutoff, female_cutoff, manifest)
+
+    run_stage(manifest, "sm.xwalk", sm_awards_xwalk, (db, table_prefix, conf, xwalk_engine, batch_size),
+              inputs + [xwalk_engine], ["sm.awards"])
+
+    run_stage(manifest, "sm.agency", sm_agency_init, (db, table_prefix, projection),
+              inputs + [projection], ["sm.xwalk"], exists("nih", "nsf", "usda", "rg"))
+
+    if incremental:
+        run_stage(manifest, "sm.state", sm_save_state, (db, sm_source_ids, table_prefix, read_db, batch_size),
+                  inputs, ["sm.names"], exists("sm_employee_state"))
+
+
+def sm_gender_stage(db, sm_source_ids, table_prefix="smpq", male_cutoff=0.2, female_cutoff=0.8, manifest=None):
+    """Run sm_names_set_flags as the sm.gender stage of manifest. See sm_init."""
+
+    run_stage(manifest, "sm.gender", sm_names_set_flags, (db, table_prefix, male_cutoff, female_cutoff),
+              [sorted(sm_source_ids.items()), table_prefix, male_cutoff, female_cutoff],
+              ["sm.names", "gender_probabilities"])
+
+
+def sm_names_build(db, sm_source_ids, table_prefix="smpq", read_db=None, engine="python", conf=None, workers=1,
+                   batch_size=1000):
+    """Create and fill air.{table_prefix}_sm_names, _sm_names_awards and _sm_team_size.
+    See sm_init."""
+
+    sm_names_init(db, table_prefix)
+    sm_names_awards_create(db, table_prefix)
+    sm_team_size_create(db, table_prefix)
+
+    if workers > 1 and conf and len(sm_source_ids) > 1:
+        pool = multiprocessing.Pool(min(workers, len(sm_source_ids)))
+        try:
+            timings = pool.map(sm_names_load_source,
+                               [(configuration(conf), k, v, table_prefix, engine) for k, v in sm_source_ids.items()],
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        for x in timings:
+            INDEX_TIMINGS.extend(x)
+    else:
+        sm_names_load(db, sm_source_ids, table_prefix, read_db, engine, batch_size)
+
+    if engine == "sql":
+        sm_names_awards_init(db, table_prefix)
+        sm_team_size_init(db, table_prefix)
+
+
+def sm_save_state(db, sm_source_ids, table_prefix="smpq", read_db=None, batch_size=1000):
+    """Save the state of every employee and the watermarks for sm_refresh."""
+
+    sm_employee_state_create(db, table_prefix)
+    employees = sm_get_employees(read_db or db, sm_source_ids, table_prefix=table_prefix)
+    if not read_db:
+        employees = list(employees)
+    sm_save_employee_states(db, employees, table_prefix, batch_size)
+    sm_set_watermarks(db, sm_source_ids, table_prefix)
+
+
+# Rows fetched from the server at a time by export_query, the number of fetched
+# batches that may wait to be written, and the write buffer of the export files.
+EXPORT_FETCH_SIZE = 10000
+EXPORT_QUEUE_SIZE = 4
+EXPORT_BUFFER_SIZE = 1 << 20
+
+
+def export_query(db, sql, path, fetch_size=EXPORT_FETCH_SIZE):
+    """Write the rows of the query sql to the CSV file path. The rows are streamed from
+    an unbuffered cursor by a reader thread while this thread writes them, so fetching
+    and writing overlap and memory holds only a few batches of fetch_size rows. The
+    file is written under a temporary name and renamed once it is complete."""
+
+    batches = queue.Queue(EXPORT_QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+
+    def put(rows):
+        while not stop.is_set():
+            try:
+                batches.put(rows, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def read():
+        cur = db.cursor(MySQLdb.cursors.SSCursor)
+        try:
+            cur.execute(sql)
+            while not stop.is_set():
+                rows = cur.fetchmany(fetch_size)
+                if not rows:
+                    break
+                put(rows)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(None)
+            cur.close()
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+
+    tmp = path + ".tmp"
+    try:
+        try:
+            with open(tmp, "w", EXPORT_BUFFER_SIZE) as f:
+                wr = csv.writer(f, lineterminator="\n")
+                while True:
+                    rows = batches.get()
+                    if rows is None:
+                        break
+                    wr.writerows(rows)
+        finally:
+            stop.set()
+            reader.join()
+
+        if errors:
+            raise errors[0]
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+
+def matching_input_queries(pq_institutions=None, sm_universities=None, table_prefix="smpq"):
+    """Return the file name, source table and query of each matching input file, see
+    create_matching_input_files."""
+
+    result = []
+
+    sql = """select left(last_name, 1), university, __employee_id, 
+             last_name, first_name, max_grad_year
+             from air.{}_sm_names
+             where max_grad_year is not null""".format(table_prefix)
+
+    if sm_universities:
+        unis = ", ".join("'{}'".format(x) for x in sm_universities)
+        sql += " and university in ({})".format(unis)
+
+    result.append(("smnames_grad.csv", "{}_sm_names".format(table_prefix), sql))
+
+    sql = """select left(last_name, 1), university, __employee_id,
+             last_name, first_name, ifnull(max_grad_year, year(max_period_end_date))
+             from air.{}_sm_names""".format(table_prefix)
+
+    if sm_universities:
+        unis = ", ".join("'{}'".format(x) for x in sm_universities)
+        sql += " where university in ({})".format(unis)
+
+    result.append(("smnames_all.csv", "{}_sm_names".format(table_prefix), sql))
+
+    sql = """select left(lastname, 1), university, publication_number, lastname, firstname, degree_year
+             from air.{}_proquest""".format(table_prefix)
+
+    if pq_institutions:
+        ids = ", ".join(str(n) for n in pq_institutions)
+        sql += " where institution_id in ({})".format(ids)
+
+    result.append(("proquest.csv", "{}_proquest".format(table_prefix), sql))
+
+    return result
+
+
+def read_fingerprint(path):
+    """Return the fingerprint stored next to the file path, or None if either is missing."""
+
+    if not os.path.exists(path) or not os.path.exists(path + ".fingerprint"):
+        return None
+
+    with open(path + ".fingerprint") as f:
+        return f.read().strip()
+
+
+def write_fingerprint(path, fingerprint):
+    """Store fingerprint next to the file path, see read_fingerprint."""
+
+    with open(path + ".fingerprint", "w") as f:
+        f.write(fingerprint + "\n")
+
+
+def table_checksum(db, table):
+    """Return the CHECKSUM TABLE of air.{table}, which changes with its contents."""
 
-    cur = db.cursor(MySQLdb.cursors.SSDictCursor)
-    cur.execute("""select e.__employee_id, s.name university, upper(e.last_name) last_name,
-                   upper(e.first_name) first_name, et.period_start_date, et.period_end_date,
-                   datediff(et.period_end_date, et.period_start_date) + 1 days_worked,
-                   o.occupational_classification, et.x_occupational_classification,
-                   ap.agency_code, ap.program_code, ap.is_nih
-                   from starmetricsnew.employee_transaction et
-                   join starmetricsnew.employee e using (__employee_id)
-                   join starmetricsnew.source s on s.__source_id = et.__source_id
-                   join starmetricsnew.occupation o using (__occupation_id)
-                   join starmetricsnew.award a using (__award_id)
-                   join starmetricsnew.agency_program ap using (__agency_program_id)
-                   where et.__source_id in ({})""".format(sm_source_id_list(sm_source_ids)))
+    cur = db.cursor()
+    cur.execute("checksum table air.{}".format(table))
 
-    row = cur.fetchone()
-    while row:
-        id = row["__employee_id"]
-        if id in employees:
-            employees[id].addtransaction(row)
+    return cur.fetchone()[1]
+
+
+def create_matching_input_files(db, directory=".", pq_institutions=None, sm_universities=None, table_prefix="smpq",
+                                conf=None, force=False):
+    """Create files to input into the matching program. Creates one CSV file from all records in
+    air.{table_prefix}_names with occupationalclassification 'Graduate' and another
+    from all records in {table_prefix}_proquest. Each file is streamed by export_query;
+    with conf (a ConnectionPool or configuration to connect with) the files are
+    exported at the same time, each on its own connection.
+
+    Each file is stored with a fingerprint of its query (which holds the table prefix,
+    pq_institutions and sm_universities) and of the checksum of its source table. A
+    file whose fingerprint has not changed is not exported again, unless force."""
+
+    checksums = {}
+    work = []
+    for name, table, sql in matching_input_queries(pq_institutions, sm_universities, table_prefix):
+        if table not in checksums:
+            checksums[table] = table_checksum(db, table)
+
+        path = os.path.join(directory, name)
+        data = json.dumps([sql, checksums[table]], default=str)
+        fingerprint = hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+        if not force and read_fingerprint(path) == fingerprint:
+            print("Skipping {} (unchanged)".format(name))
         else:
-            employees[id] = Employee(row)
+            work.append((path, sql, fingerprint))
 
-        row = cur.fetchone()
+    def export(db, path, sql, fingerprint):
+        export_query(db, sql, path)
+        write_fingerprint(path, fingerprint)
 
-    return employees
+    if conf:
+        run_in_threads([with_connection(conf, export, *x) for x in work])
+    else:
+        for x in work:
+            export(db, *x)
 
 
-def sm_insert_employees(db, employees, table_prefix="smpq"):
-    insert_columns = ["__employee_id", "university", "last_name", "first_name", "max_grad_year",
-                      "min_period_start_date", "max_period_end_date", "days_worked",
-                      "work_6_months_over_2_years", "work_12_months_over_2_years",
-                      "first_appear_bucketed_occup", "first_appear_orig_occup",
-                      "first_appear_date", "days_worked_under_first_occup",
-                      "first_appear_as_grad_date", "first_appear_as_grad_orig_occup",
-                      "last_appear_as_grad_date", "last_appear_as_grad_orig_occup",
-                      "days_worked_as_grad", "last_appear_bucketed_occup",
-                      "last_appear_orig_occup", "days_worked_under_last_occup",
-                      "work_6_months_on_nih", "work_6_months_on_nsf", "work_6_months_on_usda"]
+# Directions of the matching: STAR METRICS graduate students to ProQuest and ProQuest
+# to all STAR METRICS employees. Match and Assign take the direction as an optional
+# second argument and run both directions without it.
+MATCH_DIRECTIONS = ["sm-pq", "pq-sm"]
 
-    sql = "insert into air.{}_sm_names (".format(table_prefix)
-    sql += ", ".join(insert_columns)
-    sql += ") values ("
-    sql += ", ".join("%s" for _ in insert_columns)
-    sql += ")"
+# Input files of each direction.
+MATCH_INPUTS = {"sm-pq": ["smnames_grad.csv", "proquest.csv"],
+                "pq-sm": ["smnames_all.csv", "proquest.csv"]}
 
-    cur = db.cursor()
 
-    for e in employees.values():
-        d = e.todict()
-        values = [d[k] for k in insert_columns]
-        cur.execute(sql, values)
+def matching_fingerprint(directory, direction, blocking_keys=None):
+    """Return a fingerprint of the input files of direction and the blocking_keys, or
+    None if one of the files has no fingerprint (see create_matching_input_files)."""
 
-    db.commit()
+    inputs = [read_fingerprint(os.path.join(directory, x)) for x in MATCH_INPUTS[direction]]
+    if None in inputs:
+        return None
 
+    return hashlib.sha1(" ".join(inputs + (blocking_keys or [])).encode("utf-8")).hexdigest()
 
-def sm_name_fix(db, table_prefix="smpq"):
-    """Extract the first alphabetic word from the last name."""
 
-    cur = db.cursor()
-    cur2 = db.cursor()
+def initial_matching(directory=".", classpath=".", direction=None, force=False, shards=1, workers=1,
+                     blocking_keys=None):
+    """Run Match for direction, or both directions. The output of each direction is
+    stored with the fingerprint of its inputs, and Match is not run again while the
+    inputs are unchanged, unless force. With blocking_keys (names of BLOCKING_KEYS),
+    each direction is run by match_multipass, otherwise with shards > 1 by
+    match_sharded."""
 
-    cur.execute("select __employee_id, last_name from air.{}_proquest".format(table_prefix))
+    directions = [direction] if direction else MATCH_DIRECTIONS
+    outputs = [(os.path.join(directory, "{}_matching_output.csv".format(d.replace("-", "_"))),
+                matching_fingerprint(directory, d, blocking_keys)) for d in directions]
 
-    sql = "update air.{}_proquest set lastname = %s where publication_number = %s".format(table_prefix)
-    expr = re.compile("^[^.,]+")
+    if not force and all(fp is not None and read_fingerprint(path) == fp for path, fp in outputs):
+        print("Skipping matching {} (inputs unchanged)".format(direction or "in both directions"))
+        return
 
-    for row in cur:
-        publication_number, author = row
-        m = expr.search(author)
-        if m:
-            lastname = m.group().upper()
-            cur2.execute(sql, (lastname, publication_number))
+    if blocking_keys:
+        for d in directions:
+            match_multipass(directory, classpath, d, blocking_keys, shards, workers)
+    elif shards > 1:
+        for d in directions:
+            match_sharded(directory, classpath, d, shards, workers)
+    else:
+        subprocess.check_call(["java", "-cp", classpath, "Match", directory] + ([direction] if direction else []))
+
+    for path, fp in outputs:
+        if fp is not None:
+            write_fingerprint(path, fp)
+
+
+def block_shard(row, shards):
+    """Return the shard of a matching input row, by a hash of its blocking key
+    (flast, university)."""
+
+    key = "\t".join(row[:2])
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
+def shard_match_inputs(directory, direction, shards):
+    """Split the input files of direction into shards directories under
+    DIR/{prefix}_blocks, by block_shard. Blocks that appear in only one of the files
+    cannot produce any links and are left out. Return the shard directories that
+    received records."""
+
+    names = MATCH_INPUTS[direction]
+    paths = [os.path.join(directory, x) for x in names]
+
+    blocks = []
+    for path in paths:
+        with open(path) as f:
+            blocks.append(set(tuple(row[:2]) for row in csv.reader(f)))
+    shared = blocks[0] & blocks[1]
+
+    base = os.path.join(directory, "{}_blocks".format(direction.replace("-", "_")))
+    if os.path.isdir(base):
+        shutil.rmtree(base)
+
+    used = set()
+    for name, path in zip(names, paths):
+        files = {}
+        try:
+            with open(path) as f:
+                for row in csv.reader(f):
+                    if tuple(row[:2]) not in shared:
+                        continue
+
+                    i = block_shard(row, shards)
+                    if i not in files:
+                        shard_dir = os.path.join(base, "{:03d}".format(i))
+                        if not os.path.isdir(shard_dir):
+                            os.makedirs(shard_dir)
+                        out = open(os.path.join(shard_dir, name), "w", EXPORT_BUFFER_SIZE)
+                        files[i] = (out, csv.writer(out, lineterminator="\n"))
+                    files[i][1].writerow(row)
+        finally:
+            for out, _ in files.values():
+                out.close()
+        used.update(files)
+
+    print("Matching {}: {} shared blocks in {} shards".format(direction, len(shared), len(used)))
+
+    return [os.path.join(base, "{:03d}".format(i)) for i in sorted(used)]
+
+
+def concatenate_files(paths, output):
+    """Concatenate the files paths into output. A first line that repeats the first
+    line of the first file is taken to be a header and written only once."""
+
+    header = None
+    with open(output, "w", EXPORT_BUFFER_SIZE) as out:
+        for path in paths:
+            with open(path) as f:
+                first = f.readline()
+                if header is None:
+                    header = first
+                    out.write(first)
+                elif first != header:
+                    out.write(first)
+                shutil.copyfileobj(f, out)
+
+
+def match_sharded(directory=".", classpath=".", direction="sm-pq", shards=1, workers=1):
+    """Run Match for direction over the shards of shard_match_inputs, up to workers at
+    a time, and concatenate their outputs into the usual matching output of direction.
+    Matching only compares records within a block, so the links are the same as
+    those of a single run."""
+
+    shard_dirs = shard_match_inputs(directory, direction, shards)
+
+    scheduler = StageScheduler(workers)
+    for shard_dir in shard_dirs:
+        scheduler.add("Match {} {}".format(direction, os.path.basename(shard_dir)),
+                      lambda shard_dir=shard_dir: subprocess.check_call(
+                          ["java", "-cp", classpath, "Match", shard_dir, direction]))
+    scheduler.run()
+
+    # Match writes only the matching output; the clerical file is made by hand from
+    # it and must not be touched. With no shared blocks the output is empty, as that
+    # of a single run would be.
+    name = "{}_matching_output.csv".format(direction.replace("-", "_"))
+    paths = [os.path.join(x, name) for x in shard_dirs if os.path.exists(os.path.join(x, name))]
+    if paths or not shard_dirs:
+        concatenate_files(paths, os.path.join(directory, name))
+
+    if shard_dirs:
+        shutil.rmtree(os.path.dirname(shard_dirs[0]))
+
+
+def block_sizes(path):
+    """Return the number of records in each block (flast, university) of the matching
+    input file path."""
+
+    result = defaultdict(int)
+    with open(path) as f:
+        for row in csv.reader(f):
+            result[tuple(row[:2])] += 1
 
-    db.commit()
+    return result
 
 
+def blocking_report(directory=".", top=10):
+    """Report, for each direction, the records and blocks of its input files, the
+    comparisons Match will make (the sum over the shared blocks of left x right
+    records), the reduction against the full cross product, a histogram of the
+    comparisons per block and the top largest blocks. The sizes of every block are
+    written to DIR/{prefix}_blocking_report.csv. Only the input files are read, once
+    each."""
+
+    sizes = {}
+    for direction in MATCH_DIRECTIONS:
+        for name in MATCH_INPUTS[direction]:
+            if name not in sizes:
+                sizes[name] = block_sizes(os.path.join(directory, name))
+
+    for direction in MATCH_DIRECTIONS:
+        left, right = [sizes[x] for x in MATCH_INPUTS[direction]]
+        blocks = sorted(((left.get(k, 0) * right.get(k, 0), left.get(k, 0), right.get(k, 0), k)
+                         for k in set(left) | set(right)), reverse=True)
+
+        comparisons = sum(x[0] for x in blocks)
+        cross = sum(left.values()) * sum(right.values())
+        shared = sum(1 for x in blocks if x[0])
+
+        with open(os.path.join(directory, "{}_blocking_report.csv".format(direction.replace("-", "_"))), "w") as f:
+            wr = csv.writer(f, lineterminator="\n")
+            wr.writerow(["flast", "university", "left", "right", "comparisons"])
+            for n, l, r, k in blocks:
+                wr.writerow(list(k) + [l, r, n])
+
+        print("Blocking report {} ({} x {}):".format(direction, *MATCH_INPUTS[direction]))
+        print("  records: {} x {}".format(sum(left.values()), sum(right.values())))
+        print("  blocks: {} x {}, {} shared".format(len(left), len(right), shared))
+        print("  predicted comparisons: {}".format(comparisons))
+        if cross:
+            print("  full cross product: {}, reduction ratio {:.6f}".format(cross, 1 - float(comparisons) / cross))
+
+        histogram = defaultdict(int)
+        for n, _, _, _ in blocks:
+            if n:
+                histogram[len(str(n)) - 1] += 1
+        for e in sorted(histogram):
+            print("  blocks with {}-{} comparisons: {}".format(10 ** e, 10 ** (e + 1) - 1, histogram[e]))
+
+        print("  largest blocks:")
+        for n, l, r, k in blocks[:top]:
+            if n:
+                print("    {} / {}: {} x {} = {} ({:.1%})".format(k[0], k[1], l, r, n, float(n) / comparisons))
+
+
+SOUNDEX_CODES = dict((c, str(code)) for code, chars in enumerate(["AEIOUYHW", "BFPV", "CGJKQSXZ", "DT", "L", "MN", "R"])
+                     for c in chars)
+
+VOWELS = set("AEIOU")
+
+
+def letters(name):
+    """Return the letters A-Z of name in upper case."""
+
+    return "".join(c for c in name.upper() if "A" <= c <= "Z")
+
+
+def soundex(name):
+    """Return the American Soundex code of name: its first letter and three digits."""
+
+    name = letters(name)
+    if not name:
+        return ""
+
+    result = name[0]
+    last = SOUNDEX_CODES[name[0]]
+    for c in name[1:]:
+        code = SOUNDEX_CODES[c]
+        if code != "0" and code != last:
+            result += code
+        # H and W do not separate letters with the same code, vowels do.
+        if c not in "HW":
+            last = code
+
+    return (result + "000")[:4]
+
+
+def nysiis(name):
+    """Return the NYSIIS code of name."""
+
+    name = letters(name)
+    if not name:
+        return ""
+
+    for a, b in [("MAC", "MCC"), ("KN", "NN"), ("K", "C"), ("PH", "FF"), ("PF", "FF"), ("SCH", "SSS")]:
+        if name.startswith(a):
+            name = b + name[len(a):]
+            break
+
+    for a, b in [("EE", "Y"), ("IE", "Y"), ("DT", "D"), ("RT", "D"), ("RD", "D"), ("NT", "D"), ("ND", "D")]:
+        if name.endswith(a):
+            name = name[:-len(a)] + b
+            break
+
+    s = list(name)
+    result = s[0]
+    for i in range(1, len(s)):
+        c, prev, rest = s[i], s[i - 1], s[i + 1:]
+        if c == "E" and rest[:1] == ["V"]:
+            s[i:i + 2] = ["A", "F"]
+        elif c in VOWELS:
+            s[i] = "A"
+        elif c == "Q":
+            s[i] = "G"
+        elif c == "Z":
+            s[i] = "S"
+        elif c == "M":
+            s[i] = "N"
+        elif c == "K":
+            s[i] = "N" if rest[:1] == ["N"] else "C"
+        elif c == "S" and rest[:2] == ["C", "H"]:
+            s[i:i + 3] = ["S", "S", "S"]
+        elif c == "P" and rest[:1] == ["H"]:
+            s[i:i + 2] = ["F", "F"]
+        elif c == "H" and (prev not in VOWELS or not rest or rest[0] not in VOWELS):
+            s[i] = prev
+        elif c == "W" and prev in VOWELS:
+            s[i] = prev
+
+        if s[i] != result[-1]:
+            result += s[i]
+
+    if len(result) > 1 and result.endswith("S"):
+        result = result[:-1]
+    if result.endswith("AY"):
+        result = result[:-2] + "Y"
+    if len(result) > 1 and result.endswith("A"):
+        result = result[:-1]
 
-def sm_names_set_flags(db, table_prefix="smpq"):
+    return result
 
-    cur = db.cursor()
-    cur.execute("""update air.{}_sm_names sm
-                   join air.{}_gender_probabilities prob on sm.first_name = prob.firstname
-                   set sm.pr_fem = prob.pr_fem, sm.gender = prob.gender""".format(table_prefix, table_prefix))
 
-    cur.execute("""update air.{}_sm_names
-                   set gender = 'U'
-                   where gender is null""".format(table_prefix))
+def metaphone(name):
+    """Return the primary Double Metaphone code of name. Requires the metaphone package."""
 
-    db.commit()
+    if doublemetaphone is None:
+        raise ImportError("the metaphone blocking key requires the metaphone package")
 
+    return doublemetaphone(letters(name))[0]
 
-def sm_awards_init(db, sm_source_ids, table_prefix="smpq"):
-    cur= db.cursor()
-    cur.execute("drop table if exists air.{}_sm_awards".format(table_prefix))
-    cur.execute("drop table if exists air.{}_sm_awards_by_year".format(table_prefix))
 
-    cur.execute("""create table air.{}_sm_awards (
-                   __award_id int unsigned not null,
-                   unique_award_number varchar(60) not null,
-                   award_id varchar(50) null,
-                   umetricsgrants varchar(45) null,
-                   xwalk_id int unsigned null,
-                   cfda varchar(10) not null,
-                   agency_code int not null,
-                   nih tinyint not null default 0,
-                   nsf tinyint not null default 0,
-                   usda tinyint not null default 0,
-                   university varchar(45) not null,
-                   first_transaction_year int unsigned not null,
-                   first_period_start_date date not null,
-                   last_period_end_date date not null,
-                   team_size int not null,
-                   primary key (__award_id),
-                   index (unique_award_number),
-                   index (umetricsgrants),
-                   index (award_id))""".format(table_prefix))
+# Match.YearComparator still scores a pair whose end years differ by up to 3.
+MATCH_YEAR_TOLERANCE = 3
 
-    cur.execute("""create table air.{}_sm_awards_by_year (
-                   __award_id int unsigned not null,
-                   unique_award_number varchar(60) not null,
-                   year int not null,
-                   cfda varchar(10) not null,
-                   agency_code int not null,
-                   nih tinyint not null default 0,
-                   nsf tinyint not null default 0,
-                   usda tinyint not null default 0,
-                   team_size int null,
-                   primary key (__award_id, year))""".format(table_prefix))
+# A pair within the tolerance can straddle the boundary of any fixed bucket, so the
+# year buckets are used twice, the second time shifted by half their width. Buckets
+# wider than twice the tolerance leave no such pair split in both.
+YEAR_BUCKET_WIDTH = 2 * (MATCH_YEAR_TOLERANCE + 1)
 
-    cur.execute("""insert into air.{}_sm_awards
-                   (__award_id, unique_award_number, cfda, agency_code, nih, university, first_transaction_year, 
-                   first_period_start_date, last_period_end_date, team_size)
-                   select a.__award_id, a.unique_award_number, ap.cfda, ap.agency_code, ap.is_nih,
-                   group_concat(distinct s.name order by s.name separator '|'),
-                   min(year(et.period_start_date)), min(et.period_start_date), max(et.period_end_date),
-                   count(distinct e.__employee_id)
-                   from starmetricsnew.employee_transaction et
-                   join starmetricsnew.employee e using (__employee_id)
-                   join starmetricsnew.award a using (__award_id)
-                   join starmetricsnew.agency_program ap using (__agency_program_id)
-                   join starmetricsnew.source s on s.__source_id = et.__source_id
-                   where et.__source_id in ({})
-                   group by 1, 2, 3, 4, 5""".format(table_prefix, sm_source_id_list(sm_source_ids)))
 
-    cur.execute("""insert ignore into air.{}_sm_awards_by_year
-                   (__award_id, unique_award_number, cfda, agency_code, nih, year, team_size)
-                   select a.__award_id, a.unique_award_number, ap.cfda, ap.agency_code, ap.is_nih, 
-                          year(et.period_start_date), count(distinct e.__employee_id)
-                   from starmetricsnew.employee_transaction et
-                   join starmetricsnew.employee e using (__employee_id)
-                   join starmetricsnew.award a using (__award_id)
-                   join starmetricsnew.agency_program ap using (__agency_program_id)
-                   where et.__source_id in ({})
-                   group by 1, 2, 3, 4, 5, 6""".format(table_prefix, sm_source_id_list(sm_source_ids)))
+def year_bucket(year, width=YEAR_BUCKET_WIDTH, offset=0):
+    """Return the first year of the width-year bucket of year, with bucket boundaries
+    moved offset years earlier, or "" if year is missing."""
 
-    cur.execute("""update air.{}_sm_awards
-                   set nsf = 1
-                   where agency_code = 47""".format(table_prefix))
+    try:
+        return str((int(year) + offset) // width * width - offset)
+    except ValueError:
+        return ""
 
-    cur.execute("""update air.{}_sm_awards_by_year
-                   set nsf = 1
-                   where agency_code = 47""".format(table_prefix))
 
-    cur.execute("""update air.{}_sm_awards
-                   set usda = 1
-                   where agency_code = 10""".format(table_prefix))
+# Blocking keys for match_multipass. Each is computed from a matching input row
+# (flast, university, id, last name, first name, year) and replaces flast, so that
+# Match blocks on the key and the university.
+BLOCKING_KEYS = {
+    "initial": lambda row: row[0],
+    "soundex": lambda row: soundex(row[3]),
+    "nysiis": lambda row: nysiis(row[3]),
+    "metaphone": lambda row: metaphone(row[3]),
+    "prefix_year": lambda row: "{} {}".format(letters(row[3])[:3], year_bucket(row[5])),
+    "prefix_year_shifted": lambda row: "{} {}".format(letters(row[3])[:3],
+                                                      year_bucket(row[5], offset=YEAR_BUCKET_WIDTH // 2)),
+}
 
-    cur.execute("""update air.{}_sm_awards_by_year
-                   set usda = 1
-                   where agency_code = 10""".format(table_prefix))
+# Blocking keys that run as more than one pass.
+BLOCKING_KEY_PASSES = {
+    "prefix_year": ["prefix_year", "prefix_year_shifted"],
+}
 
-    db.commit()
 
+def blocking_key_functions(names):
+    """Return the (name, function) pairs of the passes of BLOCKING_KEYS names, with
+    the keys of BLOCKING_KEY_PASSES expanded and each pass listed once."""
 
-def sm_names_awards_init(db, table_prefix="smpq"):
-    """For all names in the air.{table_prefix}_sm_names table, create links to 
-       all star metrics awards for which they have transactions."""
+    for name in names:
+        if name not in BLOCKING_KEYS:
+            raise ValueError("Unknown blocking key '{}'".format(name))
 
-    cur = db.cursor()
-    cur.execute("drop table if exists air.{}_sm_names_awards".format(table_prefix))
+    if "metaphone" in names and doublemetaphone is None:
+        raise ImportError("the metaphone blocking key requires the metaphone package")
 
-    cur.execute("""create table air.{}_sm_names_awards (
-                   __employee_id int not null,
-                   university varchar(45) not null,
-                   __award_id int not null,
-                   unique_award_number varchar(60) not null,
-                   year int not null,
-                   primary key (__employee_id, __award_id, year))""".format(table_prefix))
+    passes = []
+    for name in names:
+        for x in BLOCKING_KEY_PASSES.get(name, [name]):
+            if x not in passes:
+                passes.append(x)
 
-    cur.execute("""insert into air.{table_prefix}_sm_names_awards
-                   select distinct et.__employee_id, names.university, 
-                          aby.__award_id, aby.unique_award_number, aby.year
-                   from air.{table_prefix}_sm_names names
-                   join starmetricsnew.employee_transaction et using (__employee_id)
-                   join air.{table_prefix}_sm_awards_by_year aby
-                   on aby.__award_id = et.__award_id and aby.year = year(et.period_start_date)""".format(table_prefix=table_prefix))
+    return [(x, BLOCKING_KEYS[x]) for x in passes]
 
-    db.commit()
 
-    cur.execute("""update air.{table_prefix}_sm_names names
-                   join (select __employee_id, max(nih) nih, max(nsf) nsf, max(usda) usda
-                         from air.{table_prefix}_sm_names_awards awards
-                         join air.{table_prefix}_sm_awards using (__award_id)
-                         group by 1) q using (__employee_id)
-                   set names.nih = q.nih, names.nsf = q.nsf, names.usda = q.usda""".format(table_prefix=table_prefix))
+def read_links(path):
+    """Return the (seq_1, seq_2) pairs of the links file path, or None if there is none."""
 
-    db.commit()
+    if not os.path.exists(path):
+        return None
 
+    with open(path) as f:
+        f.readline()
+        return set(tuple(row[1:3]) for row in csv.reader(f))
+
+
+def write_blocking_pass(directory, direction, name, key, reference_ids=(set(), set())):
+    """Write the input files of direction with flast replaced by the blocking key
+    function key to DIR/{prefix}_pass_{name}. Return the directory, the comparisons of
+    the pass and, for each file, the (key, university) of the records in
+    reference_ids."""
+
+    pass_dir = os.path.join(directory, "{}_pass_{}".format(direction.replace("-", "_"), name))
+    if os.path.isdir(pass_dir):
+        shutil.rmtree(pass_dir)
+    os.makedirs(pass_dir)
+
+    sizes = []
+    keys = []
+    for input_name, ids in zip(MATCH_INPUTS[direction], reference_ids):
+        sizes.append(defaultdict(int))
+        keys.append({})
+        with open(os.path.join(directory, input_name)) as f, \
+                open(os.path.join(pass_dir, input_name), "w", EXPORT_BUFFER_SIZE) as out:
+            wr = csv.writer(out, lineterminator="\n")
+            for row in csv.reader(f):
+                row[0] = key(row)
+                wr.writerow(row)
+                sizes[-1][tuple(row[:2])] += 1
+                if row[2] in ids:
+                    keys[-1][row[2]] = tuple(row[:2])
+
+    comparisons = sum(n * sizes[1].get(k, 0) for k, n in sizes[0].items())
+
+    return pass_dir, comparisons, keys
+
+
+def union_match_outputs(paths, output):
+    """Write the rows of the Match output files paths to output, leaving out the pairs
+    (seq_1, seq_2) already written. A first line that repeats the first line of the
+    first file is taken to be a header and written only once."""
+
+    header = None
+    seen = set()
+    with open(output, "w", EXPORT_BUFFER_SIZE) as out:
+        wr = csv.writer(out, lineterminator="\n")
+        for path in paths:
+            with open(path) as f:
+                for i, row in enumerate(csv.reader(f)):
+                    if i == 0:
+                        if header is None:
+                            header = row
+                        elif row == header:
+                            continue
+
+                    pair = tuple(row[1:3])
+                    if pair in seen:
+                        continue
+
+                    seen.add(pair)
+                    wr.writerow(row)
+
+
+def match_multipass(directory=".", classpath=".", direction="sm-pq", blocking_keys=("initial",), shards=1,
+                    workers=1):
+    """Run Match for direction once for each pass of the blocking_keys (names of
+    BLOCKING_KEYS, see blocking_key_functions), each pass on input files written by
+    write_blocking_pass, and write
+    the union of the candidate pairs of the passes to the usual output files of
+    direction. Match scores a pair by its names and years only, so a pair found by
+    several passes has the same score in each.
+
+    The comparisons of each pass are reported against those of the first-initial
+    blocks. If the working directory holds the links of a previous assignment, the
+    pair completeness of each pass and of the union (the fraction of these links
+    whose records share a block) is reported as well."""
+
+    passes = blocking_key_functions(blocking_keys)
+    prefix = direction.replace("-", "_")
+
+    reference = read_links(os.path.join(directory, "{}_links_1x1.csv".format(prefix)))
+    reference_ids = (set(x[0] for x in reference), set(x[1] for x in reference)) if reference else (set(), set())
+
+    left, right = [block_sizes(os.path.join(directory, x)) for x in MATCH_INPUTS[direction]]
+    print("Matching {}: {} comparisons with first-initial blocks".format(
+        direction, sum(n * right.get(k, 0) for k, n in left.items())))
+
+    pass_dirs = []
+    covered = set()
+    for name, key in passes:
+        pass_dir, comparisons, (left_keys, right_keys) = write_blocking_pass(directory, direction, name, key,
+                                                                             reference_ids)
+        pass_dirs.append(pass_dir)
+
+        message = "Matching {} pass {}: {} comparisons".format(direction, name, comparisons)
+        if reference:
+            found = set(x for x in reference if x[0] in left_keys and left_keys[x[0]] == right_keys.get(x[1]))
+            covered |= found
+            message += ", pair completeness {:.4f}".format(float(len(found)) / len(reference))
+        print(message)
+
+        if shards > 1:
+            match_sharded(pass_dir, classpath, direction, shards, workers)
+        else:
+            subprocess.check_call(["java", "-cp", classpath, "Match", pass_dir, direction])
 
-def sm_team_size_init(db, table_prefix="smpq"):
-    """By employee (__employee_id) and year, compute the average team size worked on."""
+    if reference:
+        print("Matching {}: pair completeness of the union {:.4f} against {} links".format(
+            direction, float(len(covered)) / len(reference), len(reference)))
 
-    cur = db.cursor()
+    for name in ["{}_matching_output.csv".format(prefix), "{}_matching_output_clerical.csv".format(prefix)]:
+        paths = [os.path.join(x, name) for x in pass_dirs if os.path.exists(os.path.join(x, name))]
+        if paths:
+            union_match_outputs(paths, os.path.join(directory, name))
 
-    cur.execute("drop table if exists air.{}_sm_team_size".format(table_prefix))
+    for pass_dir in pass_dirs:
+        shutil.rmtree(pass_dir)
 
-    cur.execute("""create table air.{}_sm_team_size (
-                   __employee_id int not null,
-                   year int not null,
-                   avg_team_size float not null,
-                   nih tinyint not null,
-                   nsf tinyint not null,
-                   primary key (__employee_id, year))""".format(table_prefix))
 
-    cur.execute("""insert into air.{table_prefix}_sm_team_size
-                   select names.__employee_id, aby.year, avg(aby.team_size),
-                          max(aby.nih), max(aby.nsf)
-                   from air.{table_prefix}_sm_names names
-                   join air.{table_prefix}_sm_names_awards na using (__employee_id)
-                   join air.{table_prefix}_sm_awards_by_year aby using (__award_id, year)
-                   group by 1, 2""".format(table_prefix=table_prefix))
+def extract_1x1_links(directory=".", classpath=".", direction=None):
+    subprocess.check_call(["java", "-cp", classpath, "Assign", directory] + ([direction] if direction else []))
 
-    db.commit()
 
+def names_proquest_create(db, table_prefix="smpq"):
+    """Create the link type table and the empty air.{table_prefix}_names_proquest table.
+    The table keeps its keys during the loads, so that a duplicate link is rejected
+    before anything is committed (insert_1x1_links loads both files in one
+    transaction)."""
 
-def sm_awards_xwalk_1x1(db, table_prefix="smpq"):
     cur = db.cursor()
+    cur.execute("""drop table if exists air.{}_names_proquest""".format(table_prefix))
+    cur.execute("""drop table if exists air.{}_names_proquest_link_type""".format(table_prefix))
 
-    cur.execute("""create temporary table air.award_id_count
-                   (primary key (award_id))
-                   select award_id, count(*) count
-                   from starmetrics.crosswalk
-                   group by 1
-                   having count(*) = 1""")
+    cur.execute("""create table air.{}_names_proquest_link_type (
+                   __link_type_id int unsigned primary key auto_increment,
+                   description varchar(100) not null)""".format(table_prefix))
 
-    cur.execute("""create temporary table air.uniqueawardnumber_count
-                   (primary key (uniqueawardnumber))
-                   select uniqueawardnumber, count(*) count
-                   from starmetrics.crosswalk
-                   group by 1
-                   having count(*) = 1""")
+    cur.execute("""insert into air.{}_names_proquest_link_type (description)
+                   values 
+                   ('StarMetrics to ProQuest (SM graduate students)'), 
+                   ('ProQuest to StarMetrics (all SM employees)')""".format(table_prefix))
 
-    cur.execute("""update air.{}_sm_awards awards
-                   join starmetrics.crosswalk x on x.uniqueawardnumber = awards.unique_award_number
-                   join air.award_id_count a on a.award_id = x.award_id
-                   join air.uniqueawardnumber_count b on b.uniqueawardnumber = x.uniqueawardnumber
-                   set awards.award_id = x.award_id, 
-                       awards.umetricsgrants = x.umetricsgrants,
-                       awards.xwalk_id = 1""".format(table_prefix))
+    cur.execute("""create table air.{table_prefix}_names_proquest (
+                   score double not null,
+                   __employee_id int not null,
+                   publication_number varchar(20) not null,
+                   __link_type_id int unsigned not null,
+                   primary key (__employee_id, publication_number, __link_type_id),
+                   foreign key (__link_type_id) references air.{table_prefix}_names_proquest_link_type (__link_type_id))""".format(table_prefix=table_prefix))
 
     db.commit()
 
-    cur.execute("drop temporary table air.award_id_count")
-    cur.execute("drop temporary table air.uniqueawardnumber_count")
 
-    db.commit()
+def insert_1x1_links(db, directory=".", drop_tables=False, table_prefix="smpq", batch_size=1000):
+    if drop_tables:
+        names_proquest_create(db, table_prefix)
 
+    sql = """insert into air.{}_names_proquest
+             (score, __employee_id, publication_number, __link_type_id)
+             values (%s, %s, %s, %s)""".format(table_prefix)
 
-def sm_awards_xwalk_agency(db, agency_table, agency_award_id, year_field, xwalk_id, table_prefix="smpq"):
-    cur = db.cursor()
+    # Both files go in one transaction: nothing is committed until every link is in.
+    with open(os.path.join(directory, "sm_pq_links_1x1.csv")) as f, BatchWriter(db, sql, batch_size, commit=False) as w:
+        f.readline()
+        rr = csv.reader(f)
 
-    sql = """create temporary table air.award_id_count
-             (primary key (award_id, start_year))
-             select x.award_id, year(a.{year_field}) start_year, count(distinct x.uniqueawardnumber) count
-             from starmetrics.crosswalk x
-             join umetricsgrants.{agency_table} a on a.{agency_award_id} = x.award_id
-             where x.umetricsgrants = '{agency_table}'
-             and a.{year_field} is not null
-             group by 1, 2
-             having count(distinct x.uniqueawardnumber) = 1"""
+        for row in rr:
+            row.append(1)
+            w.add(row)
 
-    cur.execute(sql.format(agency_table=agency_table, 
-                           year_field=year_field, 
-                           agency_award_id=agency_award_id))
-    
-    sql = """update air.{table_prefix}_sm_awards awards
-             join starmetrics.crosswalk x on x.uniqueawardnumber = awards.unique_award_number
-             join air.award_id_count a on a.award_id = x.award_id and a.start_year = awards.first_transaction_year
-             set awards.award_id = x.award_id, 
-                 awards.umetricsgrants = x.umetricsgrants,
-                 awards.xwalk_id = {xwalk_id}
-             where x.umetricsgrants = '{agency_table}'
-             and awards.award_id is null"""
+    with open(os.path.join(directory, "pq_sm_links_1x1.csv")) as f, BatchWriter(db, sql, batch_size, commit=False) as w:
+        f.readline()
+        rr = csv.reader(f)
 
-    cur.execute(sql.format(table_prefix=table_prefix, agency_table=agency_table, xwalk_id=xwalk_id))
+        for row in rr:
+            row.append(2)
+            w.add(row)
 
     db.commit()
 
-    cur.execute("drop temporary table air.award_id_count")
-    db.commit()
 
+# Steps of main that sharded runs perform per university; the others (the lookup
+# tables) are shared by all shards.
+SHARD_STEPS = ["sm_init", "sm_verify", "pq_init", "gender_recode", "matching_input", "blocking_report", "matching",
+               "assignment", "upload"]
 
-def sm_awards_xwalk(db, table_prefix="smpq"):
-    sm_awards_xwalk_1x1(db, table_prefix)
-    sm_awards_xwalk_agency(db, "nih_project", "FULL_PROJECT_NUM", "BUDGET_START", 2, table_prefix)
-    sm_awards_xwalk_agency(db, "nsf_award", "AwardId", "AwardEffectiveDate", 3, table_prefix)
-    sm_awards_xwalk_agency(db, "usda_grant", "grant_num", "start_date", 4, table_prefix)
-    sm_awards_xwalk_agency(db, "rg_award", "FederalAwardIDNumber", "AwardStartDate", 5, table_prefix)
 
+def shard_key(university):
+    """Return the name used for the table prefix and directory of a university's shard."""
 
-def sm_agency_init(db, table_prefix="smpq"):
-    cur = db.cursor()
-    cur.execute("drop table if exists air.{}_nih".format(table_prefix))
-    cur.execute("""create table air.{table_prefix}_nih
-                   (primary key (FULL_PROJECT_NUM))
-                   select nih.*
-                   from umetricsgrants.nih_project nih
-                   join air.{table_prefix}_sm_awards awards on awards.umetricsgrants = 'nih_project' and awards.award_id = nih.FULL_PROJECT_NUM
-                   where nih.TOTAL_COST <> 0""".format(table_prefix=table_prefix))
-
-    cur.execute("drop table if exists air.{}_nsf".format(table_prefix))
-    cur.execute("""create table air.{table_prefix}_nsf
-                   (primary key (AwardId))
-                   select nsf.*
-                   from umetricsgrants.nsf_award nsf
-                   join air.{table_prefix}_sm_awards awards on awards.umetricsgrants = 'nsf_award' and awards.award_id = nsf.AwardId""".format(table_prefix=table_prefix))
-
-    cur.execute("drop table if exists air.{}_usda".format(table_prefix))
-    cur.execute("""create table air.{table_prefix}_usda
-                   (primary key (grant_num))
-                   ignore select usda.*
-                   from umetricsgrants.usda_grant usda
-                   join air.{table_prefix}_sm_awards awards on awards.umetricsgrants = 'usda_grant' and awards.award_id = usda.grant_num""".format(table_prefix=table_prefix))
-
-    cur.execute("drop table if exists air.{}_rg".format(table_prefix))
-    cur.execute("""create table air.{table_prefix}_rg
-                   (primary key (FederalAwardIDNumber))
-                   select rg.*
-                   from umetricsgrants.rg_award rg
-                   join air.{table_prefix}_sm_awards awards on awards.umetricsgrants = 'rg_award' and awards.award_id = rg.FederalAwardIDNumber""".format(table_prefix=table_prefix))
+    return re.sub(r"\W+", "_", university).strip("_").lower()
 
-    db.commit()
 
+def shard_plan(conf):
+    """Return the shards of a sharded run: a list of (university, STAR METRICS source ids,
+    ProQuest institution ids) for the universities in both the [UMETRICS Universities]
+    and the [ProQuest Universities] sections of the configuration."""
 
-def sm_init(db, sm_source_ids, table_prefix="smpq"):
-    sm_names_init(db, table_prefix)
+    sm = defaultdict(dict)
+    for k, v in conf["sm_source_ids"].items():
+        sm[v.lower()][k] = v
 
-    employees = sm_get_employees(db, sm_source_ids)
-    sm_insert_employees(db, employees, table_prefix)
-    sm_names_set_flags(db)
+    pq = defaultdict(dict)
+    for k, v in conf["pq_institution_ids"].items():
+        pq[v.lower()][k] = v
 
-    sm_awards_init(db, sm_source_ids, table_prefix)
-    sm_names_awards_init(db, table_prefix)
-    sm_team_size_init(db, table_prefix)
-    sm_awards_xwalk(db, table_prefix)
-    sm_agency_init(db, table_prefix)
+    for university in sorted(set(sm) ^ set(pq)):
+        print("WARNING: {} is not configured for both STAR METRICS and ProQuest, skipping it".format(university))
 
+    return [(university, sm[university], pq[university]) for university in sorted(set(sm) & set(pq))]
 
-def create_matching_input_files(db, directory=".", pq_institutions=None, sm_universities=None, table_prefix="smpq"):
-    """Create files to input into the matching program. Creates one CSV file from all records in
-    air.{table_prefix}_names with occupationalclassification 'Graduate' and another
-    from all records in {table_prefix}_proquest."""
+
+def shard_sizes(db, shards):
+    """Estimate the size of each shard by its number of STAR METRICS transactions and
+    ProQuest dissertations. Returns a list in the order of shards."""
+
+    if not shards:
+        return []
+
+    sm_ids = [k for _, sm, _ in shards for k in sm]
+    pq_ids = [k for _, _, pq in shards for k in pq]
 
     cur = db.cursor()
-    
-    sql = """select left(last_name, 1), university, __employee_id, 
-             last_name, first_name, max_grad_year
-             from air.{}_sm_names
-             where max_grad_year is not null""".format(table_prefix)
+    cur.execute("""select __source_id, count(*)
+                   from starmetricsnew.employee_transaction
+                   where __source_id in ({})
+                   group by 1""".format(", ".join(str(k) for k in sm_ids)))
+    sm_counts = dict(cur.fetchall())
 
-    if sm_universities:
-        unis = ", ".join("'{}'".format(x) for x in sm_universities)
-        sql += " and university in ({})".format(unis)
+    cur.execute("""select institution_id, count(*)
+                   from proquest.dissertation
+                   where institution_id in ({})
+                   group by 1""".format(", ".join(str(k) for k in pq_ids)))
+    pq_counts = dict(cur.fetchall())
 
-    cur.execute(sql)
+    return [sum(sm_counts.get(k, 0) for k in sm) + sum(pq_counts.get(k, 0) for k in pq) for _, sm, pq in shards]
 
-    with open(os.path.join(directory, "smnames_grad.csv"), "w") as f:
-        wr = csv.writer(f, lineterminator="\n")
-        for row in cur:
-            wr.writerow(row)
 
-    sql = """select left(last_name, 1), university, __employee_id,
-             last_name, first_name, ifnull(max_grad_year, year(max_period_end_date))
-             from air.{}_sm_names""".format(table_prefix)
+def shard_lookup_views(db, table_prefix, lookup_prefix):
+    """Make the shared lookup tables of lookup_prefix available under the table prefix of
+    a shard as views, so that the shard's joins find them under their usual names."""
 
-    if sm_universities:
-        unis = ", ".join("'{}'".format(x) for x in sm_universities)
-        sql += " where university in ({})".format(unis)
+    cur = db.cursor()
+    for table in ["life_science", "gender_probabilities"]:
+        if table_exists(db, "{}_{}".format(lookup_prefix, table)):
+            cur.execute("""create or replace view air.{}_{}
+                           as select * from air.{}_{}""".format(table_prefix, table, lookup_prefix, table))
 
-    cur.execute(sql)
+    db.commit()
 
-    with open(os.path.join(directory, "smnames_all.csv"), "w") as f:
-        wr = csv.writer(f, lineterminator="\n")
-        for row in cur:
-            wr.writerow(row)
 
-    sql = """select left(lastname, 1), university, publication_number, lastname, firstname, degree_year
-             from air.{}_proquest""".format(table_prefix)
+def run_shard(args):
+    """Worker for run_sharded: run the steps of the command-line arguments for a single
+    university. args is a (conf, arguments, university, table prefix, directory, lookup
+    prefix) tuple, where conf is restricted to the university, so that the function
+    can be used with multiprocessing.Pool. Returns the university and the index timings
+    of the worker."""
 
-    if pq_institutions:
-        ids = ", ".join(str(n) for n in pq_institutions)
-        sql += " where institution_id in ({})".format(ids)
+    conf, arguments, university, table_prefix, directory, lookup_prefix = args
 
-    cur.execute(sql)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
 
-    with open(os.path.join(directory, "proquest.csv"), "w") as f:
-        wr = csv.writer(f, lineterminator="\n")
-        for row in cur:
-            wr.writerow(row)
+    timings = len(INDEX_TIMINGS)
+    start = datetime.datetime.now()
+
+    pool = ConnectionPool(conf, conf["db_pool_size"])
+    try:
+        with pool.connection() as db:
+            shard_lookup_views(db, table_prefix, lookup_prefix)
 
+        scheduler = StageScheduler(arguments.parallel_stages)
+        manifest = RunManifest(os.path.join(directory, "link3_manifest.json"), arguments.resume)
+        add_pipeline_stages(scheduler, conf, arguments, table_prefix, directory, manifest, pool)
+        scheduler.run()
+    finally:
+        pool.close()
 
-def initial_matching(directory="."):
-    subprocess.call(["java", "-cp", CLASSPATH, "Match", directory])
+    print("Finished shard {} in {}".format(university, datetime.datetime.now() - start))
 
+    return university, new_index_timings(timings)
 
-def extract_1x1_links(directory="."):
-    subprocess.call(["java", "-cp", CLASSPATH, "Assign", directory])
 
+def merge_shards(db, shards, table_prefix="smpq"):
+    """Merge the names_proquest tables of the shards into air.{table_prefix}_names_proquest."""
+
+    names_proquest_create(db, table_prefix)
 
-def insert_1x1_links(db, directory=".", drop_tables=False, table_prefix="smpq"):
     cur = db.cursor()
+    for university, _, _ in shards:
+        shard_prefix = "{}_{}".format(table_prefix, shard_key(university))
+        cur.execute("""insert into air.{}_names_proquest
+                       (score, __employee_id, publication_number, __link_type_id)
+                       select score, __employee_id, publication_number, __link_type_id
+                       from air.{}_names_proquest""".format(table_prefix, shard_prefix))
+        db.commit()
+
+
+def run_sharded(conf, arguments, table_prefix="smpq", directory="."):
+    """Run the steps of the command-line arguments (see main) separately for every
+    university configured for both STAR METRICS and ProQuest, in up to
+    arguments.workers processes. Each shard uses the table prefix
+    {table_prefix}_{shard_key} and the directory shard_{shard_key} below directory,
+    and shares the lookup tables of table_prefix. Matching is blocked on the
+    university, so no links are lost. The shards are started largest first, and
+    with --upload their links are merged into air.{table_prefix}_names_proquest."""
+
+    shards = shard_plan(conf)
+
+    if not shards:
+        print("WARNING: no university is configured for both STAR METRICS and ProQuest, nothing to shard")
+        return
+
+    with connection(conf) as db:
+        sizes = shard_sizes(db, shards)
+
+    work = []
+    for size, (university, sm_source_ids, pq_institution_ids) in sorted(zip(sizes, shards), key=lambda x: -x[0]):
+        print("Shard {}: about {} records".format(university, size))
+
+        shard_conf = dict(conf)
+        shard_conf["sm_source_ids"] = sm_source_ids
+        shard_conf["pq_institution_ids"] = pq_institution_ids
+
+        # Processes of a pool cannot start pools of their own.
+        shard_arguments = copy.copy(arguments)
+        shard_arguments.life_science_init = False
+        shard_arguments.gender_probabilities_init = False
+        shard_arguments.workers = 1
+
+        key = shard_key(university)
+        work.append((shard_conf, shard_arguments, university, "{}_{}".format(table_prefix, key),
+                     os.path.join(directory, "shard_{}".format(key)), table_prefix))
+
+    pool = multiprocessing.Pool(max(1, min(arguments.workers, len(work))))
+    try:
+        for university, timings in pool.imap_unordered(run_shard, work, chunksize=1):
+            INDEX_TIMINGS.extend(timings)
+    finally:
+        pool.close()
+        pool.join()
+
+    if arguments.upload:
+        print("Merging the links of {} shards...".format(len(shards)))
+        with connection(conf) as db:
+            merge_shards(db, shards, table_prefix)
+
+
+def add_pipeline_stages(scheduler, conf, args, table_prefix="smpq", directory=".", manifest=None, pool=None):
+    """Add the stages requested by the command-line arguments args (see main) to the
+    StageScheduler scheduler, with their dependencies. Each stage is also recorded in
+    the RunManifest manifest. The stages check their connections out of the
+    ConnectionPool pool, or open their own if no pool is given."""
+
+    male_cutoff = conf["gender_male_cutoff"]
+    female_cutoff = conf["gender_female_cutoff"]
+    projection = column_projection(args.projection or conf["projection_profile"], conf["projection"])
+
+    source = pool or conf
+
+    # Every stage runs on database connections of its own, so that independent stages
+    # can run at the same time. A stage that loses its connection is run again on new
+    # ones if retry is set, which is the case for the stages that rebuild their
+    # tables. Incremental refreshes update their tables in place and are left to the
+    # next run instead (sm_refresh first undoes an interrupted refresh).
+    def with_db(f, n=1, retry=True):
+        def stage():
+            for attempt in range(STAGE_RETRIES + 1 if retry else 1):
+                try:
+                    with connections(source, n) as dbs:
+                        f(*dbs)
+                    return
+                except MySQLdb.OperationalError as e:
+                    if not retry or attempt == STAGE_RETRIES or not connection_lost(e):
+                        raise
+                    print("Lost the database connection ({}), running the stage again".format(e))
+        return stage
+
+    def files_exist(*names):
+        return lambda: all(os.path.exists(os.path.join(directory, x)) for x in names)
 
-    if drop_tables:
-        cur.execute("""drop table if exists air.{}_names_proquest""".format(table_prefix))
-        cur.execute("""drop table if exists air.{}_names_proquest_link_type""".format(table_prefix))
-
-        cur.execute("""create table air.{}_names_proquest_link_type (
-                       __link_type_id int unsigned primary key auto_increment,
-                       description varchar(100) not null)""".format(table_prefix))
-
-        cur.execute("""insert into air.{}_names_proquest_link_type (description)
-                       values 
-                       ('StarMetrics to ProQuest (SM graduate students)'), 
-                       ('ProQuest to StarMetrics (all SM employees)')""".format(table_prefix))
-
-        cur.execute("""create table air.{table_prefix}_names_proquest (
-                       score double not null,
-                       __employee_id int not null,
-                       publication_number varchar(20) not null,
-                       __link_type_id int unsigned not null,
-                       primary key (__employee_id, publication_number, __link_type_id),
-                       foreign key (__link_type_id) references air.{table_prefix}_names_proquest_link_type (__link_type_id))""".format(table_prefix=table_prefix))
-
-    with open(os.path.join(directory, "sm_pq_links_1x1.csv")) as f:
-        f.readline()
-        rr = csv.reader(f)
+    if args.life_science_init:
+        def life_science_stage(db):
+            run_stage(manifest, "life_science", life_science_init,
+                      (db, conf["life_science_file"], table_prefix, conf["db_batch_size"]),
+                      [file_fingerprint(conf["life_science_file"]), table_prefix],
+                      valid=lambda: table_exists(db, "{}_life_science".format(table_prefix)))
 
-        for row in rr:
-            row.append(1)
-            cur.execute("""insert into air.{}_names_proquest
-                           (score, __employee_id, publication_number, __link_type_id)
-                           values (%s, %s, %s, %s)""".format(table_prefix), row)
+        scheduler.add("life_science", with_db(life_science_stage))
 
-    with open(os.path.join(directory, "pq_sm_links_1x1.csv")) as f:
-        f.readline()
-        rr = csv.reader(f)
+    if args.gender_probabilities_init:
+        def gender_probabilities_stage(db):
+            run_stage(manifest, "gender_probabilities", gender_probabilities_init,
+                      (db, conf["gender_file"], table_prefix, conf["db_batch_size"], not args.no_bulk_load),
+                      [file_fingerprint(conf["gender_file"]), table_prefix],
+                      valid=lambda: table_exists(db, "{}_gender_probabilities".format(table_prefix)))
 
-        for row in rr:
-            row.append(2)
-            cur.execute("""insert into air.{}_names_proquest
-                           (score, __employee_id, publication_number, __link_type_id)
-                           values (%s, %s, %s, %s)""".format(table_prefix), row)
+        scheduler.add("gender_probabilities", with_db(gender_probabilities_stage))
 
-    db.commit()
+    if args.sm_init: 
+        def sm_stage(db, read_db):
+            print("Creating STAR METRICS tables...")
+            sm_init(db, conf["sm_source_ids"], table_prefix, read_db=read_db, engine=args.sm_engine, conf=source,
+                    workers=args.workers, batch_size=conf["db_batch_size"], male_cutoff=male_cutoff,
+                    female_cutoff=female_cutoff, xwalk_engine=args.xwalk_engine, projection=projection,
+                    incremental=args.sm_incremental, manifest=manifest, gender=args.sm_incremental)
+
+        def sm_names_gender_stage(db):
+            sm_gender_stage(db, conf["sm_source_ids"], table_prefix, male_cutoff, female_cutoff, manifest)
+
+        if args.sm_incremental:
+            scheduler.add("sm", with_db(sm_stage, 2, retry=False), ["gender_probabilities"])
+        else:
+            scheduler.add("sm", with_db(sm_stage, 2))
+            scheduler.add("sm_gender", with_db(sm_names_gender_stage), ["sm", "gender_probabilities"])
+
+    if args.sm_verify:
+        def sm_verify_stage(db):
+            print("Comparing STAR METRICS engines...")
+            sm_verify_engines(db, conf["sm_source_ids"], args.sm_verify, table_prefix)
+
+        scheduler.add("sm_verify", with_db(sm_verify_stage), ["sm"])
+
+    if args.pq_init:
+        def pq_stage(db):
+            print("Creating ProQuest tables...")
+            pq_init(db, conf["pq_institution_ids"], conf["pq_min_year"], table_prefix, male_cutoff, female_cutoff,
+                    projection, source, args.workers, conf["db_batch_size"], args.pq_incremental, manifest,
+                    predict=args.pq_incremental)
+
+        def pq_names_life_science_stage(db):
+            pq_life_science_stage(db, conf["pq_institution_ids"], conf["pq_min_year"], table_prefix,
+                                  manifest=manifest)
+
+        def pq_names_gender_stage(db):
+            pq_gender_stage(db, conf["pq_institution_ids"], conf["pq_min_year"], table_prefix, male_cutoff,
+                            female_cutoff, manifest=manifest)
+
+        if args.pq_incremental:
+            scheduler.add("pq", with_db(pq_stage, retry=False), ["life_science", "gender_probabilities"])
+        else:
+            scheduler.add("pq", with_db(pq_stage))
+            scheduler.add("pq_life_science", with_db(pq_names_life_science_stage), ["pq", "life_science"])
+            scheduler.add("pq_gender", with_db(pq_names_gender_stage), ["pq", "gender_probabilities"])
+
+    if args.gender_recode:
+        def gender_recode_stage(db):
+            print("Recoding gender with cutoffs {} and {}...".format(male_cutoff, female_cutoff))
+            if table_exists(db, "{}_sm_names".format(table_prefix)):
+                sm_gender_coding(db, male_cutoff, female_cutoff, table_prefix)
+            if table_exists(db, "{}_proquest".format(table_prefix)):
+                pq_gender_coding(db, male_cutoff, female_cutoff, table_prefix=table_prefix)
+
+        scheduler.add("gender_recode", with_db(gender_recode_stage), ["sm", "sm_gender", "pq", "pq_gender"])
+
+    if args.matching_input:
+        def matching_input_stage(db):
+            print("Creating matching input files...")
+            run_stage(manifest, "matching_input", create_matching_input_files,
+                      (db, directory, None, None, table_prefix, source, args.force),
+                      [table_prefix], ["sm.gender", "sm.refresh", "pq.load", "pq.life_science", "pq.gender"],
+                      files_exist("smnames_grad.csv", "smnames_all.csv", "proquest.csv"), args.force)
+
+        scheduler.add("matching_input", with_db(matching_input_stage),
+                      ["sm", "sm_gender", "pq", "pq_life_science", "pq_gender"])
+
+    if args.blocking_report:
+        def blocking_report_stage():
+            blocking_report(directory)
+
+        scheduler.add("blocking_report", blocking_report_stage, ["matching_input"])
+
+    for direction in MATCH_DIRECTIONS:
+        prefix = direction.replace("-", "_")
+
+        if args.matching:
+            def matching_stage(direction=direction, prefix=prefix):
+                print("Performing record linkage ({})...".format(direction))
+                run_stage(manifest, "matching." + direction, initial_matching,
+                          (directory, conf["classpath"], direction, args.force, args.match_shards,
+                           args.match_workers, args.blocking_keys),
+                          depends=["matching_input"],
+                          valid=files_exist("{}_matching_output.csv".format(prefix)), always=args.force)
+
+            scheduler.add("matching." + direction, matching_stage, ["matching_input", "blocking_report"])
+
+        if args.assignment:
+            def assignment_stage(direction=direction, prefix=prefix):
+                print("Extracting one-to-one links ({})...".format(direction))
+                run_stage(manifest, "assignment." + direction, extract_1x1_links,
+                          (directory, conf["classpath"], direction),
+                          [file_fingerprint(os.path.join(directory, "{}_matching_output_clerical.csv".format(prefix)))],
+                          ["matching." + direction],
+                          files_exist("{}_links_1x1.csv".format(prefix)))
+
+            scheduler.add("assignment." + direction, assignment_stage, ["matching." + direction])
+
+    if args.upload:
+        def upload_stage(db):
+            print("Loading one-to-one links into the database...")
+            run_stage(manifest, "upload", insert_1x1_links, (db, directory, True, table_prefix, conf["db_batch_size"]),
+                      [table_prefix], ["assignment." + d for d in MATCH_DIRECTIONS],
+                      lambda: table_exists(db, "{}_names_proquest".format(table_prefix)))
+
+        scheduler.add("upload", with_db(upload_stage), ["assignment." + d for d in MATCH_DIRECTIONS])
 
 
 def main(argv):
@@ -943,15 +4292,75 @@ def main(argv):
     parser.add_argument("--gender-probabilities-init", action="store_true",
             help="Load names and gender probabilities into the database.")
 
+    parser.add_argument("--sharded", action="store_true",
+            help="Run the STAR METRICS, ProQuest, matching and upload steps separately for each "
+                 "university, in up to --workers processes, and merge the links")
+
+    parser.add_argument("--parallel-stages", action="store", type=int, default=1, metavar="N",
+            help="Run up to N independent stages at the same time")
+
+    parser.add_argument("--match-shards", action="store", type=int, default=1, metavar="N",
+            help="Split the matching inputs into N shards by blocking key and match them separately")
+
+    parser.add_argument("--blocking-keys", action="store", type=lambda x: x.split(","), metavar="KEYS",
+            help="Match in one pass for each of the comma-separated blocking keys and merge the "
+                 "candidate pairs: initial, soundex, nysiis, metaphone, prefix_year or prefix_year_shifted")
+
+    parser.add_argument("--match-workers", action="store", type=int, default=multiprocessing.cpu_count(),
+            metavar="N", help="Run up to N Match processes at a time with --match-shards "
+                              "(default: the number of CPUs)")
+
+    parser.add_argument("--resume", action="store_true",
+            help="Skip the stages recorded as completed in link3_manifest.json in the working "
+                 "directory whose inputs have not changed")
+
+    parser.add_argument("--force", action="store_true",
+            help="Recreate the matching input files and rerun the matching even if their "
+                 "inputs have not changed")
+
+    parser.add_argument("--no-bulk-load", action="store_true",
+            help="Insert the gender-name table row by row instead of with LOAD DATA LOCAL INFILE")
+
     parser.add_argument("--sm-init", action="store_true",
             help="Initialize STAR METRICS summary tables")
 
+    parser.add_argument("--sm-incremental", action="store_true",
+            help="With --sm-init, add only the transactions delivered since the last incremental run")
+
+    parser.add_argument("--sm-engine", action="store", choices=["python", "columnar", "sql"], default="python",
+            help="How to aggregate STAR METRICS employees: one Employee object at a time "
+                 "('python'), in NumPy batches ('columnar') or inside MySQL ('sql')")
+
+    parser.add_argument("--projection", action="store", choices=sorted(PROJECTION_PROFILES),
+            help="Column projection profile for the copied ProQuest and agency tables "
+                 "(default: the profile in the [Column Projection] section, or 'full')")
+
+    parser.add_argument("--xwalk-engine", action="store", choices=["sql", "memory"], default="sql",
+            help="How to crosswalk STAR METRICS awards: with temporary tables in MySQL ('sql') "
+                 "or with hash indexes in memory ('memory')")
+
+    parser.add_argument("--workers", action="store", type=int, default=1, metavar="N",
+            help="Number of worker processes for --sm-init, one STAR METRICS source per worker, "
+                 "and of insert threads for --pq-init")
+
+    parser.add_argument("--sm-verify", action="store", type=int, nargs="?", const=1000, metavar="N",
+            help="Compare the Python, columnar and SQL STAR METRICS engines on a sample of N employees (default 1000)")
+
     parser.add_argument("--pq-init", action="store_true",
             help="Initialize ProQuest summary tables")
     
+    parser.add_argument("--pq-incremental", action="store_true",
+            help="With --pq-init, load only the dissertations added since the last run")
+
+    parser.add_argument("--gender-recode", action="store_true",
+            help="Recode gender in the STAR METRICS and ProQuest tables using the current cutoffs")
+
     parser.add_argument("--matching-input", action="store_true",
             help="Create input files for matching")
 
+    parser.add_argument("--blocking-report", action="store_true",
+            help="Report the block sizes and predicted comparisons of the matching input files")
+
     parser.add_argument("--matching", action="store_true",
             help="Run the matching program on the matching input file")
 
@@ -963,61 +4372,50 @@ def main(argv):
 
     args = parser.parse_args(argv)
 
+    if args.blocking_keys:
+        blocking_key_functions(args.blocking_keys)
+
     conf = read_configuration("config.properties")
 
-    if args.life_science_init or args.gender_probabilities_init or args.sm_init or \
-            args.pq_init or args.matching_input or args.upload:
-        db = MySQLdb.connect(user=conf["db_user"], 
-                             passwd=conf["db_passwd"], 
-                             db=conf["db_db"], 
-                             host=conf["db_host"])
-
-        if args.table_prefix:
-            table_prefix = args.table_prefix
-        else:
-            table_prefix = "smpq"
+    if args.table_prefix:
+        table_prefix = args.table_prefix
+    else:
+        table_prefix = "smpq"
 
+    if args.life_science_init or args.gender_probabilities_init or args.sm_init or \
+            args.sm_verify or args.pq_init or args.gender_recode or args.matching_input or args.upload:
         print("Using table prefix '{}'".format(table_prefix))
 
-    if args.matching_input or args.matching or args.assignment or args.upload:
+    directory = args.directory or "."
+
+    if args.matching_input or args.blocking_report or args.matching or args.assignment or args.upload:
         if args.directory:
             print("Using working directory: {}".format(args.directory))
-            directory = args.directory
         else:
             print("WARNING: no working directory specified, using current directory")
-            directory = "."
-
-    if args.life_science_init:
-        life_science_init(db, table_prefix)
 
-    if args.gender_probabilities_init:
-        male_cutoff = conf["gender_male_cutoff"]
-        female_cutoff = conf["gender_female_cutoff"]
-
-        gender_probabilities_init(db, conf["gender_file"], male_cutoff, female_cutoff, table_prefix)
-
-    if args.sm_init: 
-        print("Creating STAR METRICS tables...")
-        sm_init(db, conf["sm_source_ids"], table_prefix)
+    manifest = RunManifest(os.path.join(directory, "link3_manifest.json"), args.resume)
 
-    if args.pq_init:
-        print("Creating ProQuest tables...")
-        pq_init(db, table_prefix)
+    scheduler = StageScheduler(args.parallel_stages)
+    pool = ConnectionPool(conf, conf["db_pool_size"])
 
-    if args.matching_input:
-        print("Creating matching input files...")
-        create_matching_input_files(db, directory)
+    try:
+        if args.sharded:
+            lookups = copy.copy(args)
+            for k in SHARD_STEPS:
+                setattr(lookups, k, False)
 
-    if args.matching:
-        print("Performing record linkage...")
-        initial_matching(directory)
+            add_pipeline_stages(scheduler, conf, lookups, table_prefix, directory, manifest, pool)
+            scheduler.run()
 
-    if args.assignment:
-        print("Extracting one-to-one links...")
-        extract_1x1_links(directory)
+            run_sharded(conf, args, table_prefix, directory)
+        else:
+            add_pipeline_stages(scheduler, conf, args, table_prefix, directory, manifest, pool)
+            scheduler.run()
+    finally:
+        pool.close()
 
-    if args.upload:
-        print("Loading one-to-one links into the database...")
+    index_report()
 
     print("DONE")
 